@@ -0,0 +1,81 @@
+"""Store money as integer minor units
+
+Revision ID: 5d2a7c1e9f30
+Revises: e8f03b7d9c14
+Create Date: 2026-10-18 13:21:09.642811
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2a7c1e9f30'
+down_revision: Union[str, None] = 'e8f03b7d9c14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+REAL = sqlite.REAL(precision=18, decimal_return_scale=2)
+MONEY_COLUMNS = [('users', 'balance'), ('transfers', 'amount')]
+
+
+def create_user_transfer_stats(money_type, server_default) -> None:
+    op.create_table('user_transfer_stats',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('sent_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('sent_amount', money_type, server_default=server_default, nullable=False),
+    sa.Column('received_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('received_amount', money_type, server_default=server_default, nullable=False),
+    sa.Column('transfer_count', sa.Integer(), sa.Computed('sent_count + received_count', ), nullable=True),
+    sa.Column('total_amount', money_type, sa.Computed('sent_amount + received_amount', ), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index('ix_user_transfer_stats_total_amount', 'user_transfer_stats', ['total_amount'], unique=False)
+    op.create_index('ix_user_transfer_stats_transfer_count', 'user_transfer_stats', ['transfer_count'], unique=False)
+    # the table only holds aggregates, recompute them from the transfers
+    op.execute(
+        """
+        INSERT INTO user_transfer_stats (user_id, sent_count, sent_amount)
+        SELECT sender_id, count(*), sum(amount) FROM transfers
+        WHERE status = 'COMPLETED'
+        GROUP BY sender_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO user_transfer_stats (user_id, received_count, received_amount)
+        SELECT receiver_id, count(*), sum(amount) FROM transfers
+        WHERE status = 'COMPLETED' AND receiver_id != sender_id
+        GROUP BY receiver_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            received_count = excluded.received_count,
+            received_amount = excluded.received_amount
+        """
+    )
+
+
+def drop_user_transfer_stats() -> None:
+    op.drop_index('ix_user_transfer_stats_transfer_count', table_name='user_transfer_stats')
+    op.drop_index('ix_user_transfer_stats_total_amount', table_name='user_transfer_stats')
+    op.drop_table('user_transfer_stats')
+
+
+def upgrade() -> None:
+    drop_user_transfer_stats()
+    for table, column in MONEY_COLUMNS:
+        op.execute(f'UPDATE {table} SET {column} = CAST(round({column} * 100) AS INTEGER)')
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, existing_type=REAL, type_=sa.Integer(), server_default='0', existing_nullable=False)
+    create_user_transfer_stats(sa.Integer(), '0')
+
+
+def downgrade() -> None:
+    drop_user_transfer_stats()
+    for table, column in MONEY_COLUMNS:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, existing_type=sa.Integer(), type_=REAL, server_default='0.0', existing_nullable=False)
+        op.execute(f'UPDATE {table} SET {column} = {column} / 100.0')
+    create_user_transfer_stats(REAL, '0.0')
@@ -0,0 +1,20 @@
+import argparse
+from pathlib import Path
+
+from app.main import openapi
+from app.scheme import OPENAPI_ARTIFACT_DIR
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write the app's OpenAPI schema, as served, for workers to "
+        "load at start instead of building it, see `app.scheme`."
+    )
+    parser.add_argument("--dir", type=Path, default=OPENAPI_ARTIFACT_DIR)
+    args = parser.parse_args()
+    path = openapi.write(args.dir)
+    print(f"OpenAPI schema written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,172 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+from sqlalchemy import Engine
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy import MetaData
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.metrics import instrument_engine
 
 metadata = MetaData()
 
-# Create a sync engine and session factory
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./db.sqlite")
+
+
+@dataclass(frozen=True)
+class EngineProfile:
+    """
+    SQLite settings applied to every new connection, and the pools of the
+    read and write engines.
+    """
+
+    journal_mode: str = "wal"  # readers no longer block the writer
+    synchronous: str = "normal"  # WAL is still durable, fsync at checkpoints
+    busy_timeout: int = 5_000  # ms to wait on a lock before "database is locked"
+    cache_size: int = -64_000  # page cache per connection, negative means KiB
+    mmap_size: int = 256 * 1024 * 1024
+    temp_store: str = "memory"
+    # Write transactions take the write lock upfront (BEGIN IMMEDIATE), so
+    # they queue on busy_timeout instead of failing when upgrading a read lock
+    write_begin: str = "BEGIN IMMEDIATE"
+    # SQLite has a single writer: one pooled connection serializes the
+    # process' writes in the pool rather than in SQLite's lock
+    write_pool_size: int = 1
+    read_pool_size: int = 10
+
+    def pragmas(self) -> dict[str, str | int]:
+        return {
+            "journal_mode": self.journal_mode,
+            "synchronous": self.synchronous,
+            "busy_timeout": self.busy_timeout,
+            "cache_size": self.cache_size,
+            "mmap_size": self.mmap_size,
+            "temp_store": self.temp_store,
+        }
+
+
+PROFILES = {
+    "production": EngineProfile(),
+    # SQLite's own defaults and a shared pool, as the app used to run
+    "legacy": EngineProfile(
+        journal_mode="delete",
+        synchronous="full",
+        cache_size=-2_000,
+        mmap_size=0,
+        temp_store="default",
+        write_begin="BEGIN",
+        write_pool_size=10,
+    ),
+    # fsync on every commit, so a committed ledger batch survives power loss;
+    # the ledger's group commit pays it once per batch
+    "durable": EngineProfile(synchronous="full"),
+}
+profile = PROFILES[os.environ.get("DB_PROFILE", "production")]
+
+
+def configure_sqlite(engine: Engine, profile: EngineProfile, begin: str) -> None:
+    """
+    Apply the profile's pragmas on connect and emit `begin` ourselves: the
+    sqlite3 driver's implicit transactions ignore SAVEPOINTs and always begin
+    deferred.
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in profile.pragmas().items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql(begin)
+
+
+@dataclass(frozen=True)
+class Database:
+    """The sync, write and read engines of a database and their sessions."""
+
+    engine: Engine
+    session_factory: sessionmaker
+    write_engine: AsyncEngine
+    write_session_factory: async_sessionmaker
+    read_engine: AsyncEngine
+    read_session_factory: async_sessionmaker
+
+
+def sibling_url(url: str, name: str) -> str:
+    """URL of the `name` database next to the one at `url`, `db.<name>.sqlite`."""
+    url = make_url(url)
+    path = Path(url.database)
+    path = path.with_suffix(f".{name}{path.suffix}")
+    return url.set(database=str(path)).render_as_string(hide_password=False)
+
+
+def open_database(url: str, label: str = "") -> Database:
+    """
+    Engines and session factories for the database at `url`, their metrics
+    are labelled e.g. `write` + `label`. Nothing connects until first used.
+    """
+    # A sync engine and session factory, used by scripts such as the seeder
+    engine = create_engine(
+        url,
+        pool_size=10,  # Max connections in the pool
+        max_overflow=20,  # Extra connections that can be created beyond `pool_size`
+        pool_timeout=30,  # Wait time before giving up on getting a connection
+    )
+    configure_sqlite(engine, profile, "BEGIN")
+    instrument_engine(engine, f"sync{label}")
+
+    # Async read and write engines, used by the API so that database waits do
+    # not block the event loop. aiosqlite defaults to NullPool, connections
+    # are kept pooled like for the sync engine.
+    async_url = url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    write_engine = create_async_engine(
+        async_url,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=profile.write_pool_size,
+        max_overflow=0,
+        pool_timeout=30,
+    )
+    configure_sqlite(write_engine.sync_engine, profile, profile.write_begin)
+    instrument_engine(write_engine.sync_engine, f"write{label}")
+
+    read_engine = create_async_engine(
+        async_url,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=profile.read_pool_size,
+        max_overflow=20,
+        pool_timeout=30,
+    )
+    configure_sqlite(read_engine.sync_engine, profile, "BEGIN")
+    instrument_engine(read_engine.sync_engine, f"read{label}")
+
+    # Objects are not expired on commit: attribute access after a commit
+    # would otherwise trigger an implicit (and forbidden) lazy load under
+    # asyncio
+    return Database(
+        engine=engine,
+        session_factory=sessionmaker(engine),
+        write_engine=write_engine,
+        write_session_factory=async_sessionmaker(write_engine, expire_on_commit=False),
+        read_engine=read_engine,
+        read_session_factory=async_sessionmaker(read_engine, expire_on_commit=False),
+    )
+
 
-engine = create_engine(
-    "sqlite:///./db.sqlite",
-    pool_size=10,  # Max connections in the pool
-    max_overflow=20,  # Extra connections that can be created beyond `pool_size`
-    pool_timeout=30,  # Wait time before giving up on getting a connection
-)
-session_factory = sessionmaker(engine)
+database = open_database(DATABASE_URL)
+engine = database.engine
+session_factory = database.session_factory
+write_engine = database.write_engine
+write_session_factory = database.write_session_factory
+read_engine = database.read_engine
+read_session_factory = database.read_session_factory
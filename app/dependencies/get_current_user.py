@@ -1,15 +1,66 @@
+import os
+
+from fastapi import Depends
 from fastapi import HTTPException
 from fastapi import Request
+from fastapi import WebSocket
+from fastapi import WebSocketException
 from fastapi import status
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import session_factory
+from app.cache import TTLCache
+from app.dependencies.get_session import get_read_session, request_shard
 from app.models import User
+from app.services import pydantic_models
+
+# Identities (id and username) only: balances change too often to be cached
+user_cache = TTLCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", 10_000)),
+    ttl=float(os.environ.get("USER_CACHE_TTL", 60)),
+)
+
+
+@event.listens_for(User.username, "set")
+def _invalidate_renamed_user(target, value, oldvalue, initiator):
+    if target.id is not None:
+        user_cache.invalidate(target.id)
+
 
+@event.listens_for(User, "after_delete")
+def _invalidate_deleted_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
 
-async def get_current_user(request: Request) -> User:
-    if user_id := request.headers.get("user_id", None):
-        with session_factory() as session:
-            user = session.get(User, user_id)
-            if user:
-                return user
+
+async def get_current_user(
+    request: Request, session: AsyncSession = Depends(get_read_session)
+) -> pydantic_models.User:
+    """
+    Authenticate the `user_id` header. Cache misses are looked up with the
+    request's read session, which FastAPI shares with read-only handlers;
+    sessions only check out a connection when first used.
+    """
+    try:
+        user_id = int(request.headers.get("user_id", ""))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+
+    if user := user_cache.get(user_id):
+        return user
+    if db_user := await session.get(User, user_id):
+        user = pydantic_models.User.model_validate(db_user)
+        user_cache.set(user_id, user)
+        return user
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+
+
+async def get_websocket_user(websocket: WebSocket) -> pydantic_models.User:
+    """
+    `get_current_user` for WebSockets, with a session of its own: the
+    dependencies of a WebSocket endpoint are only closed once it returns.
+    """
+    async with request_shard(websocket).database.read_session_factory() as session:
+        try:
+            return await get_current_user(websocket, session)
+        except HTTPException:
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
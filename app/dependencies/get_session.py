@@ -1,7 +1,24 @@
-from app.db import session_factory
+from fastapi import Request
+from fastapi.requests import HTTPConnection
 
+from app.shards import Shard, router
 
-def get_session():
-    with session_factory() as session:
+
+def request_shard(request: HTTPConnection) -> Shard:
+    """
+    The home shard of the user in the `user_id` header. Requests without a
+    valid one get the first shard, `get_current_user` turns them away.
+    """
+    try:
+        return router.shard_for(int(request.headers.get("user_id", "")))
+    except ValueError:
+        return router.shards[0]
+
+
+async def get_read_session(request: Request):
+    """
+    Session on the read engine, it never holds the writer connection. Writes
+    go through the shard's ledger writer.
+    """
+    async with request_shard(request).database.read_session_factory() as session:
         yield session
-        session.close()
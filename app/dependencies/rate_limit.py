@@ -0,0 +1,83 @@
+import math
+import os
+from typing import Awaitable, Callable
+
+from fastapi import Depends
+from fastapi import HTTPException
+from fastapi import WebSocketException
+from fastapi import status
+from fastapi.requests import HTTPConnection
+
+from app.db import DATABASE_URL, open_database, sibling_url
+from app.dependencies.get_current_user import get_current_user
+from app.ratelimit import Limiter, RateLimit, SqlBucketStore
+from app.services.pydantic_models import User
+
+# Shared by the workers through a database of its own, `db.ratelimit.sqlite`
+# by default: its syncs never queue behind the ledger's commits, nor hold
+# them up
+RATE_LIMIT_DATABASE_URL = os.environ.get(
+    "RATE_LIMIT_DATABASE_URL", sibling_url(DATABASE_URL, "ratelimit")
+)
+limiter_database = open_database(RATE_LIMIT_DATABASE_URL, "@ratelimit")
+limiter = Limiter(
+    SqlBucketStore(limiter_database.write_session_factory),
+    sync_interval=float(os.environ.get("RATE_LIMIT_SYNC_INTERVAL", 0.25)),
+)
+
+# Limits by scope, overridden with e.g. RATE_LIMIT_TRANSFERS="20/minute"
+RATE_LIMITS = {
+    scope: RateLimit.parse(os.environ.get(f"RATE_LIMIT_{scope.upper()}", default))
+    for scope, default in {
+        "transfers": "5/minute",
+        "transfer": "120/minute",
+        "export": "10/hour",
+        "transfer_writes": "60/minute",
+        "money": "30/minute",
+        "balance": "120/minute",
+        "leaderboard": "60/minute",
+        "events": "30/minute",
+    }.items()
+}
+
+
+def rate_limit(
+    scope: str,
+    authenticate: Callable[..., Awaitable[User]] | None = get_current_user,
+):
+    """
+    Dependency limiting the requests of the `scope` per user, once
+    `authenticate` has authenticated them, or per client address for the
+    routes of anonymous requests, with `authenticate=None`. WebSocket
+    connections over the limit are closed with code 1008.
+    """
+    limit = RATE_LIMITS[scope]
+
+    def check(request: HTTPConnection, key) -> None:
+        retry_after = limiter.hit(scope, key, limit)
+        if retry_after is not None and request.scope["type"] == "websocket":
+            raise WebSocketException(
+                code=status.WS_1008_POLICY_VIOLATION,
+                reason=f"Rate limit exceeded: {limit}",
+            )
+        if retry_after is not None:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"Rate limit exceeded: {limit}",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+    if authenticate is None:
+
+        async def check_address_rate_limit(request: HTTPConnection) -> None:
+            check(request, request.client.host if request.client else "")
+
+        return check_address_rate_limit
+
+    # FastAPI authenticates once per request, for this and the route
+    async def check_user_rate_limit(
+        request: HTTPConnection, user: User = Depends(authenticate)
+    ) -> None:
+        check(request, user.id)
+
+    return check_user_rate_limit
@@ -1,128 +1,411 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
 from decimal import Decimal
 
-from fastapi import FastAPI, Depends, Query, Request
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from fastapi import FastAPI, Depends, Header, Query, Request, Response, WebSocket
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import session_factory
-from app.dependencies.get_current_user import get_current_user
-from app.dependencies.get_session import get_session
+from app.dependencies.get_current_user import (
+    get_current_user,
+    get_websocket_user,
+    user_cache,
+)
+from app.dependencies.get_session import get_read_session
+from app.dependencies.rate_limit import limiter, rate_limit
+from app.metrics import CONTENT_TYPE, MetricsMiddleware, Stats, registry
 from app.models import TransferStatusEnum
-from app.models import User
-from app.scheme import custom_openapi
+from app.scheduler import scheduler
+from app.scheme import install_openapi
+from app.shards import router
 from app.services.business_logic import (
-    list_transfer_logic,
-    get_transfer,
+    get_transfer_response,
+    list_transfer_response,
     accept_transfer,
+    accept_transfers,
+    create_transfers,
     deposit_balance,
+    get_balance,
     reject_transfer,
+    reject_transfers,
     transfers_leaderboard,
+    withdraw_amount,
+)
+from app.services.events import event_dispatcher, sse_events, websocket_events
+from app.services.export import EXPORT_MEDIA_TYPES, ExportFormat, export_transfers
+from app.services.idempotency import idempotent_results
+from app.services.shard_relay import shard_relay
+from app.services.response_cache import (
+    cached_response,
+    listing_responses,
+    transfer_responses,
+)
+from app.services.pydantic_models import (
+    BalanceChangeValidator,
+    BalanceValidator,
+    LeaderboardEntryValidator,
+    TransferValidator,
+    TransferPageValidator,
+    TransferBatchValidator,
+    TransferBatchResultValidator,
+    TransferBulkCreateValidator,
+    TransferBulkCreatedValidator,
+    TransferCreateValidator,
+    TransferCreatedValidator,
+    User,
 )
-from app.services.pydantic_models import TransferValidator, TransferPageValidator
 
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI()
 
-app.openapi = custom_openapi(app)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Deliver the shard messages a previous run left undelivered
+    for shard in router.shards:
+        shard_relay.notify(shard)
+    await event_dispatcher.start()
+    scheduler.start()
+    yield
+    # Commit the writes already queued before shutting down, undelivered
+    # shard messages are delivered on the next start
+    await scheduler.close()
+    await event_dispatcher.close()
+    await shard_relay.close()
+    await router.close()
+    await limiter.close()
+
+
+# The schema and docs routes are those of `install_openapi`
+app = FastAPI(lifespan=lifespan, openapi_url=None)
+
+openapi = install_openapi(app)
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+app.add_middleware(MetricsMiddleware)
 
+registry.register(
+    Stats(
+        "cache",
+        "cache",
+        {
+            "users": user_cache.stats,
+            "transfers": transfer_responses.stats,
+            "listings": listing_responses.stats,
+            "idempotency": idempotent_results.stats,
+        },
+    )
+)
+registry.register(
+    Stats(
+        "ledger",
+        "writer",
+        {f"ledger{shard.label}": shard.ledger.stats for shard in router.shards},
+    )
+)
+registry.register(Stats("shard_relay", "relay", {"shards": shard_relay.stats}))
+registry.register(
+    Stats("events", "dispatcher", {"subscriptions": event_dispatcher.stats})
+)
+registry.register(Stats("scheduler", "scheduler", {"jobs": scheduler.stats}))
+registry.register(Stats("rate_limiter", "limiter", {"requests": limiter.stats}))
 
-@app.get("/transfers", response_model=TransferPageValidator)
-@limiter.limit("5/minute")
+
+@app.get(
+    "/transfers",
+    response_model=TransferPageValidator,
+    dependencies=[Depends(rate_limit("transfers"))],
+)
 async def list_transfers_api(
     request: Request,
-    session: session_factory = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
     current_user: User = Depends(get_current_user),
     status: TransferStatusEnum = None,
     page: int = Query(1, ge=1),  # Page number, defaults to 1
     limit: int = Query(10, ge=1),  # Limit number of items per page, defaults to 10
+    cursor: str = None,  # Opaque `next_cursor` of the previous page, overrides `page`
+    include_total: bool = True,  # Set to false to skip `total_transfers`, see `has_more`
 ):
-    result = list_transfer_logic(session, current_user, status, page=page, limit=limit)
-    return result.unwrap()
+    result = await list_transfer_response(
+        session,
+        current_user,
+        status,
+        request.headers.get("if-none-match"),
+        page=page,
+        limit=limit,
+        cursor=cursor,
+        include_total=include_total,
+    )
+    if result.is_err:
+        raise result.unwrap_err()
+    return cached_response(result.unwrap())
 
 
-@app.get("/transfers/{transfer_id}", response_model=TransferValidator)
-def get_transfer_api(
+@app.post(
+    "/transfers",
+    status_code=201,
+    response_model=TransferCreatedValidator,
+    dependencies=[Depends(rate_limit("transfer_writes"))],
+)
+async def create_transfer_api(
+    transfer: TransferCreateValidator,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: str = Header(None, max_length=255),
+):
+    """
+    Creates a pending transfer to `receiver_id`, holding its amount from the user's balance until it is accepted or rejected.
+    """
+    result = await create_transfers(
+        current_user.id, [(transfer.receiver_id, transfer.amount)], idempotency_key
+    )
+    if result.is_err:
+        raise result.unwrap_err()
+    return {"id": result.unwrap()[0]}
+
+
+@app.post(
+    "/transfers/bulk",
+    status_code=201,
+    response_model=TransferBulkCreatedValidator,
+    dependencies=[Depends(rate_limit("transfer_writes"))],
+)
+async def create_transfers_api(
+    bulk: TransferBulkCreateValidator,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: str = Header(None, max_length=255),
+):
+    """
+    Creates many pending transfers at once, all or none, holding their total from the user's balance. Returns their ids in the order given.
+    """
+    result = await create_transfers(
+        current_user.id,
+        [(transfer.receiver_id, transfer.amount) for transfer in bulk.transfers],
+        idempotency_key,
+    )
+    if result.is_err:
+        raise result.unwrap_err()
+    return {"transfer_ids": result.unwrap()}
+
+
+# Declared before `/transfers/{transfer_id}`, which would match "export" as an id
+@app.get("/transfers/export", dependencies=[Depends(rate_limit("export"))])
+async def export_transfers_api(
+    current_user: User = Depends(get_current_user),
+    format: ExportFormat = "ndjson",
+    status: TransferStatusEnum = None,
+    created_from: datetime = None,  # Inclusive
+    created_to: datetime = None,  # Exclusive
+):
+    """
+    Streams all of the user's transfers, oldest first, as NDJSON or CSV.
+    """
+    return StreamingResponse(
+        export_transfers(current_user.id, format, status, created_from, created_to),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="transfers.{format}"'},
+    )
+
+
+@app.get(
+    "/transfers/{transfer_id}",
+    response_model=TransferValidator,
+    dependencies=[Depends(rate_limit("transfer"))],
+)
+async def get_transfer_api(
+    request: Request,
     transfer_id: int,
     current_user: User = Depends(get_current_user),
-    session: session_factory = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
 ):
     """
     Retrieve a specific transfer by ID, ensuring the user is authorized (either the sender or receiver).
+    Responses carry an ETag, send it back in `If-None-Match` to get a 304 when the transfer did not change.
     """
-    transfer = get_transfer(session, transfer_id, current_user.id)
+    transfer = await get_transfer_response(
+        session, transfer_id, current_user.id, request.headers.get("if-none-match")
+    )
     if transfer.is_err:
         raise transfer.unwrap_err()
-    return transfer.unwrap()
+    return cached_response(transfer.unwrap())
+
+
+# Declared before the single-transfer routes, which would match "batch" as an id
+@app.post(
+    "/transfers/batch/accept",
+    response_model=TransferBatchResultValidator,
+    dependencies=[Depends(rate_limit("transfer_writes"))],
+)
+async def accept_transfers_api(
+    batch: TransferBatchValidator,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Accepts many pending transfers at once, with a result per transfer.
+    """
+    result = await accept_transfers(
+        list(dict.fromkeys(batch.transfer_ids)), current_user.id
+    )
+    if result.is_err:
+        raise result.unwrap_err()
+    return result.unwrap()
+
+
+@app.post(
+    "/transfers/batch/reject",
+    response_model=TransferBatchResultValidator,
+    dependencies=[Depends(rate_limit("transfer_writes"))],
+)
+async def reject_transfers_api(
+    batch: TransferBatchValidator,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Rejects many pending transfers at once, with a result per transfer.
+    """
+    result = await reject_transfers(
+        list(dict.fromkeys(batch.transfer_ids)), current_user.id
+    )
+    if result.is_err:
+        raise result.unwrap_err()
+    return result.unwrap()
 
 
-@app.post("/transfers/{transfer_id}/accept")
-def accept_transfer_api(
+@app.post(
+    "/transfers/{transfer_id}/accept",
+    dependencies=[Depends(rate_limit("transfer_writes"))],
+)
+async def accept_transfer_api(
     transfer_id: int,
     current_user: User = Depends(get_current_user),
-    session: session_factory = Depends(get_session),
+    idempotency_key: str = Header(None, max_length=255),
 ):
     """
     Allows the receiver to accept a transfer, moving funds from the sender’s balance to the receiver’s balance minus a 2% fee.
     """
-    result = accept_transfer(session, transfer_id, current_user.id)
+    result = await accept_transfer(transfer_id, current_user.id, idempotency_key)
     if result.is_err:
         raise result.unwrap_err()
     return result.unwrap()
 
 
-@app.post("/transfers/{transfer_id}/reject")
-def reject_transfer_api(
+@app.post(
+    "/transfers/{transfer_id}/reject",
+    dependencies=[Depends(rate_limit("transfer_writes"))],
+)
+async def reject_transfer_api(
     transfer_id: int,
     current_user: User = Depends(get_current_user),
-    session: session_factory = Depends(get_session),
 ):
     """
     Rejects the transfer, returning the amount to the sender’s balance.
     """
-    result = reject_transfer(session, transfer_id, current_user.id)
+    result = await reject_transfer(transfer_id, current_user.id)
     if result.is_err:
         raise result.unwrap_err()
     return result.unwrap()
 
 
-@app.post("/deposit")
-def deposit_api(
-    amount: Decimal,
+@app.post(
+    "/deposit",
+    response_model=BalanceChangeValidator,
+    dependencies=[Depends(rate_limit("money"))],
+)
+async def deposit_api(
+    amount: Decimal = Query(gt=0, decimal_places=2),
     current_user: User = Depends(get_current_user),
-    session: session_factory = Depends(get_session),
+    idempotency_key: str = Header(None, max_length=255),
 ):
     """Deposits money into the user's balance."""
-    result = deposit_balance(session, current_user.id, amount)
+    result = await deposit_balance(current_user.id, amount, idempotency_key)
     if result.is_err:
         raise result.unwrap_err()
     return result.unwrap()
 
 
-@app.post("/withdraw")
-def withdraw_api(
-    amount: Decimal,
+@app.post(
+    "/withdraw",
+    response_model=BalanceChangeValidator,
+    dependencies=[Depends(rate_limit("money"))],
+)
+async def withdraw_api(
+    amount: Decimal = Query(gt=0, decimal_places=2),
     current_user: User = Depends(get_current_user),
-    session: session_factory = Depends(get_session),
+    idempotency_key: str = Header(None, max_length=255),
 ):
     """Withdraws money from the user’s balance, ensuring they have enough funds."""
-    result = deposit_balance(session, current_user.id, amount)
+    result = await withdraw_amount(current_user.id, amount, idempotency_key)
     if result.is_err:
         raise result.unwrap_err()
     return result.unwrap()
 
 
-@app.get("/leaderboard/top-transfers")
-def get_top_transfers_api(
-    limit: int = 10, by: str = "count", session: session_factory = Depends(get_session)
+@app.get(
+    "/balance",
+    response_model=BalanceValidator,
+    dependencies=[Depends(rate_limit("balance"))],
+)
+async def balance_api(
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_read_session),
+):
+    """Returns the user's balance as recorded by the ledger."""
+    result = await get_balance(session, current_user.id)
+    if result.is_err:
+        raise result.unwrap_err()
+    return result.unwrap()
+
+
+@app.get(
+    "/leaderboard/top-transfers",
+    response_model=list[LeaderboardEntryValidator],
+    # Only the column ranked by
+    response_model_exclude_unset=True,
+    dependencies=[Depends(rate_limit("leaderboard", authenticate=None))],
+)
+async def get_top_transfers_api(
+    limit: int = Query(10, ge=1, le=100),
+    by: str = "count",
 ):
     """
     Returns the top users who have sent or received the most transfers.
     Allows filtering by the number of transfers or total transferred amount.
     """
-    results = transfers_leaderboard(session, by)
+    results = await transfers_leaderboard(by, limit)
     if results.is_err:
         raise results.unwrap_err()
     return results.unwrap()
+
+
+@app.get("/events", dependencies=[Depends(rate_limit("events"))])
+async def events_api(
+    current_user: User = Depends(get_current_user),
+    last_event_id: int = Header(None),
+):
+    """
+    Server-sent events about the user's transfers and balance, to use instead
+    of polling: a `transfer` event when they receive a transfer and when one
+    they sent or received is accepted or rejected, and a `balance` event on
+    deposits and withdrawals. Reconnect with `Last-Event-ID` to get the events missed in
+    between, for `EVENT_RETENTION` seconds.
+    """
+    return StreamingResponse(
+        sse_events(current_user.id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.websocket(
+    "/events/ws",
+    dependencies=[Depends(rate_limit("events", authenticate=get_websocket_user))],
+)
+async def events_websocket_api(
+    websocket: WebSocket,
+    current_user: User = Depends(get_websocket_user),
+    last_event_id: int = None,
+):
+    """The events of `GET /events` as JSON messages."""
+    await websocket.accept()
+    await websocket_events(websocket, current_user.id, last_event_id)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_api():
+    """Request, SQL, pool, cache and writer metrics in Prometheus text format."""
+    return Response(registry.render(), media_type=CONTENT_TYPE)
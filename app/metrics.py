@@ -0,0 +1,354 @@
+import logging
+import os
+import re
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Sequence
+
+from sqlalchemy import Engine
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("app.sql.slow")
+
+# Statements slower than this are logged with their normalized text, 0 is off
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 0))
+# The same statement run this many times in a request is reported as N+1
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 10))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 10, 100, 1000, 10_000, 100_000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per label values: counts per bucket (not cumulative), sum, count
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels) -> int:
+        series = self._values.get(labels)
+        return series[2] if series else 0
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(self.labelnames, labels, f'le="{_number(bound)}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            le = _labels(self.labelnames, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{le} {count}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {total!r}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {count}"
+
+
+class Stats:
+    """
+    Metrics read at scrape time from `stats()` methods returning flat dicts,
+    e.g. a cache's hits and size: one `<prefix>_<key>` series per key, with
+    a `label` set to each source's name.
+    """
+
+    def __init__(self, prefix: str, label: str, sources: dict[str, Callable]):
+        self.prefix = prefix
+        self.label = label
+        self.sources = sources
+
+    def render(self) -> Iterable[str]:
+        series: dict[str, list[str]] = {}
+        for source, stats in self.sources.items():
+            for key, value in stats().items():
+                series.setdefault(key, []).append(
+                    f'{self.prefix}_{key}{{{self.label}="{_escape(source)}"}} '
+                    f"{_number(value)}"
+                )
+        for key, lines in series.items():
+            yield f"# TYPE {self.prefix}_{key} untyped"
+            yield from lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(
+            f"{line}\n" for metric in self.metrics for line in metric.render()
+        )
+
+
+registry = Registry()
+
+http_request_duration = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time to send the whole response, streamed bodies included.",
+        ["method", "route"],
+    )
+)
+http_responses = registry.register(
+    Counter("http_responses_total", "Responses sent.", ["method", "route", "status"])
+)
+http_request_statements = registry.register(
+    Histogram(
+        "http_request_db_statements",
+        "SQL statements run on behalf of a request.",
+        ["route"],
+        COUNT_BUCKETS,
+    )
+)
+db_statement_duration = registry.register(
+    Histogram(
+        "db_statement_duration_seconds",
+        "SQL statement execution time, fetching excluded.",
+        ["engine", "operation"],
+        SQL_BUCKETS,
+    )
+)
+db_pool_wait = registry.register(
+    Histogram(
+        "db_pool_wait_seconds",
+        "Time spent waiting for a pooled connection.",
+        ["engine"],
+        SQL_BUCKETS,
+    )
+)
+db_n_plus_one = registry.register(
+    Counter(
+        "db_n_plus_one_total",
+        f"Requests running a statement more than {N_PLUS_ONE_THRESHOLD} times.",
+        ["route"],
+    )
+)
+db_slow_statements = registry.register(
+    Counter(
+        "db_slow_statements_total",
+        f"Statements slower than SLOW_QUERY_MS ({SLOW_QUERY_MS:g}).",
+        ["engine"],
+    )
+)
+
+scheduler_job_rows = registry.register(
+    Histogram(
+        "scheduler_job_rows",
+        "Rows processed by a scheduled job per tick.",
+        ["job"],
+        ROW_BUCKETS,
+    )
+)
+scheduler_job_duration = registry.register(
+    Histogram("scheduler_job_duration_seconds", "Time to run a scheduled job.", ["job"])
+)
+scheduler_job_failures = registry.register(
+    Counter("scheduler_job_failures_total", "Scheduled job runs failed.", ["job"])
+)
+
+
+@dataclass
+class RequestStats:
+    statements: int = 0
+    # Executions by normalized statement, to spot N+1 query patterns
+    repeats: dict[str, int] = field(default_factory=dict)
+
+
+# Stats of the request being served, None outside of requests (e.g. in the
+# ledger writer, which is shared by all requests)
+request_stats: ContextVar[RequestStats | None] = ContextVar(
+    "request_stats", default=None
+)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_statement(statement: str) -> str:
+    """
+    The statement with literals replaced by `?` and parameter lists folded,
+    so that the executions of a query share a single text.
+    """
+    statement = _LITERALS.sub("?", statement)
+    statement = _PARAMETER_LISTS.sub("(?, ...)", statement)
+    return _SPACES.sub(" ", statement).strip()
+
+
+def instrument_engine(engine: Engine, name: str) -> None:
+    """
+    Record the statement durations and pool waits of `engine`, the sync
+    engine of async ones, as the `engine` label `name`.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["statement_started_at"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper()
+        db_statement_duration.observe(elapsed, name, operation)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            db_slow_statements.inc(name)
+            slow_query_logger.warning(
+                "%.1f ms on %s: %s",
+                elapsed * 1000,
+                name,
+                normalize_statement(statement),
+            )
+        if (stats := request_stats.get()) is not None:
+            stats.statements += 1
+            stats.repeats[statement] = stats.repeats.get(statement, 0) + 1
+
+    @event.listens_for(engine, "handle_error")
+    def discard_timer(exception_context):
+        if started := exception_context.connection.info.get("statement_started_at"):
+            started.pop()
+
+    # Pools have no event before waiting for a connection, time their getter
+    pool = engine.pool
+    do_get = pool._do_get
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started, name)
+
+    pool._do_get = timed_do_get
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing requests by route template, e.g.
+    `/transfers/{transfer_id}`, and counting the SQL they run.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            request_stats.reset(token)
+            self._record(scope, status, elapsed, stats)
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"  # not the path, which is unbounded
+        if endpoint not in self._routes:
+            self._routes = {
+                route.endpoint: route.path
+                for route in scope["app"].routes
+                if hasattr(route, "endpoint")
+            }
+        return self._routes.get(endpoint, "unmatched")
+
+    def _record(self, scope, status: int, elapsed: float, stats: RequestStats):
+        route = self._route(scope)
+        method = scope["method"]
+        http_request_duration.observe(elapsed, method, route)
+        http_responses.inc(method, route, status)
+        http_request_statements.observe(stats.statements, route)
+        repeated = [
+            statement
+            for statement, count in stats.repeats.items()
+            if count > N_PLUS_ONE_THRESHOLD
+        ]
+        if repeated:
+            db_n_plus_one.inc(route)
+            for statement in repeated:
+                logger.warning(
+                    "%s %s ran %d times: %s",
+                    method,
+                    route,
+                    stats.repeats[statement],
+                    normalize_statement(statement),
+                )
@@ -1,16 +1,22 @@
 import enum
 from datetime import datetime, timezone
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 
+from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import Computed
 from sqlalchemy import DateTime
 from sqlalchemy import Enum
+from sqlalchemy import Float
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import JSON
 from sqlalchemy import String
+from sqlalchemy import TypeDecorator
+from sqlalchemy import false
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import relationship
-from sqlalchemy.dialects import sqlite
 from app.db import metadata
 
 
@@ -18,16 +24,40 @@ class Base(DeclarativeBase):
     metadata = metadata
 
 
+class Money(TypeDecorator):
+    """
+    Amount of money stored as an exact integer number of minor units (cents)
+    and exposed as a `Decimal` with 2 decimal places, so that sums and fees
+    are computed with integer arithmetic and never go through float.
+    """
+
+    impl = Integer
+    cache_ok = True
+
+    SCALE = 2
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        value = Decimal(str(value)) if isinstance(value, float) else Decimal(value)
+        return int(value.scaleb(self.SCALE).quantize(Decimal(1), ROUND_HALF_UP))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-self.SCALE)
+
+    def coerce_compared_value(self, op, value):
+        # Amounts added to or compared with a money column are money as well
+        return self
+
+
 class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
     username = Column(String, unique=True, nullable=False)
-    balance = Column(
-        sqlite.REAL(precision=18, decimal_return_scale=2),
-        nullable=False,
-        default=Decimal(0),
-    )
+    balance = Column(Money, nullable=False, default=Decimal(0))
 
     def __repr__(self) -> str:
         return f"<User(id={self.id}, username={self.username}, balance={self.balance})>"
@@ -37,32 +67,273 @@ class TransferStatusEnum(enum.Enum):
     PENDING = "pending"
     COMPLETED = "completed"
     REJECTED = "rejected"
+    EXPIRED = "expired"  # still pending after `PENDING_TRANSFER_TTL`
 
 
 class Transfer(Base):
     __tablename__ = "transfers"
+    __table_args__ = (
+        # Serve the per-side halves of "sender_id = ? OR receiver_id = ?"
+        # listings and counts, with or without a status filter, in
+        # (created_at, id) keyset order
+        Index(
+            "ix_transfers_sender_status_created",
+            "sender_id",
+            "status",
+            "created_at",
+            "id",
+        ),
+        Index(
+            "ix_transfers_receiver_status_created",
+            "receiver_id",
+            "status",
+            "created_at",
+            "id",
+        ),
+        Index("ix_transfers_sender_created", "sender_id", "created_at", "id"),
+        Index("ix_transfers_receiver_created", "receiver_id", "created_at", "id"),
+        # The oldest pending transfers, for their expiry
+        Index("ix_transfers_status_created", "status", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(
+        DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)
+    )
     updated_at = Column(
         DateTime,
         nullable=False,
-        default=datetime.now(timezone.utc),
+        default=lambda: datetime.now(timezone.utc),
         onupdate=lambda: datetime.now(timezone.utc),
     )
-    amount = Column(
-        sqlite.REAL(precision=18, decimal_return_scale=2),
-        nullable=False,
-        default=Decimal(0),
-    )
+    amount = Column(Money, nullable=False, default=Decimal(0))
     status = Column(
         Enum(TransferStatusEnum), nullable=False, default=TransferStatusEnum.PENDING
     )
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # The amount was taken from the sender's balance when the transfer was
+    # created, and is held until it is accepted or rejected
+    held = Column(Boolean, nullable=False, default=False, server_default=false())
+    # The sender lives on another shard, which holds the amount: this row is
+    # the receiver's shard copy of the transfer, see `app.shards`
+    remote_hold = Column(Boolean, nullable=False, default=False, server_default=false())
 
     sender = relationship("User", foreign_keys="Transfer.sender_id")
     receiver = relationship("User", foreign_keys="Transfer.receiver_id")
 
     def __repr__(self) -> str:
         return f"<Transfer(id={self.id}, sender={self.sender}, receiver={self.receiver}, amount={self.amount}, status:{self.status}, created_at: {self.created_at}>"
+
+
+class UserTransferCount(Base):
+    """
+    Number of transfers a user sent or received, per status. Kept up to date
+    in the same transaction as every transfer insert or status change, so that
+    paged listings do not need a COUNT(*) over the user's transfers.
+    """
+
+    __tablename__ = "user_transfer_counts"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    status = Column(Enum(TransferStatusEnum), primary_key=True)
+    transfer_count = Column(Integer, nullable=False, default=0)
+
+
+class UserTransferStats(Base):
+    """
+    Completed transfers a user sent and received, kept up to date when a
+    transfer is accepted, so that the leaderboard reads a top-N off an index
+    instead of aggregating every transfer. A self-transfer only counts as sent.
+    """
+
+    __tablename__ = "user_transfer_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    sent_count = Column(Integer, nullable=False, default=0, server_default="0")
+    sent_amount = Column(Money, nullable=False, default=Decimal(0), server_default="0")
+    received_count = Column(Integer, nullable=False, default=0, server_default="0")
+    received_amount = Column(
+        Money, nullable=False, default=Decimal(0), server_default="0"
+    )
+    transfer_count = Column(Integer, Computed("sent_count + received_count"))
+    total_amount = Column(Money, Computed("sent_amount + received_amount"))
+
+    __table_args__ = (
+        Index("ix_user_transfer_stats_transfer_count", "transfer_count"),
+        Index("ix_user_transfer_stats_total_amount", "total_amount"),
+    )
+
+
+class UserTransferVersion(Base):
+    """
+    Moved forward whenever a transfer the user sent or received changes, so
+    that the user's listings can be revalidated (ETag) and cached without
+    reading them. Versions are timestamps in microseconds, they keep going up
+    when the table is rebuilt.
+    """
+
+    __tablename__ = "user_transfer_versions"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+class LedgerAccountEnum(enum.Enum):
+    USER = "user"  # a user's balance, `user_id` is set
+    EXTERNAL = "external"  # money deposited from or withdrawn to the outside
+    FEES = "fees"  # transfer fees collected
+    HOLDS = "holds"  # amounts of pending transfers, held since their creation
+    # money moving between shards, sums to zero across them
+    CLEARING = "clearing"
+
+
+class LedgerEntryKindEnum(enum.Enum):
+    OPENING = "opening"  # balance a user had before the ledger existed
+    DEPOSIT = "deposit"
+    WITHDRAWAL = "withdrawal"
+    TRANSFER = "transfer"
+    FEE = "fee"
+    HOLD = "hold"  # a pending transfer's amount, from its sender to the holds
+    RELEASE = "release"  # a rejected transfer's hold, back to its sender
+    MOVE = "move"  # a balance or hold moved to another shard by a rebalance
+
+
+class LedgerEntry(Base):
+    """
+    Append-only double-entry journal of every balance movement: the entries
+    of a movement have the same `kind` (and `transfer_id` for transfers) and
+    sum to zero. Rows are never updated nor deleted, a user's balance is the
+    sum of their entries, see `BalanceSnapshot`.
+    """
+
+    __tablename__ = "ledger_entries"
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(
+        DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)
+    )
+    account = Column(Enum(LedgerAccountEnum), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    kind = Column(Enum(LedgerEntryKindEnum), nullable=False)
+    transfer_id = Column(Integer, ForeignKey("transfers.id"))
+    amount = Column(Money, nullable=False)  # credit if positive, debit if negative
+
+    __table_args__ = (
+        # Entries of a user after their snapshot, in journal order
+        Index("ix_ledger_entries_user_id", "user_id", "id"),
+    )
+
+
+class BalanceSnapshot(Base):
+    """
+    A user's balance as of the ledger entry `entry_id`, checkpointed
+    periodically: the current balance is the snapshot plus the user's
+    entries after `entry_id`.
+    """
+
+    __tablename__ = "balance_snapshots"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    balance = Column(Money, nullable=False)
+    entry_id = Column(Integer, nullable=False)
+    created_at = Column(
+        DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)
+    )
+
+    __table_args__ = (
+        # The newest snapshot's entry, where the next checkpoint starts
+        Index("ix_balance_snapshots_entry_id", "entry_id"),
+    )
+
+
+class RateLimitBucket(Base):
+    """
+    Token bucket shared by the workers' rate limiters, see `app.ratelimit`.
+    Times are UNIX timestamps, `tokens` goes negative when workers together
+    allowed more than the bucket had.
+    """
+
+    __tablename__ = "rate_limit_buckets"
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    capacity = Column(Integer, nullable=False)
+    rate = Column(Float, nullable=False)  # tokens per second
+    updated_at = Column(Float, nullable=False)
+
+
+class SchedulerLease(Base):
+    """
+    Lease on running the scheduled jobs, held by one worker at a time until
+    `expires_at`, a UNIX timestamp, and renewed by that worker, see
+    `app.scheduler`.
+    """
+
+    __tablename__ = "scheduler_leases"
+
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False)
+
+
+class ShardMessage(Base):
+    """
+    Outbox of changes to apply on another shard, e.g. the copies of new
+    transfers for their receivers' shard. Written in the transaction making
+    the change, delivered in order and deleted by `app.services.shard_relay`.
+    """
+
+    __tablename__ = "shard_messages"
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(
+        DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)
+    )
+    shard = Column(Integer, nullable=False)  # the target shard's index
+    kind = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+
+    # Ids are never reused once delivered messages are deleted, the targets
+    # skip the ids they already applied
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class ShardInbox(Base):
+    """
+    Last message applied from each other shard. Messages are delivered in
+    order, so that redeliveries after a failure are recognized and skipped.
+    """
+
+    __tablename__ = "shard_inbox"
+
+    source = Column(Integer, primary_key=True)
+    message_id = Column(Integer, nullable=False)
+
+
+class UserEvent(Base):
+    """
+    Outbox of the changes users are pushed by `GET /events`, e.g. the
+    transfers they received being accepted, written in the transaction making
+    the change on the user's home shard. Every worker's
+    `app.services.events` dispatcher reads them and fans them out to its
+    subscribers, they are kept for a while for reconnecting clients.
+    """
+
+    __tablename__ = "user_events"
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(
+        DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)
+    )
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    kind = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+
+    __table_args__ = (
+        # A user's events after the last one their client got
+        Index("ix_user_events_user_id_id", "user_id", "id"),
+        # Ids are never reused once old events are deleted, clients resume
+        # after the last id they got
+        {"sqlite_autoincrement": True},
+    )
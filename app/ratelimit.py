@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Hashable, Protocol, Sequence
+
+from sqlalchemy import Delete
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import RateLimitBucket
+from app.tasks import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """`amount` requests per `period` seconds, with bursts of up to `amount`."""
+
+    amount: int
+    period: float
+
+    @property
+    def rate(self) -> float:
+        return self.amount / self.period
+
+    @classmethod
+    def parse(cls, limit: str) -> "RateLimit":
+        """Parse slowapi style limits, such as "5/minute" or "100 per hour"."""
+        match = re.fullmatch(r"\s*(\d+)\s*(?:/|per)\s*(\w+?)s?\s*", limit)
+        if match is None or match.group(2) not in PERIODS:
+            raise ValueError(f"Invalid rate limit: {limit!r}")
+        return cls(int(match.group(1)), PERIODS[match.group(2)])
+
+    def __str__(self) -> str:
+        return f"{self.amount} per {self.period:g} seconds"
+
+
+class BucketStore(Protocol):
+    async def exchange(
+        self, updates: Sequence[tuple[str, RateLimit, int, float]]
+    ) -> dict[str, float]:
+        """
+        Refill the shared buckets up to the given times, take the given
+        numbers of tokens from them, as `(key, limit, consumed, now)`, and
+        return their new levels by key.
+        """
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated_at", "consumed", "limit")
+
+    def __init__(self, limit: RateLimit, now: float):
+        self.limit = limit
+        self.tokens = float(limit.amount)
+        self.updated_at = now
+        self.consumed = 0  # taken locally since the last sync
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(
+                self.limit.amount, self.tokens + elapsed * self.limit.rate
+            )
+            self.updated_at = now
+
+
+class Limiter:
+    """
+    Token buckets kept in process and reconciled with a shared `store` in
+    the background, every `sync_interval` seconds, in one call for all the
+    buckets used since the previous sync. A request only costs a dict lookup
+    and some arithmetic; workers can overshoot a limit by what they allow
+    between two syncs, the debt is then paid before new requests are let in.
+
+    Without a store the limits are per process.
+    """
+
+    def __init__(self, store: BucketStore | None = None, sync_interval: float = 0.25):
+        self.store = store
+        self.sync_interval = sync_interval
+        self.enabled = True
+        self.syncs = 0
+        self._buckets: dict[tuple[str, Hashable], _Bucket] = {}
+        self._dirty: set[tuple[str, Hashable]] = set()
+        self._task = BackgroundTask(self._sync_periodically)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "buckets": len(self._buckets),
+            "dirty": len(self._dirty),
+            "syncs": self.syncs,
+        }
+
+    def hit(self, scope: str, key: Hashable, limit: RateLimit) -> float | None:
+        """
+        Take a token from the `(scope, key)` bucket. Returns None when the
+        request is allowed, or the number of seconds until it would be.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        bucket = self._buckets.get((scope, key))
+        if bucket is None or bucket.limit != limit:
+            bucket = self._buckets[(scope, key)] = _Bucket(limit, now)
+        bucket.refill(now)
+        if bucket.tokens < 1:
+            return (1 - bucket.tokens) / limit.rate
+        bucket.tokens -= 1
+        bucket.consumed += 1
+        if self.store is not None:
+            self._dirty.add((scope, key))
+            self._task.ensure_running()
+        return None
+
+    async def sync(self) -> None:
+        """Push the tokens taken since the last sync and pull the levels."""
+        dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        sent = {}
+        for bucket_key in dirty:
+            bucket = self._buckets[bucket_key]
+            sent[bucket_key] = bucket.consumed
+            bucket.consumed = 0
+        try:
+            levels = await self.store.exchange(
+                [
+                    (
+                        self._store_key(bucket_key),
+                        self._buckets[bucket_key].limit,
+                        n,
+                        now,
+                    )
+                    for bucket_key, n in sent.items()
+                ]
+            )
+        except Exception:
+            # Push these tokens again with the next sync
+            for bucket_key, n in sent.items():
+                self._buckets[bucket_key].consumed += n
+            self._dirty |= dirty
+            raise
+        self.syncs += 1
+
+        for bucket_key in dirty:
+            bucket = self._buckets[bucket_key]
+            level = levels.get(self._store_key(bucket_key))
+            if level is not None:
+                # Tokens taken during the exchange are not in the shared level
+                bucket.tokens, bucket.updated_at = level - bucket.consumed, now
+        self._forget_full_buckets()
+
+    async def close(self) -> None:
+        self._task.cancel()
+        if self._dirty:
+            await self.sync()
+
+    def _forget_full_buckets(self) -> None:
+        now = time.time()
+        for bucket_key, bucket in list(self._buckets.items()):
+            if bucket_key in self._dirty or bucket.consumed:
+                continue
+            bucket.refill(now)
+            if bucket.tokens >= bucket.limit.amount:
+                del self._buckets[bucket_key]
+
+    @staticmethod
+    def _store_key(bucket_key: tuple[str, Hashable]) -> str:
+        return f"{bucket_key[0]}:{bucket_key[1]}"
+
+    async def _sync_periodically(self) -> None:
+        while self._dirty:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Rate limiter sync failed")
+
+
+class SqlBucketStore:
+    """
+    `BucketStore` on the `rate_limit_buckets` table, shared by workers,
+    created on the first exchange: the store may have a database of its own,
+    out of the migrations' reach. The rows of buckets refilled to capacity,
+    idle since, are deleted on the first exchange every `prune_interval`
+    seconds: a missing row stands for a full bucket.
+    """
+
+    def __init__(self, session_factory, prune_interval: float = 60):
+        self.session_factory = session_factory
+        self.prune_interval = prune_interval
+        self.pruned = 0
+        self._pruned_at = 0.0
+        self._created = False
+
+    async def exchange(
+        self, updates: Sequence[tuple[str, RateLimit, int, float]]
+    ) -> dict[str, float]:
+        if not updates:
+            return {}
+        stmt = sqlite_insert(RateLimitBucket).values(
+            [
+                {
+                    "key": key,
+                    "tokens": limit.amount - consumed,
+                    "capacity": limit.amount,
+                    "rate": limit.rate,
+                    "updated_at": now,
+                }
+                # In key order, so that concurrent upserts take rows in order
+                for key, limit, consumed, now in sorted(updates, key=lambda u: u[0])
+            ]
+        )
+        new = stmt.excluded
+        refilled = func.min(
+            new.capacity,
+            RateLimitBucket.tokens
+            + func.max(new.updated_at - RateLimitBucket.updated_at, 0) * new.rate,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[RateLimitBucket.key],
+            set_={
+                # `excluded.tokens` is the capacity minus the tokens taken
+                "tokens": refilled - (new.capacity - new.tokens),
+                "capacity": new.capacity,
+                "rate": new.rate,
+                "updated_at": func.max(new.updated_at, RateLimitBucket.updated_at),
+            },
+        ).returning(RateLimitBucket.key, RateLimitBucket.tokens)
+        now = max(update[3] for update in updates)
+        async with self.session_factory() as session:
+            if not self._created:
+                connection = await session.connection()
+                await connection.run_sync(
+                    RateLimitBucket.__table__.create, checkfirst=True
+                )
+                self._created = True
+            levels = dict((await session.execute(stmt)).all())
+            if now - self._pruned_at >= self.prune_interval:
+                self._pruned_at = now
+                pruned = await session.execute(self._prune(now))
+                self.pruned += pruned.rowcount
+            await session.commit()
+        return levels
+
+    @staticmethod
+    def _prune(now: float) -> Delete:
+        refilled = (
+            RateLimitBucket.tokens
+            + (now - RateLimitBucket.updated_at) * RateLimitBucket.rate
+        )
+        return delete(RateLimitBucket).where(refilled >= RateLimitBucket.capacity)
@@ -0,0 +1,185 @@
+import argparse
+import json
+from collections import defaultdict
+
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.db import DATABASE_URL, open_database
+from app.models import (
+    Base,
+    LedgerAccountEnum,
+    ShardMessage,
+    Transfer,
+    TransferStatusEnum,
+    User,
+    UserTransferStats,
+)
+from app.rebuild_aggregates import rebuild_aggregates
+from app.services.entries import move_entries
+from app.shards import (
+    SHARD_BUCKETS,
+    rebalanced_buckets,
+    router,
+    shard_map_path,
+    shard_url,
+)
+
+
+def _in_buckets(column, buckets):
+    return (column % SHARD_BUCKETS).in_(sorted(buckets))
+
+
+def rebalance(count: int, log=None):
+    """
+    Spread the users evenly over `count` shards, moving as few buckets of
+    users as possible, and write the new bucket map. For each moved user, on
+    the shard they leave and the one they reach:
+
+    - their balance moves, with `MOVE` ledger entries through the clearing
+      account, and the holds of their pending transfers with it;
+    - their transfers are copied, marked `remote_hold` where the sender does
+      not live;
+    - and every shard's aggregates are rebuilt, leaderboard aggregates only
+      for the users living there.
+
+    Every shard gets a row for every user. Copies of transfers neither of
+    whose parties lives on a shard anymore are left behind, unused. Pending
+    transfers from before holds cannot be accepted once their parties live
+    on different shards.
+
+    Run it with the API stopped: it needs empty outboxes and does not lock
+    the shards. The shards are committed one after the other, back them up
+    first.
+    """
+    log = log or (lambda message: None)
+    old_buckets = router.buckets
+    new_buckets = rebalanced_buckets(old_buckets, count)
+    databases = [shard.database for shard in router.shards]
+    databases += [
+        open_database(shard_url(DATABASE_URL, index), f"@{index}")
+        for index in range(len(databases), count)
+    ]
+    for database in databases:
+        Base.metadata.create_all(database.engine)
+    users = {}
+    for database in databases:
+        with database.session_factory() as session:
+            if session.scalar(select(func.count(ShardMessage.id))):
+                raise RuntimeError(
+                    "Shard messages are undelivered, start the API first"
+                )
+            users.update(session.execute(select(User.id, User.username)).all())
+
+    # Every user on every shard, with no balance where they do not live. The
+    # sessions start with a write: a read transaction could not be upgraded
+    # once another connection wrote.
+    sessions = [database.session_factory() for database in databases]
+    rows = [{"id": user_id, "username": name} for user_id, name in users.items()]
+    for session in sessions:
+        session.execute(sqlite_insert(User).on_conflict_do_nothing(), rows)
+    log(f"{len(users)} users on every shard")
+
+    moves = defaultdict(set)
+    for bucket, (old, new) in enumerate(zip(old_buckets, new_buckets)):
+        if old != new:
+            moves[(old, new)].add(bucket)
+    for (old, new), buckets in sorted(moves.items()):
+        _move(sessions[old], sessions[new], buckets)
+        log(f"{len(buckets)} buckets moved from shard {old} to shard {new}")
+
+    for index, session in enumerate(sessions):
+        _mark_remote_holds(session, index, new_buckets)
+        rebuild_aggregates(session)
+        away = {bucket for bucket, home in enumerate(new_buckets) if home != index}
+        session.execute(
+            delete(UserTransferStats).where(
+                _in_buckets(UserTransferStats.user_id, away)
+            )
+        )
+        session.commit()
+        log(f"shard {index} aggregates rebuilt")
+
+    # New transfers get ids above every shard's, whatever their stride
+    first_id = 1 + max(
+        session.scalar(select(func.max(Transfer.id))) or 0 for session in sessions
+    )
+    shard_map_path().write_text(
+        json.dumps({"buckets": new_buckets, "first_id": first_id})
+    )
+    for session in sessions:
+        session.close()
+
+
+def _move(source, target, buckets):
+    moved = _in_buckets(User.id, buckets)
+    balances = source.execute(
+        select(User.id, User.balance).where(moved, User.balance != 0)
+    ).all()
+    if balances:
+        target.execute(
+            update(User),
+            [{"id": user_id, "balance": balance} for user_id, balance in balances],
+        )
+        source.execute(update(User).where(moved).values(balance=0))
+        for user_id, balance in balances:
+            source.execute(move_entries(LedgerAccountEnum.USER, user_id, -balance))
+            target.execute(move_entries(LedgerAccountEnum.USER, user_id, balance))
+
+    held = source.scalar(
+        select(func.sum(Transfer.amount)).where(
+            _in_buckets(Transfer.sender_id, buckets),
+            Transfer.status == TransferStatusEnum.PENDING,
+            Transfer.held,
+            ~Transfer.remote_hold,
+        )
+    )
+    if held:
+        source.execute(move_entries(LedgerAccountEnum.HOLDS, None, -held))
+        target.execute(move_entries(LedgerAccountEnum.HOLDS, None, held))
+
+    transfers = source.execute(
+        select(Transfer.__table__).where(
+            _in_buckets(Transfer.sender_id, buckets)
+            | _in_buckets(Transfer.receiver_id, buckets)
+        )
+    ).all()
+    if transfers:
+        stmt = sqlite_insert(Transfer.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Transfer.id],
+            set_={
+                "status": stmt.excluded.status,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        target.execute(stmt, [row._asdict() for row in transfers])
+
+
+def _mark_remote_holds(session, index, buckets):
+    # Pending held transfers whose sender lives elsewhere hold nothing here
+    home = {bucket for bucket, shard in enumerate(buckets) if shard == index}
+    pending = (Transfer.status == TransferStatusEnum.PENDING) & Transfer.held
+    session.execute(
+        update(Transfer)
+        .where(pending)
+        .values(remote_hold=~_in_buckets(Transfer.sender_id, home))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Spread the users over a number of shards, see "
+        "`app.shards`. Stop the API and back the databases up first."
+    )
+    parser.add_argument("shards", type=int)
+    args = parser.parse_args()
+    rebalance(args.shards, log=print)
+
+
+if __name__ == "__main__":
+    main()
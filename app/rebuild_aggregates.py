@@ -0,0 +1,30 @@
+from app.db import session_factory
+from app.services.counters import (
+    rebuild_transfer_counts,
+    rebuild_transfer_stats,
+    rebuild_transfer_versions,
+)
+from app.services.entries import rebuild_balance_snapshots
+
+
+def rebuild_aggregates(session=None):
+    """
+    Recompute the per-user transfer counters and leaderboard aggregates from
+    the transfers table, and the balance snapshots from the ledger, e.g. after
+    a backfill or a bulk import. Listing versions are moved forward, cached
+    listings are stale.
+    """
+    session = session_factory() if session is None else session
+
+    for stmt in [
+        *rebuild_transfer_counts(),
+        *rebuild_transfer_stats(),
+        rebuild_transfer_versions(),
+        *rebuild_balance_snapshots(),
+    ]:
+        session.execute(stmt)
+    session.commit()
+
+
+if __name__ == "__main__":
+    rebuild_aggregates()
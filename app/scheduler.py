@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.db import write_session_factory
+from app.metrics import (
+    scheduler_job_duration,
+    scheduler_job_failures,
+    scheduler_job_rows,
+)
+from app.models import SchedulerLease
+from app.tasks import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+# A job returns the number of rows it processed
+Job = Callable[[], Awaitable[int]]
+
+
+class LeaderLease:
+    """
+    Named lease on the `scheduler_leases` table, shared by workers: a worker
+    holds it until it expires, `ttl` seconds after it last acquired it, and
+    the first worker to acquire it after that takes it over.
+    """
+
+    def __init__(self, session_factory, name: str, ttl: float):
+        self.session_factory = session_factory
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = False
+
+    async def acquire(self) -> bool:
+        """Take or renew the lease, return whether this worker holds it."""
+        now = time.time()
+        stmt = sqlite_insert(SchedulerLease).values(
+            name=self.name, owner=self.owner, expires_at=now + self.ttl
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SchedulerLease.name],
+            set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at},
+            where=(SchedulerLease.owner == self.owner)
+            | (SchedulerLease.expires_at < now),
+        ).returning(SchedulerLease.owner)
+        async with self.session_factory() as session:
+            self.held = (await session.scalar(stmt)) is not None
+            await session.commit()
+        return self.held
+
+    async def release(self) -> None:
+        """Give the lease up, for another worker to take over right away."""
+        if not self.held:
+            return
+        async with self.session_factory() as session:
+            await session.execute(
+                delete(SchedulerLease).where(
+                    SchedulerLease.name == self.name,
+                    SchedulerLease.owner == self.owner,
+                )
+            )
+            await session.commit()
+        self.held = False
+
+
+class Scheduler:
+    """
+    Runs the registered jobs every `interval` seconds, give or take `jitter`
+    of it so that workers started together do not tick together, in the one
+    worker holding `lease` among those running it. The lease is renewed on
+    every tick and lasts three intervals: when its worker stops, another
+    takes over within that time.
+
+    Jobs run one after the other, each is responsible for keeping its ticks
+    short. The rows each processed, the time it took and its failures are
+    recorded in the `scheduler_job_*` metrics.
+    """
+
+    def __init__(self, lease: LeaderLease, interval: float, jitter: float = 0.1):
+        self.lease = lease
+        self.interval = interval
+        self.jitter = jitter
+        self.jobs: dict[str, Job] = {}
+        self.ticks = 0
+        self.failures = 0
+        self._task = BackgroundTask(self._run)
+
+    def job(self, name: str) -> Callable[[Job], Job]:
+        """Register the decorated coroutine function as the `name` job."""
+
+        def register(job: Job) -> Job:
+            self.jobs[name] = job
+            return job
+
+        return register
+
+    def start(self) -> None:
+        self._task.ensure_running()
+
+    async def close(self) -> None:
+        self._task.cancel()
+        await self.lease.release()
+
+    async def tick(self) -> dict[str, int] | None:
+        """
+        Run every job if this worker holds the lease, return the rows each
+        processed, or None when another worker holds it.
+        """
+        if not await self.lease.acquire():
+            return None
+        self.ticks += 1
+        processed = {}
+        for name, job in self.jobs.items():
+            start = time.perf_counter()
+            try:
+                processed[name] = await job()
+            except Exception:
+                # Retried on the next tick
+                self.failures += 1
+                scheduler_job_failures.inc(name)
+                logger.exception("Scheduled job %s failed", name)
+                continue
+            finally:
+                scheduler_job_duration.observe(time.perf_counter() - start, name)
+            scheduler_job_rows.observe(processed[name], name)
+        return processed
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "leader": int(self.lease.held),
+            "ticks": self.ticks,
+            "failures": self.failures,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            jitter = random.uniform(-self.jitter, self.jitter)
+            await asyncio.sleep(self.interval * (1 + jitter))
+            try:
+                await self.tick()
+            except Exception:
+                # The lease could not be acquired, tried again on the next tick
+                self.failures += 1
+                logger.exception("Scheduler tick failed")
+
+
+SCHEDULER_INTERVAL = float(os.environ.get("SCHEDULER_INTERVAL", 30))
+
+scheduler = Scheduler(
+    LeaderLease(write_session_factory, "scheduler", ttl=3 * SCHEDULER_INTERVAL),
+    interval=SCHEDULER_INTERVAL,
+    jitter=float(os.environ.get("SCHEDULER_JITTER", 0.1)),
+)
@@ -1,34 +1,189 @@
+"""
+The app's OpenAPI schema, built once per worker and served as pre-encoded
+bytes with an ETag.
+
+Building it walks every route and model, so a worker would pay for it on the
+first `/openapi.json` or `/docs` hit after each start. `app/build_openapi.py`
+writes it ahead of time, e.g. when building the image, to
+`build/openapi-<fingerprint>.json`: the fingerprint covers the app's sources,
+the FastAPI and pydantic versions and the settings showing in the schema, so
+a stale artifact is never found and the schema is built instead.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import fastapi
+import pydantic
+from fastapi import FastAPI, Request
+from fastapi.dependencies.models import Dependant
+from fastapi.openapi.docs import (
+    get_redoc_html,
+    get_swagger_ui_html,
+    get_swagger_ui_oauth2_redirect_html,
+)
 from fastapi.openapi.utils import get_openapi
+from fastapi.routing import APIRoute
+
+from app.dependencies.get_current_user import get_current_user
+from app.services.pydantic_models import TRANSFER_BULK_MAX
+from app.services.response_cache import CachedResponse, cached_response, etag_matches
+
+APP_DIR = Path(__file__).parent
+OPENAPI_ARTIFACT_DIR = Path(
+    os.environ.get("OPENAPI_ARTIFACT_DIR", APP_DIR.parent / "build")
+)
+
+TITLE = "bE app"
+
+USER_HEADER = {
+    "name": "user_id",
+    "in": "header",
+    "required": True,
+    "schema": {
+        "type": "integer",
+        "example": "1",
+    },
+    "type": "integer",
+}
+
+
+def _authenticated(dependant: Dependant) -> bool:
+    return any(
+        dependency.call is get_current_user or _authenticated(dependency)
+        for dependency in dependant.dependencies
+    )
+
+
+def build_openapi(app: FastAPI) -> dict:
+    """
+    The schema of the app's routes, with the `user_id` header on the
+    operations of the routes that authenticate it.
+    """
+    openapi_schema = get_openapi(
+        title=TITLE,
+        version="1.0.0",
+        description="app for tut fastapi",
+        routes=app.routes,
+    )
+    paths = openapi_schema["paths"]
+    for route in app.routes:
+        if not (
+            isinstance(route, APIRoute)
+            and route.include_in_schema
+            and route.path_format in paths
+            and _authenticated(route.dependant)
+        ):
+            continue
+        for method in route.methods:
+            operation = paths[route.path_format].get(method.lower())
+            if operation is not None:
+                operation.setdefault("parameters", []).append(USER_HEADER)
+    return openapi_schema
+
+
+def encode_openapi(openapi_schema: dict) -> bytes:
+    return json.dumps(
+        openapi_schema, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def _cached(body: bytes) -> CachedResponse:
+    return CachedResponse(f'"openapi-{hashlib.sha256(body).hexdigest()[:16]}"', body)
+
 
+def source_fingerprint() -> str:
+    """Hash of everything the schema is built from."""
+    digest = hashlib.sha256(
+        f"{fastapi.__version__} {pydantic.VERSION} {TRANSFER_BULK_MAX}".encode()
+    )
+    for path in sorted(APP_DIR.rglob("*.py")):
+        digest.update(path.relative_to(APP_DIR).as_posix().encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
 
-def custom_openapi(app):
-    def wrapper():
-        if app.openapi_schema:
-            return app.openapi_schema
-        openapi_schema = get_openapi(
-            title="bE app",
-            version="1.0.0",
-            description="app for tut fastapi",
-            routes=app.routes,
+
+def artifact_path(directory: Path = OPENAPI_ARTIFACT_DIR) -> Path:
+    return directory / f"openapi-{source_fingerprint()}.json"
+
+
+class OpenAPISchema:
+    """
+    The app's schema, loaded from its artifact or built on first use, and
+    kept with its encoded body: nothing is built or encoded again.
+    """
+
+    def __init__(self, app: FastAPI, artifact: Path | None = None):
+        self.app = app
+        self.artifact = artifact
+        self.loaded = False
+        self._encoded: CachedResponse | None = None
+
+    def schema(self) -> dict:
+        if self.app.openapi_schema is None:
+            self.encoded()
+        return self.app.openapi_schema
+
+    def encoded(self) -> CachedResponse:
+        if self._encoded is None:
+            artifact = self.artifact or artifact_path()
+            if artifact.exists():
+                body = artifact.read_bytes()
+                self.app.openapi_schema = json.loads(body)
+                self.loaded = True
+            else:
+                self.app.openapi_schema = build_openapi(self.app)
+                body = encode_openapi(self.app.openapi_schema)
+            self._encoded = _cached(body)
+        return self._encoded
+
+    def write(self, directory: Path = OPENAPI_ARTIFACT_DIR) -> Path:
+        """Write the artifact of the current sources, return its path."""
+        path = artifact_path(directory)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(encode_openapi(build_openapi(self.app)))
+        return path
+
+
+def install_openapi(app: FastAPI, openapi_url: str = "/openapi.json") -> OpenAPISchema:
+    """
+    Serve the cached schema, and the docs reading it, on the paths FastAPI
+    would: the app is created with `openapi_url=None`, FastAPI's own route
+    encodes the schema again on every hit.
+    """
+    openapi = OpenAPISchema(app)
+    app.openapi = openapi.schema
+    oauth2_redirect_url = "/docs/oauth2-redirect"
+
+    @app.get(openapi_url, include_in_schema=False)
+    async def openapi_json(request: Request):
+        encoded = openapi.encoded()
+        if etag_matches(request.headers.get("if-none-match"), encoded.etag):
+            encoded = encoded.not_modified()
+        return cached_response(encoded)
+
+    # Behind a proxy, the docs read the schema under its `root_path`
+    def root(request: Request) -> str:
+        return request.scope.get("root_path", "").rstrip("/")
+
+    @app.get("/docs", include_in_schema=False)
+    async def swagger_ui(request: Request):
+        return get_swagger_ui_html(
+            openapi_url=root(request) + openapi_url,
+            title=f"{TITLE} - Swagger UI",
+            oauth2_redirect_url=root(request) + oauth2_redirect_url,
         )
-        user_header = {
-            "name": "user_id",
-            "in": "header",
-            "required": True,
-            "schema": {
-                "type": "integer",
-                "example": "1",
-            },
-            "type": "integer",
-        }
-        paths = openapi_schema["paths"]
-        for key in paths.keys():
-            path = paths[key]
-            if "get" in path.keys():
-                path["get"]["parameters"].append(user_header)
-            if "post" in path.keys():
-                path["post"]["parameters"].append(user_header)
-
-        return openapi_schema
-
-    return wrapper
+
+    @app.get(oauth2_redirect_url, include_in_schema=False)
+    async def swagger_ui_redirect():
+        return get_swagger_ui_oauth2_redirect_html()
+
+    @app.get("/redoc", include_in_schema=False)
+    async def redoc(request: Request):
+        return get_redoc_html(
+            openapi_url=root(request) + openapi_url, title=f"{TITLE} - ReDoc"
+        )
+
+    return openapi
@@ -1,16 +1,77 @@
+import argparse
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from sqlalchemy import Insert
+from sqlalchemy import Integer
+from sqlalchemy import case
+from sqlalchemy import cast
 from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import literal
+from sqlalchemy import select
+
+from sqlalchemy.orm import Session
 
+from app.db import engine
+from app.db import profile
 from app.db import session_factory
+from app.models import BalanceSnapshot
+from app.models import LedgerEntry
+from app.models import Money
 from app.models import Transfer
 from app.models import TransferStatusEnum
 from app.models import User
+from app.models import UserEvent
+from app.models import UserTransferCount
+from app.models import UserTransferStats
+from app.models import UserTransferVersion
+from app.rebuild_aggregates import rebuild_aggregates
+from app.services.entries import opening_entries
+
+DEFAULT_STATUSES = {
+    TransferStatusEnum.PENDING: 0.2,
+    TransferStatusEnum.COMPLETED: 0.7,
+    TransferStatusEnum.REJECTED: 0.1,
+}
+# Generated transfers are a second apart from this date on
+GENERATED_FROM = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# Pseudo-random numbers are computed by SQLite from the row number, with a
+# two round quadratic hash modulo a prime: the same seed gives the same data,
+# and no row goes through Python. Intermediate products stay below 2**63.
+_PRIME = 2_147_483_647
+_STREAMS = {
+    # column: (multiplier, increment)
+    "amount": (48_271, 69_621),
+    "status": (16_807, 39_373),
+    "sender": (62_089_911, 1_583_458_089),
+    "receiver": (40_692, 31_772),
+}
+
+
+def clear(session):
+    for model in [
+        BalanceSnapshot,
+        LedgerEntry,
+        UserTransferVersion,
+        UserTransferStats,
+        UserTransferCount,
+        Transfer,
+        UserEvent,
+        User,
+    ]:
+        session.execute(delete(model))
 
 
 def seed(session=None):
     session = session_factory() if session is None else session
 
-    session.execute(delete(Transfer))
-    session.execute(delete(User))
+    clear(session)
 
     for i in range(10):
         user = User(username=f"user_{i}", balance=10000 * i)
@@ -33,9 +94,223 @@ def seed(session=None):
         status=TransferStatusEnum.COMPLETED,
     )
     session.add(transfer)
+    session.flush()
+    session.execute(opening_entries())
+
+    rebuild_aggregates(session)
+
+
+def _first_round(i, seed: int, stream: str):
+    multiplier, increment = _STREAMS[stream]
+    j = i + seed % 1_000_000_007 + 1_000_003
+    return ((j * j) % _PRIME * multiplier + j * increment) % _PRIME
+
 
-    session.commit()
+def _second_round(h, stream: str):
+    multiplier, _ = _STREAMS[stream]
+    # In [0, 1)
+    return ((h * h) % _PRIME * multiplier + h) % _PRIME * (1.0 / _PRIME)
+
+
+def generated_users(users: int, balance: Decimal) -> Insert:
+    seq = select(literal(1).label("i")).cte("seq", recursive=True)
+    seq = seq.union_all(select(seq.c.i + 1).where(seq.c.i < users))
+    return insert(User).from_select(
+        ["id", "username", "balance"],
+        select(
+            seq.c.i,
+            literal("user_").concat(seq.c.i),
+            literal(balance, Money()),
+        ),
+    )
+
+
+def generated_transfers(
+    start: int,
+    stop: int,
+    users: int,
+    seed: int,
+    statuses: dict[TransferStatusEnum, float],
+    skew: float,
+) -> Insert:
+    """
+    Transfers `start` to `stop` (excluded) of a generated data set. Senders
+    follow a power law: user `k` sends about `k ** (1 / skew - 1)` times as
+    much as user 1, `skew=1` is uniform. Receivers are uniform.
+    """
+    seq = select(literal(start).label("i")).cte("seq", recursive=True)
+    seq = seq.union_all(select(seq.c.i + 1).where(seq.c.i < stop - 1))
+    # Materialized, so that the first round is computed once per row
+    hashes = (
+        select(
+            seq.c.i,
+            *(_first_round(seq.c.i, seed, stream).label(stream) for stream in _STREAMS),
+        )
+        .cte("hashes")
+        .prefix_with("MATERIALIZED")
+    )
+    uniform = {stream: _second_round(hashes.c[stream], stream) for stream in _STREAMS}
+
+    total, thresholds = sum(statuses.values()), []
+    cumulative = 0
+    for status, weight in statuses.items():
+        cumulative += weight / total
+        thresholds.append(
+            (uniform["status"] < cumulative, literal(status, Transfer.status.type))
+        )
+    status = thresholds[-1][1]
+    if len(thresholds) > 1:
+        status = case(*thresholds[:-1], else_=status)
+
+    sender = 1 + cast(users * func.pow(uniform["sender"], skew), Integer)
+    # Anyone but the sender
+    receiver = (sender + cast((users - 1) * uniform["receiver"], Integer)) % users + 1
+    created_at = func.datetime(
+        int(GENERATED_FROM.timestamp()) + hashes.c.i, "unixepoch"
+    ).concat(".000000")
+    return insert(Transfer).from_select(
+        [
+            "id",
+            "created_at",
+            "updated_at",
+            "amount",
+            "status",
+            "sender_id",
+            "receiver_id",
+        ],
+        select(
+            hashes.c.i,
+            created_at,
+            created_at,
+            1 + cast(uniform["amount"] * 100_000, Integer),  # in cents
+            status,
+            sender,
+            receiver,
+        ),
+    )
+
+
+@contextmanager
+def relaxed_pragmas(connection):
+    """
+    No journal, no fsync and a bigger page cache on `connection` while
+    loading, the profile's settings are restored afterwards. A failed load
+    leaves the database to be seeded again. Run outside of transactions,
+    SQLite does not change these within one.
+    """
+    driver_connection = connection.connection.driver_connection
+    try:
+        driver_connection.execute("PRAGMA journal_mode = OFF")
+    except sqlite3.OperationalError:
+        pass  # other connections have the database open in WAL mode
+    driver_connection.execute("PRAGMA synchronous = OFF")
+    driver_connection.execute("PRAGMA cache_size = -512000")
+    try:
+        yield
+    finally:
+        connection.rollback()
+        driver_connection.execute(f"PRAGMA journal_mode = {profile.journal_mode}")
+        driver_connection.execute(f"PRAGMA synchronous = {profile.synchronous}")
+        driver_connection.execute(f"PRAGMA cache_size = {profile.cache_size}")
+
+
+def bulk_seed(
+    users: int = 10_000,
+    transfers: int = 1_000_000,
+    seed: int = 0,
+    statuses: dict[TransferStatusEnum, float] | None = None,
+    skew: float = 1.0,
+    batch_size: int = 1_000_000,
+    balance: Decimal = Decimal(1_000_000),
+    log=None,
+):
+    """
+    Replace the data with `users` users and `transfers` generated transfers
+    between them, for benchmarks. Rows are generated and inserted by SQLite
+    in batches of `batch_size`, committed one by one, and the transfer
+    indexes are built once at the end. The same arguments give the same data.
+    """
+    log = log or (lambda message: None)
+    started = time.perf_counter()
+
+    def done(step):
+        log(f"{step} in {time.perf_counter() - started:.1f}s")
+
+    # A single connection for the whole load, the pragmas are per connection
+    with engine.connect() as connection, relaxed_pragmas(connection):
+        session = Session(bind=connection)
+        clear(session)
+        indexes = Transfer.__table__.indexes
+        for index in indexes:
+            index.drop(session.connection(), checkfirst=True)
+        session.execute(generated_users(users, balance))
+        session.commit()
+        done(f"{users} users")
+
+        for offset in range(1, transfers + 1, batch_size):
+            stop = min(offset + batch_size, transfers + 1)
+            session.execute(
+                generated_transfers(
+                    offset, stop, users, seed, statuses or DEFAULT_STATUSES, skew
+                )
+            )
+            session.commit()
+            done(f"{stop - 1} transfers")
+
+        for index in indexes:
+            index.create(session.connection(), checkfirst=True)
+        session.commit()
+        done("transfer indexes")
+
+        session.execute(opening_entries())
+        rebuild_aggregates(session)
+        done("ledger and aggregates")
+
+
+def _statuses(value: str) -> dict[TransferStatusEnum, float]:
+    """Parse "pending=0.2,completed=0.7,rejected=0.1"."""
+    statuses = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        statuses[TransferStatusEnum[name.strip().upper()]] = float(weight)
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replace the data with the test fixtures, or with generated "
+        "data when --transfers is given."
+    )
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--transfers", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--statuses",
+        type=_statuses,
+        default=DEFAULT_STATUSES,
+        help="weights, e.g. pending=0.2,completed=0.7,rejected=0.1",
+    )
+    parser.add_argument(
+        "--skew", type=float, default=1.0, help="sender power law, 1 is uniform"
+    )
+    parser.add_argument("--batch-size", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    if args.transfers is None:
+        return seed()
+    started = time.perf_counter()
+    bulk_seed(
+        users=args.users,
+        transfers=args.transfers,
+        seed=args.seed,
+        statuses=args.statuses,
+        skew=args.skew,
+        batch_size=args.batch_size,
+        log=print,
+    )
+    elapsed = time.perf_counter() - started
+    print(f"{args.transfers / elapsed:,.0f} transfers/s overall")
 
 
 if __name__ == "__main__":
-    seed()
+    main()
@@ -1,89 +1,654 @@
+import asyncio
+import heapq
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
+from functools import partial
 from typing import List, Any, Dict
-from sqlalchemy import func, desc
+
+from sqlalchemy import Insert
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from fastapi import HTTPException
 from option import Ok, Err, Result
 
-from app.models import Transfer, TransferStatusEnum, User
+from app.models import (
+    LedgerEntryKindEnum,
+    ShardMessage,
+    Transfer,
+    TransferStatusEnum,
+)
+from app.services.counters import (
+    created_transfer_counts,
+    created_transfer_versions,
+    transfer_stats_delta,
+    transfer_status_change,
+    transfer_version_bump,
+)
+from app.services.entries import (
+    balance_entries,
+    hold_entries,
+    ledger_balance,
+    release_entries,
+    settlement_entries,
+    transfer_entries,
+)
+from app.services.events import (
+    add_events,
+    balance_event,
+    created_transfer_events,
+    event_dispatcher,
+    transfer_events,
+)
+from app.scheduler import scheduler
+from app.services.idempotency import idempotent_results
+from app.services.mutations import (
+    adjust_balance,
+    release_holds,
+    transfers_amount,
+    transition_transfers,
+)
+from app.services.pagination import encode_cursor, decode_cursor
+from app.services.pydantic_models import (
+    TransferPageDict,
+    TransferValidator,
+    transfer_dict,
+    transfer_page_json,
+)
+from app.services.response_cache import (
+    FINAL_STATUSES,
+    CachedResponse,
+    etag_matches,
+    listing_etag,
+    listing_responses,
+    transfer_etag,
+    transfer_responses,
+)
 from app.services.selectors import (
-    list_transfers,
-    get_user_by_id,
+    list_transfer_rows,
     get_transfer_by_id,
+    get_transfer_state,
+    get_transfers_by_ids,
+    get_transfers_version,
+    get_unknown_user_ids,
     count_transfers_by_user,
+    leaderboard_query,
+    LEADERBOARD_COLUMNS,
 )
+from app.services.shard_relay import shard_relay
+from app.shards import Shard, router
 
 
-def list_transfer_logic(
-    session, user, status, **kwargs
-) -> Result[dict[str, int | list[Transfer]], Any]:
+async def list_transfer_logic(
+    session: AsyncSession, user, status, **kwargs
+) -> Result[TransferPageDict, Any]:
     page = kwargs.get("page", 1)
     limit = kwargs.get("limit", 10)
+    cursor = kwargs.get("cursor")
+    include_total = kwargs.get("include_total", True)
     offset = (page - 1) * limit
+    before = None
 
-    transactions = list_transfers(session, user, status, offset=offset, limit=limit)
-    total_transfers = count_transfers_by_user(session, user, status)
+    if cursor:
+        # Cursor mode: seek past the last row of the previous page instead of
+        # skipping `offset` rows, the page number is meaningless there
+        decoded = decode_cursor(cursor)
+        if decoded.is_err:
+            return decoded
+        before = decoded.unwrap()
+        page, offset = None, 0
+
+    # Fetch one extra row to know whether there is a next page
+    rows = await list_transfer_rows(
+        session, user, status, offset=offset, limit=limit + 1, before=before
+    )
+    next_cursor = None
+    has_more = len(rows) > limit
+    if has_more:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    total_transfers = None
+    if include_total:
+        total_transfers = await count_transfers_by_user(session, user, status)
 
     return Ok(
+        # In the order of `TransferPageValidator`, JSON keys follow the dict's
         {
             "page": page,
             "limit": limit,
+            "transfers": [transfer_dict(row) for row in rows],
             "total_transfers": total_transfers,
-            "transfers": transactions,
+            "next_cursor": next_cursor,
+            "has_more": has_more,
         }
     )
 
 
-def accept_transfer(session, transfer_id, user_id) -> Result[dict, HTTPException]:
+async def create_transfers(
+    sender_id,
+    transfers: list[tuple[int, Decimal]],
+    idempotency_key: str | None = None,
+) -> Result[list[int], HTTPException]:
+    """
+    Create pending transfers of `(receiver_id, amount)` from the sender, all
+    or none, and return their ids in order. Their total is held from the
+    sender's balance right away, so that accepting them cannot fail for lack
+    of funds.
+    """
+    shard = router.shard_for(sender_id)
+    return await idempotent_results.run(
+        sender_id,
+        idempotency_key,
+        ("create", tuple(transfers)),
+        lambda: _submit(
+            shard,
+            lambda session: _create_transfers(session, shard, sender_id, transfers),
+        ),
+    )
+
+
+async def _submit(shard: Shard, operation) -> Result:
+    # Through the shard's writer, then deliver the messages it may have left
+    # for other shards and the events for its users
+    result = await shard.ledger.submit(operation)
+    shard_relay.notify(shard)
+    event_dispatcher.notify(shard)
+    return result
+
+
+async def _create_transfers(
+    session: AsyncSession, shard: Shard, sender_id, transfers: list[tuple[int, Decimal]]
+):
+    receiver_ids = {receiver_id for receiver_id, _ in transfers}
+    if sender_id in receiver_ids:
+        return Err(HTTPException(status_code=400, detail="Cannot transfer to yourself"))
+    if unknown := await get_unknown_user_ids(session, receiver_ids):
+        detail = f"Unknown receivers: {', '.join(map(str, unknown[:10]))}"
+        return Err(HTTPException(status_code=404, detail=detail))
+    total = sum(amount for _, amount in transfers)
+    if await adjust_balance(session, sender_id, -total) is None:
+        return Err(HTTPException(status_code=400, detail="Insufficient funds"))
+
+    # The ledger writer is the only one inserting transfers on the shard, the
+    # ids after its last one are free
+    last_id = await session.scalar(select(func.max(Transfer.id))) or 0
+    transfer_ids = router.transfer_ids(shard, last_id, len(transfers))
+    now = datetime.now(timezone.utc)
+    rows = [
+        {
+            "id": transfer_id,
+            "created_at": now,
+            "updated_at": now,
+            "amount": amount,
+            "status": TransferStatusEnum.PENDING,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "held": True,
+        }
+        for transfer_id, (receiver_id, amount) in zip(transfer_ids, transfers)
+    ]
+    # Core executemany, with the ids known upfront: RETURNING could only be
+    # kept in parameter order by inserting row by row
+    await session.execute(insert(Transfer.__table__), rows)
+    created = Transfer.id.between(transfer_ids[0], transfer_ids[-1]) & (
+        Transfer.sender_id == sender_id
+    )
+    await session.execute(created_transfer_counts(created))
+    await session.execute(created_transfer_versions(created))
+    await session.execute(hold_entries(created))
+    # Receivers living on other shards are told by their copy
+    home = [
+        receiver_id
+        for receiver_id in receiver_ids
+        if router.is_home(shard, receiver_id)
+    ]
+    await session.execute(
+        created_transfer_events(
+            created, None if len(home) == len(receiver_ids) else home
+        )
+    )
+    if (messages := _copy_messages(shard, rows)) is not None:
+        await session.execute(messages)
+    return Ok(list(transfer_ids))
+
+
+def _copy_messages(shard: Shard, rows: list[dict]) -> Insert | None:
+    # Copies of new transfers for their receivers living on other shards
+    copies = defaultdict(list)
+    for row in rows:
+        if not router.is_home(shard, row["receiver_id"]):
+            receiver_shard = router.shard_for(row["receiver_id"])
+            copies[receiver_shard.index].append(
+                [row["id"], row["receiver_id"], str(row["amount"])]
+            )
+    if not copies:
+        return None
+    sender_id, created_at = rows[0]["sender_id"], rows[0]["created_at"]
+    return insert(ShardMessage).values(
+        [
+            {
+                "shard": index,
+                "kind": "copy",
+                "payload": {
+                    "sender_id": sender_id,
+                    "created_at": created_at.isoformat(),
+                    "transfers": transfers,
+                },
+            }
+            for index, transfers in sorted(copies.items())
+        ]
+    )
+
+
+def _sender_messages(shard: Shard, kind: str, transfers: list[Transfer]):
+    # `kind` changes made to transfers whose senders live on other shards
+    changed = defaultdict(list)
+    for transfer in transfers:
+        if not router.is_home(shard, transfer.sender_id):
+            sender_shard = router.shard_for(transfer.sender_id)
+            changed[sender_shard.index].append(transfer.id)
+    if not changed:
+        return None
+    return insert(ShardMessage).values(
+        [
+            {"shard": index, "kind": kind, "payload": {"transfer_ids": transfer_ids}}
+            for index, transfer_ids in sorted(changed.items())
+        ]
+    )
+
+
+@shard_relay.handles("copy")
+async def _copy_transfers(session: AsyncSession, shard: Shard, payload: dict):
+    sender_id = payload["sender_id"]
+    created_at = datetime.fromisoformat(payload["created_at"])
+    rows = [
+        {
+            "id": transfer_id,
+            "created_at": created_at,
+            "updated_at": created_at,
+            "amount": Decimal(amount),
+            "status": TransferStatusEnum.PENDING,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "held": True,
+            "remote_hold": True,
+        }
+        for transfer_id, receiver_id, amount in payload["transfers"]
+    ]
+    await session.execute(insert(Transfer.__table__), rows)
+    created = Transfer.id.between(rows[0]["id"], rows[-1]["id"]) & (
+        Transfer.sender_id == sender_id
+    )
+    await session.execute(created_transfer_counts(created))
+    await session.execute(created_transfer_versions(created))
+    await session.execute(created_transfer_events(created))
+    return Ok(None)
+
+
+@shard_relay.handles("accept")
+async def _settle_transfers(session: AsyncSession, shard: Shard, payload: dict):
+    transfer_ids = payload["transfer_ids"]
+    transfers = await get_transfers_by_ids(session, transfer_ids)
+    settled = await transition_transfers(
+        session, transfer_ids, None, TransferStatusEnum.COMPLETED
+    )
+    if settled:
+        settled = [transfers[transfer_id] for transfer_id in settled]
+        await session.execute(
+            transfer_status_change(settled, TransferStatusEnum.PENDING)
+        )
+        await session.execute(
+            transfer_stats_delta(settled, partial(router.is_home, shard))
+        )
+        await session.execute(transfer_version_bump(settled))
+        await session.execute(settlement_entries([transfer.id for transfer in settled]))
+        await add_events(
+            session, transfer_events(shard, settled, TransferStatusEnum.COMPLETED)
+        )
+    return Ok(None)
+
+
+@shard_relay.handles("reject")
+async def _release_transfers(session: AsyncSession, shard: Shard, payload: dict):
+    return await _close_remote(session, shard, payload, TransferStatusEnum.REJECTED)
+
+
+@shard_relay.handles("expire")
+async def _expire_remote(session: AsyncSession, shard: Shard, payload: dict):
+    return await _close_remote(session, shard, payload, TransferStatusEnum.EXPIRED)
+
+
+async def _close_remote(
+    session: AsyncSession, shard: Shard, payload: dict, status: TransferStatusEnum
+):
+    transfer_ids = payload["transfer_ids"]
+    transfers = await get_transfers_by_ids(session, transfer_ids)
+    closed = await transition_transfers(session, transfer_ids, None, status)
+    if closed:
+        closed = [transfers[transfer_id] for transfer_id in closed]
+        await _close_transfers(session, shard, closed, status)
+    return Ok(None)
+
+
+async def accept_transfer(
+    transfer_id, user_id, idempotency_key: str | None = None
+) -> Result[dict, HTTPException]:
     """
     Allows the receiver to accept a transfer,
     moving funds from the sender’s balance to the receiver’s balance minus a 2% fee.
+    Transfers created through the API were paid for when created, accepting
+    them only credits the receiver.
     """
-    with session.begin_nested():
-        transfer = get_transfer_by_id(session, transfer_id)
-        if (
-            not transfer
-            or transfer.receiver_id != user_id
-            or transfer.status != TransferStatusEnum.PENDING
-        ):
-            return Err(HTTPException(status_code=403, detail="Cannot accept transfer"))
-        fee = Decimal(transfer.amount) * Decimal("0.02")
-        net_amount = Decimal(transfer.amount) - fee
-        sender = get_user_by_id(session, transfer.sender_id, lock_for_update=True)
-        receiver = get_user_by_id(session, transfer.receiver_id, lock_for_update=True)
-        if sender.balance < transfer.amount:
+    shard = router.shard_for(user_id)
+    return await idempotent_results.run(
+        user_id,
+        idempotency_key,
+        ("accept", transfer_id),
+        lambda: _submit(
+            shard,
+            lambda session: _accept_transfer(session, shard, transfer_id, user_id),
+        ),
+    )
+
+
+def _sender_elsewhere():
+    return HTTPException(
+        status_code=409,
+        detail="Transfer predates holds and its sender is on another shard",
+    )
+
+
+async def _accept_transfer(session: AsyncSession, shard: Shard, transfer_id, user_id):
+    transfer = await get_transfer_by_id(session, transfer_id)
+    if not transfer or not await transition_transfers(
+        session, [transfer_id], user_id, TransferStatusEnum.COMPLETED
+    ):
+        return Err(HTTPException(status_code=403, detail="Cannot accept transfer"))
+    if not transfer.held:
+        if not router.is_home(shard, transfer.sender_id):
+            return Err(_sender_elsewhere())
+        debit = -transfers_amount([transfer_id])
+        if await adjust_balance(session, transfer.sender_id, debit) is None:
             return Err(HTTPException(status_code=400, detail="Insufficient funds"))
-        sender.balance -= transfer.amount
-        receiver.balance += net_amount
-        transfer.status = TransferStatusEnum.COMPLETED
-        session.add(transfer)
-        session.add(sender)
-        session.add(receiver)
-        session.commit()
-        return Ok({"status": "Transfer accepted"})
-
-
-def reject_transfer(session, transfer_id, user_id):
-    transfer = get_transfer_by_id(session, transfer_id)
+    await adjust_balance(
+        session, transfer.receiver_id, transfers_amount([transfer_id], net=True)
+    )
+    await session.execute(
+        transfer_status_change([transfer], TransferStatusEnum.PENDING)
+    )
     if (
-        not transfer
-        or transfer.receiver_id != user_id
-        or transfer.status != TransferStatusEnum.PENDING
+        stats := transfer_stats_delta([transfer], partial(router.is_home, shard))
+    ) is not None:
+        await session.execute(stats)
+    await session.execute(transfer_version_bump([transfer]))
+    await session.execute(transfer_entries([transfer_id]))
+    await add_events(
+        session, transfer_events(shard, [transfer], TransferStatusEnum.COMPLETED)
+    )
+    if (messages := _sender_messages(shard, "accept", [transfer])) is not None:
+        await session.execute(messages)
+    return Ok({"status": "Transfer accepted"})
+
+
+async def reject_transfer(transfer_id, user_id) -> Result[dict, HTTPException]:
+    shard = router.shard_for(user_id)
+    return await _submit(
+        shard, lambda session: _reject_transfer(session, shard, transfer_id, user_id)
+    )
+
+
+async def _reject_transfer(session: AsyncSession, shard: Shard, transfer_id, user_id):
+    transfer = await get_transfer_by_id(session, transfer_id)
+    if not transfer or not await transition_transfers(
+        session, [transfer_id], user_id, TransferStatusEnum.REJECTED
     ):
         return Err(HTTPException(status_code=403, detail="Cannot reject transfer"))
-    transfer.status = TransferStatusEnum.REJECTED
-    session.add(transfer)
-    session.commit()
+    await _close_transfers(session, shard, [transfer], TransferStatusEnum.REJECTED)
     return Ok({"status": "Transfer rejected"})
 
 
-def get_transfer(
-    session, transfer_id, request_user_id
+# Pending transfers expire after this many seconds, never when 0
+PENDING_TRANSFER_TTL = float(os.environ.get("PENDING_TRANSFER_TTL", 7 * 86400))
+# Transfers expired per transaction, and at most per scheduler tick
+EXPIRY_CHUNK_SIZE = int(os.environ.get("EXPIRY_CHUNK_SIZE", 500))
+EXPIRY_MAX_PER_TICK = int(os.environ.get("EXPIRY_MAX_PER_TICK", 20_000))
+# Seconds between two chunks, for the requests queued on the ledger writer
+EXPIRY_CHUNK_PAUSE = float(os.environ.get("EXPIRY_CHUNK_PAUSE", 0.01))
+
+
+@scheduler.job("expire_transfers")
+async def expire_stale_transfers() -> int:
+    """
+    Expire the transfers pending for longer than `PENDING_TRANSFER_TTL`, in
+    chunks of `EXPIRY_CHUNK_SIZE`, oldest first, pausing between chunks so
+    that the requests waiting on the ledger writers go first. Stops after
+    `EXPIRY_MAX_PER_TICK` on each shard, so that a shard's backlog does not
+    hold the others' up: the rest expire on the next ticks. Returns how many
+    expired.
+    """
+    if not PENDING_TRANSFER_TTL:
+        return 0
+    created_before = datetime.now(timezone.utc) - timedelta(
+        seconds=PENDING_TRANSFER_TTL
+    )
+    total = 0
+    for shard in router.shards:
+        expired = 0
+        while expired < EXPIRY_MAX_PER_TICK:
+            limit = min(EXPIRY_CHUNK_SIZE, EXPIRY_MAX_PER_TICK - expired)
+            result = await expire_transfers(shard, created_before, limit)
+            count = result.unwrap()
+            expired += count
+            if count < limit:
+                break
+            await asyncio.sleep(EXPIRY_CHUNK_PAUSE)
+        total += expired
+    return total
+
+
+async def expire_transfers(
+    shard: Shard, created_before: datetime, limit: int
+) -> Result[int, HTTPException]:
+    """
+    Expire the `limit` oldest transfers created before `created_before` and
+    still pending, among those received by users of the shard, which decides
+    on them, with one set-based UPDATE. Their holds are released as on a
+    rejection. Returns how many expired.
+    """
+    return await _submit(
+        shard,
+        lambda session: _expire_transfers(session, shard, created_before, limit),
+    )
+
+
+async def _expire_transfers(
+    session: AsyncSession, shard: Shard, created_before: datetime, limit: int
+):
+    # Ids first: with a subquery, SQLite would scan the pending transfers to
+    # find the ones to update rather than look them up
+    qry = (
+        select(Transfer.id)
+        .where(
+            Transfer.status == TransferStatusEnum.PENDING,
+            Transfer.created_at < created_before,
+            router.lives_on(shard, Transfer.receiver_id),
+        )
+        .order_by(Transfer.created_at, Transfer.id)
+        .limit(limit)
+    )
+    stale = list(await session.scalars(qry))
+    expired = await transition_transfers(
+        session, stale, None, TransferStatusEnum.EXPIRED
+    )
+    if expired:
+        transfers = await get_transfers_by_ids(session, expired)
+        await _close_transfers(
+            session, shard, list(transfers.values()), TransferStatusEnum.EXPIRED
+        )
+    return Ok(len(expired))
+
+
+# Outbox message kinds of the transfers closed without being accepted
+_CLOSING_KINDS = {
+    TransferStatusEnum.REJECTED: "reject",
+    TransferStatusEnum.EXPIRED: "expire",
+}
+
+
+async def _close_transfers(
+    session: AsyncSession,
+    shard: Shard,
+    transfers: list[Transfer],
+    status: TransferStatusEnum,
+):
+    # Transfers just rejected or expired: their holds go back to the senders
+    released = [transfer.id for transfer in transfers]
+    await session.execute(release_holds(released))
+    await session.execute(release_entries(released))
+    messages = _sender_messages(shard, _CLOSING_KINDS[status], transfers)
+    if messages is not None:
+        await session.execute(messages)
+    await session.execute(transfer_status_change(transfers, TransferStatusEnum.PENDING))
+    await session.execute(transfer_version_bump(transfers))
+    await add_events(session, transfer_events(shard, transfers, status))
+
+
+def _batch_item(transfer_id, status_code, detail) -> dict:
+    return {"transfer_id": transfer_id, "status_code": status_code, "detail": detail}
+
+
+async def accept_transfers(
+    transfer_ids: list[int], user_id
+) -> Result[dict, HTTPException]:
+    """
+    Accept many transfers received by the user in a single transaction: the
+    transfers are loaded and claimed with one statement each, every sender is
+    debited once for all of their transfers that were not held at creation
+    (one by one only if that fails) and the receiver is credited once. Every
+    transfer gets the outcome `accept_transfer` would have given it.
+    """
+    shard = router.shard_for(user_id)
+    return await _submit(
+        shard,
+        lambda session: _accept_transfers(session, shard, transfer_ids, user_id),
+    )
+
+
+async def _accept_transfers(
+    session: AsyncSession, shard: Shard, transfer_ids: list[int], user_id
+):
+    transfers = await get_transfers_by_ids(session, transfer_ids)
+    claimed = await transition_transfers(
+        session, list(transfers), user_id, TransferStatusEnum.COMPLETED
+    )
+    results = {
+        transfer_id: _batch_item(transfer_id, 403, "Cannot accept transfer")
+        for transfer_id in transfer_ids
+    }
+
+    accepted, unpaid, elsewhere = [], [], []
+    by_sender = defaultdict(list)
+    for transfer_id in transfer_ids:
+        if transfer_id in claimed:
+            transfer = transfers[transfer_id]
+            if transfer.held:
+                accepted.append(transfer)
+            elif not router.is_home(shard, transfer.sender_id):
+                elsewhere.append(transfer)
+            else:
+                by_sender[transfer.sender_id].append(transfer)
+
+    for sender_id, sent in by_sender.items():
+        total = transfers_amount([transfer.id for transfer in sent])
+        if await adjust_balance(session, sender_id, -total) is not None:
+            accepted.extend(sent)
+            continue
+        for transfer in sent:
+            amount = transfers_amount([transfer.id])
+            if await adjust_balance(session, sender_id, -amount) is not None:
+                accepted.append(transfer)
+            else:
+                unpaid.append(transfer)
+
+    for transfer in unpaid:
+        results[transfer.id] = _batch_item(transfer.id, 400, "Insufficient funds")
+    for transfer in elsewhere:
+        results[transfer.id] = _batch_item(transfer.id, 409, _sender_elsewhere().detail)
+    for transfer in accepted:
+        results[transfer.id] = _batch_item(transfer.id, 200, "Transfer accepted")
+
+    if unpaid or elsewhere:
+        await transition_transfers(
+            session,
+            [transfer.id for transfer in unpaid + elsewhere],
+            user_id,
+            TransferStatusEnum.PENDING,
+            old_status=TransferStatusEnum.COMPLETED,
+        )
+    if accepted:
+        net_amount = transfers_amount([transfer.id for transfer in accepted], net=True)
+        await adjust_balance(session, user_id, net_amount)
+        await session.execute(
+            transfer_status_change(accepted, TransferStatusEnum.PENDING)
+        )
+        if (
+            stats := transfer_stats_delta(accepted, partial(router.is_home, shard))
+        ) is not None:
+            await session.execute(stats)
+        await session.execute(transfer_version_bump(accepted))
+        await session.execute(transfer_entries([transfer.id for transfer in accepted]))
+        await add_events(
+            session, transfer_events(shard, accepted, TransferStatusEnum.COMPLETED)
+        )
+        if (messages := _sender_messages(shard, "accept", accepted)) is not None:
+            await session.execute(messages)
+    return Ok({"results": list(results.values())})
+
+
+async def reject_transfers(
+    transfer_ids: list[int], user_id
+) -> Result[dict, HTTPException]:
+    """
+    Reject many transfers received by the user in a single transaction.
+    """
+    shard = router.shard_for(user_id)
+    return await _submit(
+        shard,
+        lambda session: _reject_transfers(session, shard, transfer_ids, user_id),
+    )
+
+
+async def _reject_transfers(
+    session: AsyncSession, shard: Shard, transfer_ids: list[int], user_id
+):
+    transfers = await get_transfers_by_ids(session, transfer_ids)
+    rejected = await transition_transfers(
+        session, list(transfers), user_id, TransferStatusEnum.REJECTED
+    )
+    results = [
+        _batch_item(transfer_id, 200, "Transfer rejected")
+        if transfer_id in rejected
+        else _batch_item(transfer_id, 403, "Cannot reject transfer")
+        for transfer_id in transfer_ids
+    ]
+
+    if rejected:
+        rejected = [transfers[transfer_id] for transfer_id in rejected]
+        await _close_transfers(session, shard, rejected, TransferStatusEnum.REJECTED)
+    return Ok({"results": results})
+
+
+async def get_transfer(
+    session: AsyncSession, transfer_id, request_user_id
 ) -> Result[Transfer, HTTPException]:
     """
     Retrieve a specific transfer by ID, ensuring the user is authorized (either the sender or receiver).
     """
-    transfer = get_transfer_by_id(session, transfer_id)
+    transfer = await get_transfer_by_id(session, transfer_id)
     if not transfer:
         return Err(HTTPException(status_code=404, detail="Transfer not found"))
     if request_user_id not in [transfer.sender_id, transfer.receiver_id]:
@@ -91,62 +656,152 @@ def get_transfer(
     return Ok(transfer)
 
 
-def deposit_balance(session, user_id, amount: Decimal) -> Result[dict, HTTPException]:
-    user = get_user_by_id(session, user_id, lock_for_update=True)
-    if user is None:
+async def get_transfer_response(
+    session: AsyncSession, transfer_id, request_user_id, if_none_match=None
+) -> Result[CachedResponse, HTTPException]:
+    """
+    `get_transfer` as a cached JSON body and its ETag, which changes with the
+    transfer's `updated_at` and its parties' usernames. Final transfers are
+    served from the cache without reading the database until it expires, the
+    others are revalidated with a primary key lookup. The body is None when
+    `if_none_match` holds the current ETag.
+    """
+    cached = transfer_responses.get(transfer_id)
+    if cached is None or not cached.final:
+        state = await get_transfer_state(session, transfer_id)
+        if state is None:
+            return Err(HTTPException(status_code=404, detail="Transfer not found"))
+        etag = transfer_etag(
+            transfer_id,
+            state.updated_at,
+            (state.sender_username, state.receiver_username),
+        )
+        parties = {state.sender_id, state.receiver_id}
+    else:
+        etag, parties = cached.etag, cached.parties
+    if request_user_id not in parties:
+        return Err(HTTPException(status_code=403, detail="Access denied"))
+
+    if cached is None or cached.etag != etag:
+        transfer = await get_transfer_by_id(session, transfer_id)
+        cached = CachedResponse(
+            etag=transfer_etag(
+                transfer.id,
+                transfer.updated_at,
+                (transfer.sender.username, transfer.receiver.username),
+            ),
+            body=TransferValidator.model_validate(transfer).model_dump_json().encode(),
+            parties=frozenset(parties),
+            final=transfer.status in FINAL_STATUSES,
+        )
+        transfer_responses.set(transfer_id, cached)
+    if etag_matches(if_none_match, cached.etag):
+        return Ok(cached.not_modified())
+    return Ok(cached)
+
+
+async def list_transfer_response(
+    session: AsyncSession, user, status, if_none_match=None, **kwargs
+) -> Result[CachedResponse, Any]:
+    """
+    `list_transfer_logic` as a cached JSON body and its ETag, which changes
+    with the user's listing version. The body is None when `if_none_match`
+    holds the current ETag.
+    """
+    version = await get_transfers_version(session, user.id)
+    query = (status, *sorted(kwargs.items()))
+    etag = listing_etag(user.id, version, query)
+    if etag_matches(if_none_match, etag):
+        return Ok(CachedResponse(etag=etag, body=None))
+
+    key = (user.id, version, query)
+    cached = listing_responses.get(key)
+    if cached is None:
+        result = await list_transfer_logic(session, user, status, **kwargs)
+        if result.is_err:
+            return result
+        body = transfer_page_json.dump_json(result.unwrap())
+        cached = CachedResponse(etag=etag, body=body)
+        listing_responses.set(key, cached)
+    return Ok(cached)
+
+
+async def deposit_balance(
+    user_id, amount: Decimal, idempotency_key: str | None = None
+) -> Result[dict, HTTPException]:
+    return await idempotent_results.run(
+        user_id,
+        idempotency_key,
+        ("deposit", amount),
+        lambda: _submit(
+            router.shard_for(user_id),
+            lambda session: _deposit_balance(session, user_id, amount),
+        ),
+    )
+
+
+async def _deposit_balance(session: AsyncSession, user_id, amount: Decimal):
+    balance = await adjust_balance(session, user_id, amount)
+    if balance is None:
         return Err(HTTPException(status_code=404, detail="User not found"))
+    await session.execute(balance_entries(user_id, amount, LedgerEntryKindEnum.DEPOSIT))
+    await add_events(session, [balance_event(user_id, amount, balance)])
+    return Ok({"status": "Deposit successful", "balance": balance})
+
 
-    user.balance += amount
-    session.add(user)
-    session.commit()
-    return Ok({"status": "Deposit successful", "balance": user.balance})
+async def withdraw_amount(
+    user_id, amount: Decimal, idempotency_key: str | None = None
+) -> Result[dict, HTTPException]:
+    return await idempotent_results.run(
+        user_id,
+        idempotency_key,
+        ("withdraw", amount),
+        lambda: _submit(
+            router.shard_for(user_id),
+            lambda session: _withdraw_amount(session, user_id, amount),
+        ),
+    )
 
 
-def withdraw_amount(session, user_id, amount: Decimal) -> Result[dict, HTTPException]:
-    user = get_user_by_id(session, user_id, lock_for_update=True)
-    if user.balance < amount:
+async def _withdraw_amount(session: AsyncSession, user_id, amount: Decimal):
+    balance = await adjust_balance(session, user_id, -amount)
+    if balance is None:
         return Err(HTTPException(status_code=400, detail="Insufficient funds"))
-    user.balance -= amount
-    session.add(user)
-    session.commit()
-    return Ok({"status": "Withdrawal successful", "balance": user.balance})
+    await session.execute(
+        balance_entries(user_id, -amount, LedgerEntryKindEnum.WITHDRAWAL)
+    )
+    await add_events(session, [balance_event(user_id, -amount, balance)])
+    return Ok({"status": "Withdrawal successful", "balance": balance})
 
 
-def transfers_leaderboard(session, by) -> Result[List[Dict[str, Any]], HTTPException]:
+async def get_balance(session: AsyncSession, user_id) -> Result[dict, HTTPException]:
     """
-    Returns a list of users with the highest number of transfers.
+    The user's balance as recorded by the ledger, their latest snapshot plus
+    the entries since.
     """
-    if by == "count":
-        result = (
-            session.query(
-                User.id, User.username, func.count(Transfer.id).label("transfer_count")
-            )
-            .join(
-                Transfer,
-                (Transfer.sender_id == User.id) | (Transfer.receiver_id == User.id),
-            )
-            .group_by(User.id)
-            .order_by(desc("transfer_count"))
-            .limit(10)
-            .all()
-        )
-    elif by == "amount":
-        result = (
-            session.query(
-                User.id,
-                User.username,
-                func.sum(Transfer.amount).label("total_transferred"),
-            )
-            .join(
-                Transfer,
-                (Transfer.sender_id == User.id) | (Transfer.receiver_id == User.id),
-            )
-            .group_by(User.id)
-            .order_by(desc("total_transferred"))
-            .limit(10)
-            .all()
-        )
-    else:
+    return Ok({"balance": await session.scalar(select(ledger_balance(user_id)))})
+
+
+async def transfers_leaderboard(
+    by, limit: int = 10
+) -> Result[List[Dict[str, Any]], HTTPException]:
+    """
+    Returns a list of users with the highest number of transfers. Every
+    shard's top `limit` is read concurrently, users only count on their home
+    shard, and the tops are merged.
+    """
+    if by not in LEADERBOARD_COLUMNS:
         return Err(HTTPException(status_code=400, detail="Invalid 'by' parameter"))
-    result = [row._mapping for row in result]
+
+    async def shard_top(shard: Shard):
+        async with shard.database.read_session_factory() as session:
+            result = await session.execute(leaderboard_query(by, limit))
+            return [row._mapping for row in result.all()]
+
+    tops = await asyncio.gather(*(shard_top(shard) for shard in router.shards))
+    column = LEADERBOARD_COLUMNS[by].key
+    # Stable, ties keep the order of a single shard's query
+    result = heapq.nlargest(
+        limit, (row for top in tops for row in top), key=lambda row: row[column]
+    )
     return Ok(result)
@@ -0,0 +1,281 @@
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Iterable, Mapping
+
+from sqlalchemy import ColumnElement
+
+from sqlalchemy import Delete
+from sqlalchemy import Insert
+from sqlalchemy import Select
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import union
+from sqlalchemy import union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import (
+    Transfer,
+    TransferStatusEnum,
+    User,
+    UserTransferCount,
+    UserTransferStats,
+    UserTransferVersion,
+)
+
+
+def _parties(transfer: Transfer) -> set[int]:
+    return {transfer.sender_id, transfer.receiver_id}
+
+
+def transfer_count_upsert(
+    deltas: Mapping[tuple[int, TransferStatusEnum], int],
+) -> Insert:
+    """
+    Single upsert adding each `(user_id, status) -> delta` to the per-status
+    counters. Execute it in the transaction that inserts the transfers or
+    changes their status.
+    """
+    stmt = sqlite_insert(UserTransferCount).values(
+        [
+            {"user_id": user_id, "status": status, "transfer_count": delta}
+            for (user_id, status), delta in sorted(
+                deltas.items(), key=lambda item: (item[0][0], item[0][1].name)
+            )
+        ]
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTransferCount.user_id, UserTransferCount.status],
+        set_={
+            "transfer_count": UserTransferCount.transfer_count
+            + stmt.excluded.transfer_count
+        },
+    )
+
+
+def transfer_count_delta(
+    sender_id: int, receiver_id: int, status: TransferStatusEnum, delta: int
+) -> Insert:
+    """
+    Upsert adding `delta` to the counters of both parties of a transfer (once
+    for a self-transfer).
+    """
+    return transfer_count_upsert(
+        {(user_id, status): delta for user_id in {sender_id, receiver_id}}
+    )
+
+
+def transfer_status_change(
+    transfers: Iterable[Transfer], old_status: TransferStatusEnum
+) -> Insert | None:
+    """
+    Upsert moving the given transfers from `old_status` to their current status
+    in the counters of their parties, or None when there is nothing to change.
+    """
+    deltas = Counter()
+    for transfer in transfers:
+        for user_id in _parties(transfer):
+            deltas[(user_id, old_status)] -= 1
+            deltas[(user_id, transfer.status)] += 1
+    return transfer_count_upsert(deltas) if deltas else None
+
+
+def _transfer_parties(transfers: ColumnElement[bool] | None = None) -> Select:
+    # Every party of the transfers once, with the transfer's status
+    sent = select(Transfer.sender_id.label("user_id"), Transfer.status)
+    received = select(Transfer.receiver_id.label("user_id"), Transfer.status).filter(
+        Transfer.receiver_id != Transfer.sender_id
+    )
+    if transfers is not None:
+        sent, received = sent.filter(transfers), received.filter(transfers)
+    parties = union_all(sent, received).subquery()
+    return select(parties.c.user_id, parties.c.status, func.count()).group_by(
+        parties.c.user_id, parties.c.status
+    )
+
+
+def created_transfer_counts(created: ColumnElement[bool]) -> Insert:
+    """
+    Upsert counting the transfers matching `created`, e.g. a range of ids
+    inserted at once, whatever their number: the counts are aggregated in
+    SQL instead of being sent as parameters.
+    """
+    stmt = sqlite_insert(UserTransferCount).from_select(
+        ["user_id", "status", "transfer_count"],
+        # WHERE keeps SQLite from parsing ON CONFLICT as a join constraint
+        select(_transfer_parties(created).subquery()).where(True),
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTransferCount.user_id, UserTransferCount.status],
+        set_={
+            "transfer_count": UserTransferCount.transfer_count
+            + stmt.excluded.transfer_count
+        },
+    )
+
+
+def rebuild_transfer_counts() -> list[Delete | Insert]:
+    """
+    Statements recomputing every counter from the transfers table, for
+    backfills and bulk loads that bypass `transfer_count_delta`.
+    """
+    return [
+        delete(UserTransferCount),
+        insert(UserTransferCount).from_select(
+            ["user_id", "status", "transfer_count"], _transfer_parties()
+        ),
+    ]
+
+
+def transfer_stats_delta(
+    transfers: Iterable[Transfer], is_home: Callable[[int], bool] | None = None
+) -> Insert | None:
+    """
+    Single upsert adding newly completed transfers to the leaderboard
+    aggregates of their senders and receivers, or None when there are none.
+    With `is_home`, only the users it is true for are counted: the others
+    live on another shard, whose aggregates count them.
+    """
+    totals = defaultdict(
+        lambda: {
+            "sent_count": 0,
+            "sent_amount": 0,
+            "received_count": 0,
+            "received_amount": 0,
+        }
+    )
+    for transfer in transfers:
+        totals[transfer.sender_id]["sent_count"] += 1
+        totals[transfer.sender_id]["sent_amount"] += transfer.amount
+        if transfer.receiver_id != transfer.sender_id:
+            totals[transfer.receiver_id]["received_count"] += 1
+            totals[transfer.receiver_id]["received_amount"] += transfer.amount
+    if is_home is not None:
+        totals = {user_id: totals[user_id] for user_id in totals if is_home(user_id)}
+    if not totals:
+        return None
+
+    stmt = sqlite_insert(UserTransferStats).values(
+        [{"user_id": user_id, **totals[user_id]} for user_id in sorted(totals)]
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTransferStats.user_id],
+        set_={
+            column: getattr(UserTransferStats, column) + stmt.excluded[column]
+            for column in (
+                "sent_count",
+                "sent_amount",
+                "received_count",
+                "received_amount",
+            )
+        },
+    )
+
+
+def rebuild_transfer_stats() -> list[Delete | Insert]:
+    """
+    Statements recomputing the leaderboard aggregates from the completed
+    transfers, for backfills and bulk loads.
+    """
+    completed = Transfer.status == TransferStatusEnum.COMPLETED
+    sent = (
+        select(Transfer.sender_id, func.count(), func.sum(Transfer.amount))
+        .filter(completed)
+        .group_by(Transfer.sender_id)
+    )
+    received = (
+        select(Transfer.receiver_id, func.count(), func.sum(Transfer.amount))
+        .filter(completed, Transfer.receiver_id != Transfer.sender_id)
+        .group_by(Transfer.receiver_id)
+    )
+    upsert_received = sqlite_insert(UserTransferStats).from_select(
+        ["user_id", "received_count", "received_amount"], received
+    )
+    upsert_received = upsert_received.on_conflict_do_update(
+        index_elements=[UserTransferStats.user_id],
+        set_={
+            "received_count": upsert_received.excluded.received_count,
+            "received_amount": upsert_received.excluded.received_amount,
+        },
+    )
+    return [
+        delete(UserTransferStats),
+        insert(UserTransferStats).from_select(
+            ["user_id", "sent_count", "sent_amount"], sent
+        ),
+        upsert_received,
+    ]
+
+
+def _version() -> int:
+    return time.time_ns() // 1000
+
+
+def transfer_version_bump(transfers: Iterable[Transfer]) -> Insert | None:
+    """
+    Upsert moving the listing versions of the parties of the given transfers
+    forward, or None when there are none. Execute it in the transaction that
+    inserts the transfers or changes their status.
+    """
+    user_ids = sorted({user_id for t in transfers for user_id in _parties(t)})
+    if not user_ids:
+        return None
+    version = _version()
+    stmt = sqlite_insert(UserTransferVersion).values(
+        [{"user_id": user_id, "version": version} for user_id in user_ids]
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTransferVersion.user_id],
+        set_={
+            "version": func.max(UserTransferVersion.version + 1, stmt.excluded.version)
+        },
+    )
+
+
+def _version_upsert(user_ids: Select) -> Insert:
+    stmt = sqlite_insert(UserTransferVersion).from_select(
+        ["user_id", "version"],
+        select(user_ids.subquery(), literal(_version())).where(True),
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTransferVersion.user_id],
+        set_={
+            "version": func.max(UserTransferVersion.version + 1, stmt.excluded.version)
+        },
+    )
+
+
+def created_transfer_versions(created: ColumnElement[bool]) -> Insert:
+    """
+    Upsert moving the listing versions of the parties of the transfers
+    matching `created` forward, `transfer_version_bump` for any number of
+    transfers.
+    """
+    parties = union(
+        select(Transfer.sender_id).filter(created),
+        select(Transfer.receiver_id).filter(created),
+    )
+    return _version_upsert(parties)
+
+
+def renamed_user_versions(user_id: int) -> Insert:
+    """
+    Upsert moving the listing versions of a renamed user and of everyone
+    they exchanged transfers with forward: listings show usernames.
+    """
+    parties = union(
+        select(literal(user_id)),
+        select(Transfer.receiver_id).filter(Transfer.sender_id == user_id),
+        select(Transfer.sender_id).filter(Transfer.receiver_id == user_id),
+    )
+    return _version_upsert(parties)
+
+
+def rebuild_transfer_versions() -> Insert:
+    """
+    Upsert moving every user's listing version forward, for backfills and
+    bulk loads that bypass `transfer_version_bump`.
+    """
+    return _version_upsert(select(User.id))
@@ -0,0 +1,310 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from sqlalchemy import ColumnElement
+from sqlalchemy import CompoundSelect
+from sqlalchemy import Delete
+from sqlalchemy import Insert
+from sqlalchemy import Integer
+from sqlalchemy import Select
+from sqlalchemy import case
+from sqlalchemy import delete
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import literal
+from sqlalchemy import null
+from sqlalchemy import select
+from sqlalchemy import type_coerce
+from sqlalchemy import union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import (
+    BalanceSnapshot,
+    LedgerAccountEnum,
+    LedgerEntry,
+    LedgerEntryKindEnum,
+    Money,
+    Transfer,
+    User,
+)
+from app.services.mutations import transfer_fee
+
+ENTRY_COLUMNS = ["account", "user_id", "kind", "transfer_id", "amount"]
+
+
+def _account(account: LedgerAccountEnum):
+    return literal(account, LedgerEntry.account.type)
+
+
+def _kind(kind: LedgerEntryKindEnum):
+    return literal(kind, LedgerEntry.kind.type)
+
+
+def _cents(column) -> Integer:
+    # Sum and compare money in minor units, without going through `Decimal`
+    return type_coerce(column, Integer)
+
+
+def _insert_entries(rows: CompoundSelect) -> Insert:
+    # From a subquery, so that `created_at` gets its default for every row
+    return insert(LedgerEntry).from_select(ENTRY_COLUMNS, select(rows.subquery()))
+
+
+def transfer_entries(transfer_ids) -> Insert:
+    """
+    Entries of accepted transfers: the sender, or the holds account for
+    transfers held at creation, is debited the amount, the receiver credited
+    the amount minus the fee and the fees account the fee. Copies of transfers
+    held on another shard debit the clearing account instead, see
+    `settlement_entries`.
+    """
+    amount = _cents(Transfer.amount)
+    fee = transfer_fee(amount)
+    user = _account(LedgerAccountEnum.USER)
+    transfer = _kind(LedgerEntryKindEnum.TRANSFER)
+    accepted = Transfer.id.in_(transfer_ids)
+    rows = union_all(
+        select(user, Transfer.sender_id, transfer, Transfer.id, -amount).where(
+            accepted, ~Transfer.held
+        ),
+        select(
+            case(
+                (Transfer.remote_hold, _account(LedgerAccountEnum.CLEARING)),
+                else_=_account(LedgerAccountEnum.HOLDS),
+            ),
+            null(),
+            transfer,
+            Transfer.id,
+            -amount,
+        ).where(accepted, Transfer.held),
+        select(user, Transfer.receiver_id, transfer, Transfer.id, amount - fee).where(
+            accepted
+        ),
+        select(
+            _account(LedgerAccountEnum.FEES),
+            null(),
+            _kind(LedgerEntryKindEnum.FEE),
+            Transfer.id,
+            fee,
+        ).where(accepted),
+    )
+    return _insert_entries(rows)
+
+
+def _hold_movement(
+    transfers: ColumnElement[bool], kind: LedgerEntryKindEnum, sign: int
+) -> Insert:
+    # The sender gives `sign * amount` to the holds account
+    amount = _cents(Transfer.amount) * sign
+    return _insert_entries(
+        union_all(
+            select(
+                _account(LedgerAccountEnum.USER),
+                Transfer.sender_id,
+                _kind(kind),
+                Transfer.id,
+                -amount,
+            ).where(transfers),
+            select(
+                _account(LedgerAccountEnum.HOLDS),
+                null(),
+                _kind(kind),
+                Transfer.id,
+                amount,
+            ).where(transfers),
+        )
+    )
+
+
+def hold_entries(created: ColumnElement[bool]) -> Insert:
+    """
+    Entries of the holds of new transfers, e.g. a range of ids: their
+    amounts move from the senders to the holds account.
+    """
+    return _hold_movement(created & Transfer.held, LedgerEntryKindEnum.HOLD, 1)
+
+
+def release_entries(transfer_ids) -> Insert:
+    """
+    Entries of rejected transfers that were held on this shard: their
+    amounts go back from the holds account to the senders.
+    """
+    rejected = Transfer.id.in_(transfer_ids) & Transfer.held & ~Transfer.remote_hold
+    return _hold_movement(rejected, LedgerEntryKindEnum.RELEASE, -1)
+
+
+def settlement_entries(transfer_ids) -> Insert:
+    """
+    Entries of held transfers accepted on their receiver's shard, on their
+    sender's: the holds account pays the amount to the clearing account,
+    which the receiver's shard debited.
+    """
+    amount = _cents(Transfer.amount)
+    transfer = _kind(LedgerEntryKindEnum.TRANSFER)
+    settled = Transfer.id.in_(transfer_ids) & Transfer.held & ~Transfer.remote_hold
+    return _insert_entries(
+        union_all(
+            select(
+                _account(LedgerAccountEnum.HOLDS),
+                null(),
+                transfer,
+                Transfer.id,
+                -amount,
+            ).where(settled),
+            select(
+                _account(LedgerAccountEnum.CLEARING),
+                null(),
+                transfer,
+                Transfer.id,
+                amount,
+            ).where(settled),
+        )
+    )
+
+
+def move_entries(
+    account: LedgerAccountEnum, user_id: int | None, amount: Decimal
+) -> Insert:
+    """
+    Entries of `amount` of `account` (a user's balance or the holds) moving
+    to another shard, negative on the shard it leaves and positive on the one
+    it reaches: the clearing account takes the other side.
+    """
+    move = LedgerEntryKindEnum.MOVE
+    return insert(LedgerEntry).values(
+        [
+            {"account": account, "user_id": user_id, "kind": move, "amount": amount},
+            {
+                "account": LedgerAccountEnum.CLEARING,
+                "user_id": None,
+                "kind": move,
+                "amount": -amount,
+            },
+        ]
+    )
+
+
+def balance_entries(user_id: int, delta: Decimal, kind: LedgerEntryKindEnum) -> Insert:
+    """
+    Entries of a deposit (positive `delta`) or a withdrawal (negative `delta`),
+    between the user and the external account.
+    """
+    return insert(LedgerEntry).values(
+        [
+            {
+                "account": LedgerAccountEnum.USER,
+                "user_id": user_id,
+                "kind": kind,
+                "amount": delta,
+            },
+            {
+                "account": LedgerAccountEnum.EXTERNAL,
+                "user_id": None,
+                "kind": kind,
+                "amount": -delta,
+            },
+        ]
+    )
+
+
+def opening_entries() -> Insert:
+    """
+    Opening entries for the balances of users who have no ledger entry yet,
+    e.g. users created by a seed or before the ledger existed.
+    """
+    balance = _cents(User.balance)
+    opening = _kind(LedgerEntryKindEnum.OPENING)
+    unrecorded = (User.balance != 0) & ~exists().where(LedgerEntry.user_id == User.id)
+    return _insert_entries(
+        union_all(
+            select(
+                _account(LedgerAccountEnum.USER), User.id, opening, null(), balance
+            ).where(unrecorded),
+            select(
+                _account(LedgerAccountEnum.EXTERNAL), null(), opening, null(), -balance
+            ).where(unrecorded),
+        ),
+    )
+
+
+def checkpoint_balances() -> Insert:
+    """
+    Upsert the snapshots of the users with entries since the last checkpoint,
+    as of the last entry. Every checkpoint covers all the users with new
+    entries, so only the entries after the newest snapshot are read.
+    """
+    watermark = select(
+        func.coalesce(func.max(BalanceSnapshot.entry_id), 0)
+    ).scalar_subquery()
+    last_entry = select(func.max(LedgerEntry.id)).scalar_subquery()
+    # Materialized so that the tail is read as a range of the primary key, to
+    # group by user SQLite would rather scan the whole `user_id` index
+    tail = (
+        select(LedgerEntry.user_id, _cents(LedgerEntry.amount).label("amount"))
+        .where(
+            LedgerEntry.id > watermark,
+            LedgerEntry.account == LedgerAccountEnum.USER,
+        )
+        .cte("tail")
+        .prefix_with("MATERIALIZED")
+    )
+    balances = (
+        select(
+            tail.c.user_id,
+            func.coalesce(func.max(_cents(BalanceSnapshot.balance)), 0)
+            + func.sum(tail.c.amount),
+            last_entry,
+            literal(datetime.now(timezone.utc), BalanceSnapshot.created_at.type),
+        )
+        .select_from(tail)
+        .outerjoin(BalanceSnapshot, BalanceSnapshot.user_id == tail.c.user_id)
+        .group_by(tail.c.user_id)
+    )
+    stmt = sqlite_insert(BalanceSnapshot).from_select(
+        ["user_id", "balance", "entry_id", "created_at"], balances
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[BalanceSnapshot.user_id],
+        set_={
+            "balance": stmt.excluded.balance,
+            "entry_id": stmt.excluded.entry_id,
+            "created_at": stmt.excluded.created_at,
+        },
+    )
+
+
+def rebuild_balance_snapshots() -> list[Delete | Insert]:
+    """Statements recomputing every snapshot from the whole ledger."""
+    return [delete(BalanceSnapshot), checkpoint_balances()]
+
+
+def ledger_balance(user_id) -> ColumnElement[Decimal]:
+    """
+    A user's balance from the ledger: their snapshot plus the entries after
+    it, read off the `(user_id, id)` index.
+    """
+    snapshot = BalanceSnapshot.user_id == user_id
+    # `user_id` may be a column of the enclosing query, e.g. `User.id`
+    snapshot_entry = (
+        select(BalanceSnapshot.entry_id)
+        .where(snapshot)
+        .correlate_except(BalanceSnapshot)
+    )
+    snapshot_balance = select(_cents(BalanceSnapshot.balance)).where(snapshot)
+    tail = select(func.sum(_cents(LedgerEntry.amount))).where(
+        LedgerEntry.user_id == user_id,
+        LedgerEntry.id > func.coalesce(snapshot_entry.scalar_subquery(), 0),
+    )
+    balance = func.coalesce(snapshot_balance.scalar_subquery(), 0) + func.coalesce(
+        tail.scalar_subquery(), 0
+    )
+    return type_coerce(balance, Money)
+
+
+def balance_drift_query() -> Select:
+    """Users whose balance does not match the ledger, for audits."""
+    ledger = ledger_balance(User.id)
+    return select(User.id, User.balance, ledger.label("ledger_balance")).where(
+        _cents(User.balance) != type_coerce(ledger, Integer)
+    )
@@ -0,0 +1,425 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import AsyncIterator
+
+from fastapi import WebSocket, WebSocketDisconnect
+from option import Ok
+from sqlalchemy import ColumnElement, Insert, Integer, delete, func, insert, literal
+from sqlalchemy import select, type_coerce
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Transfer, TransferStatusEnum, UserEvent
+from app.shards import Shard, ShardRouter, router
+from app.tasks import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+# Events a subscriber may lag behind before being disconnected
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", 256))
+# Seconds events are kept for clients resuming after a disconnection
+EVENT_RETENTION = float(os.environ.get("EVENT_RETENTION", 300))
+# Seconds between two reads of the outboxes, for events written elsewhere
+EVENT_POLL_INTERVAL = float(os.environ.get("EVENT_POLL_INTERVAL", 0.5))
+# Seconds between two keep-alives sent to idle SSE subscribers
+EVENT_KEEPALIVE = float(os.environ.get("EVENT_KEEPALIVE", 15))
+
+
+@dataclass(frozen=True)
+class Event:
+    id: int
+    kind: str
+    payload: dict
+
+    def sse(self) -> bytes:
+        data = json.dumps(self.payload, separators=(",", ":"))
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {data}\n\n".encode()
+
+    def message(self) -> dict:
+        return {"id": self.id, "kind": self.kind, "data": self.payload}
+
+
+# Queued to idle subscribers every `keepalive` seconds
+KEEPALIVE = None
+
+
+class Subscription:
+    """
+    A connection's queue of a user's events, at most `maxsize` of them: a
+    subscriber that falls further behind is closed rather than slowing the
+    dispatcher down, and resumes from the outbox when it reconnects. Idle
+    subscriptions are kept small, a worker holds tens of thousands.
+    """
+
+    __slots__ = ("dispatcher", "user_id", "maxsize", "closed", "_events", "_waiter")
+
+    def __init__(self, dispatcher: "EventDispatcher", user_id: int, maxsize: int):
+        self.dispatcher = dispatcher
+        self.user_id = user_id
+        self.maxsize = maxsize
+        self.closed: str | None = None  # why, once closed
+        self._events: list[Event | None] = []
+        self._waiter: asyncio.Future | None = None
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.dispatcher.unsubscribe(self)
+
+    def push(self, event: Event | None) -> bool:
+        """Queue the event, False if the subscriber is too far behind."""
+        if self.closed is not None or len(self._events) >= self.maxsize:
+            return False
+        self._events.append(event)
+        self._wake()
+        return True
+
+    def close(self, reason: str) -> None:
+        """End `events` once the events already queued have been read."""
+        if self.closed is None:
+            self.closed = reason
+            self._wake()
+
+    async def events(self, last_id: int | None = None) -> AsyncIterator[Event | None]:
+        """
+        The user's events after `last_id`, read from the outbox, then as they
+        are dispatched, and `KEEPALIVE`s. Ends once the subscription closes.
+        """
+        if last_id is not None:
+            for event in await self.dispatcher.replay(self.user_id, last_id):
+                last_id = event.id
+                yield event
+        while True:
+            events, self._events = self._events, []
+            for event in events:
+                if event is KEEPALIVE:
+                    yield event
+                # Events read from the outbox again by the replay are skipped
+                elif last_id is None or event.id > last_id:
+                    last_id = event.id
+                    yield event
+            if self._events:
+                continue
+            if self.closed is not None:
+                return
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+    def _wake(self) -> None:
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+class EventDispatcher:
+    """
+    Fans the `UserEvent` outboxes out to the worker's subscribers: a single
+    task reads the events written since its last read, on every shard, when
+    notified of a write by this worker or every `interval` seconds for those
+    of other workers, and queues each one for the subscriptions of its user.
+    A subscriber costs a queue and no database access while it is idle.
+
+    The task also queues keep-alives every `keepalive` seconds and deletes
+    the events older than `retention` seconds.
+    """
+
+    def __init__(
+        self,
+        router: ShardRouter,
+        queue_size: int = 256,
+        interval: float = 0.5,
+        keepalive: float = 15,
+        retention: float = 300,
+        batch_size: int = 1_000,
+    ):
+        self.router = router
+        self.queue_size = queue_size
+        self.interval = interval
+        self.keepalive = keepalive
+        self.retention = retention
+        self.batch_size = batch_size
+        self.subscribers: dict[int, set[Subscription]] = {}
+        self.dispatched = 0
+        self.overflows = 0
+        self.failures = 0
+        self._last_ids: dict[int, int] = {}
+        self._wakeup: asyncio.Event | None = None
+        self._task = BackgroundTask(self._run)
+
+    async def start(self) -> None:
+        """Dispatch the events written from now on."""
+        for shard in self.router.shards:
+            async with shard.database.read_session_factory() as session:
+                self._last_ids[shard.index] = await _last_event_id(session)
+        self._ensure_running()
+
+    def subscribe(self, user_id: int) -> Subscription:
+        """Subscribe to the user's events, use it as a context manager."""
+        self._ensure_running()
+        subscription = Subscription(self, user_id, self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription, reason="unsubscribed") -> None:
+        subscriptions = self.subscribers.get(subscription.user_id, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            self.subscribers.pop(subscription.user_id, None)
+        subscription.close(reason)
+
+    def notify(self, shard: Shard) -> None:
+        """Read the shard's new events now, it was just written to."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def replay(self, user_id: int, last_id: int) -> list[Event]:
+        """The user's events after `last_id` still in the outbox."""
+        shard = self.router.shard_for(user_id)
+        async with shard.database.read_session_factory() as session:
+            qry = (
+                select(UserEvent.id, UserEvent.kind, UserEvent.payload)
+                .where(UserEvent.user_id == user_id, UserEvent.id > last_id)
+                .order_by(UserEvent.id)
+            )
+            return [Event(*row) for row in await session.execute(qry)]
+
+    async def close(self) -> None:
+        """Stop reading the outboxes and end every subscription."""
+        self._task.cancel()
+        self._wakeup = None
+        for subscriptions in list(self.subscribers.values()):
+            for subscription in subscriptions:
+                subscription.close("shutdown")
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "subscribers": sum(map(len, self.subscribers.values())),
+            "users": len(self.subscribers),
+            "dispatched": self.dispatched,
+            "overflows": self.overflows,
+            "failures": self.failures,
+        }
+
+    def _ensure_running(self) -> None:
+        if self._task.ensure_running():
+            self._wakeup = asyncio.Event()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_keepalive = loop.time() + self.keepalive
+        next_prune = loop.time()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            for shard in self.router.shards:
+                try:
+                    await self._poll(shard)
+                    if loop.time() >= next_prune:
+                        await shard.ledger.submit(
+                            lambda session: _delete_expired(session, self.retention)
+                        )
+                except Exception:
+                    # Read again on the next round, from the same event on
+                    self.failures += 1
+                    logger.exception(
+                        "Reading the events of shard %d failed", shard.index
+                    )
+            if loop.time() >= next_prune:
+                next_prune = loop.time() + min(60, self.retention / 2)
+            if loop.time() >= next_keepalive:
+                next_keepalive = loop.time() + self.keepalive
+                self._dispatch_all(KEEPALIVE)
+
+    async def _poll(self, shard: Shard) -> None:
+        async with shard.database.read_session_factory() as session:
+            if shard.index not in self._last_ids:
+                # Not started: events from before are only replayed on request
+                self._last_ids[shard.index] = await _last_event_id(session)
+                return
+            while True:
+                qry = (
+                    select(
+                        UserEvent.id,
+                        UserEvent.user_id,
+                        UserEvent.kind,
+                        UserEvent.payload,
+                    )
+                    .where(UserEvent.id > self._last_ids[shard.index])
+                    .order_by(UserEvent.id)
+                    .limit(self.batch_size)
+                )
+                rows = (await session.execute(qry)).all()
+                for event_id, user_id, kind, payload in rows:
+                    self._dispatch(user_id, Event(event_id, kind, payload))
+                if rows:
+                    self._last_ids[shard.index] = rows[-1].id
+                if len(rows) < self.batch_size:
+                    return
+
+    def _dispatch(self, user_id: int, event: Event) -> None:
+        for subscription in list(self.subscribers.get(user_id, ())):
+            if subscription.push(event):
+                self.dispatched += 1
+            else:
+                self.overflows += 1
+                self.unsubscribe(subscription, "overflow")
+
+    def _dispatch_all(self, event: Event | None) -> None:
+        # Full queues are not idle, they need no keep-alive
+        for subscriptions in self.subscribers.values():
+            for subscription in subscriptions:
+                subscription.push(event)
+
+
+def transfer_events(
+    shard: Shard, transfers: list[Transfer], status: TransferStatusEnum
+) -> list[dict]:
+    """`transfer` event rows for the parties of `transfers` living on `shard`."""
+    return [
+        {
+            "user_id": user_id,
+            "kind": "transfer",
+            "payload": {
+                "id": transfer.id,
+                "status": status.value,
+                "amount": f"{transfer.amount:.2f}",
+                "sender_id": transfer.sender_id,
+                "receiver_id": transfer.receiver_id,
+            },
+        }
+        for transfer in transfers
+        for user_id in (transfer.sender_id, transfer.receiver_id)
+        if router.is_home(shard, user_id)
+    ]
+
+
+def created_transfer_events(
+    created: ColumnElement[bool], receiver_ids: list[int] | None = None
+) -> Insert:
+    """
+    `transfer` events of new transfers, e.g. a range of ids, for their
+    receivers or those of them in `receiver_ids`. Written by SQLite from the
+    transfers, like their counters: bulk submissions create thousands.
+    """
+    cents = type_coerce(Transfer.amount, Integer)
+    payload = func.json_object(
+        "id",
+        Transfer.id,
+        "status",
+        TransferStatusEnum.PENDING.value,
+        "amount",
+        func.printf("%d.%02d", cents // 100, cents % 100),
+        "sender_id",
+        Transfer.sender_id,
+        "receiver_id",
+        Transfer.receiver_id,
+    )
+    if receiver_ids is not None:
+        ids = func.json_each(json.dumps(sorted(receiver_ids))).table_valued("value")
+        created &= Transfer.receiver_id.in_(select(ids.c.value))
+    return insert(UserEvent).from_select(
+        ["created_at", "user_id", "kind", "payload"],
+        select(
+            Transfer.created_at, Transfer.receiver_id, literal("transfer"), payload
+        ).where(created),
+    )
+
+
+def balance_event(user_id: int, amount: Decimal, balance: Decimal) -> dict:
+    """A `balance` event row, for a deposit or (negative) withdrawal."""
+    return {
+        "user_id": user_id,
+        "kind": "balance",
+        "payload": {"amount": f"{amount:.2f}", "balance": f"{balance:.2f}"},
+    }
+
+
+async def add_events(session: AsyncSession, events: list[dict]) -> None:
+    if events:
+        await session.execute(insert(UserEvent.__table__), events)
+
+
+async def _last_event_id(session: AsyncSession) -> int:
+    return await session.scalar(select(func.max(UserEvent.id))) or 0
+
+
+async def _delete_expired(session: AsyncSession, retention: float):
+    expired = datetime.now(timezone.utc) - timedelta(seconds=retention)
+    await session.execute(delete(UserEvent).where(UserEvent.created_at < expired))
+    return Ok(None)
+
+
+event_dispatcher = EventDispatcher(
+    router,
+    queue_size=EVENT_QUEUE_SIZE,
+    interval=EVENT_POLL_INTERVAL,
+    keepalive=EVENT_KEEPALIVE,
+    retention=EVENT_RETENTION,
+)
+
+
+SSE_KEEPALIVE = b": keep-alive\n\n"
+
+
+async def sse_events(user_id: int, last_id: int | None) -> AsyncIterator[bytes]:
+    """
+    The user's events as a `text/event-stream`, after `last_id` if given. A
+    subscription closed by the server ends with a `close` event giving the
+    reason, clients reconnect with the last event id they got.
+    """
+    with event_dispatcher.subscribe(user_id) as subscription:
+        # Sent right away, so that clients and proxies see the stream open
+        yield SSE_KEEPALIVE
+        async for event in subscription.events(last_id):
+            yield SSE_KEEPALIVE if event is KEEPALIVE else event.sse()
+        reason = json.dumps({"reason": subscription.closed})
+        yield f"event: close\ndata: {reason}\n\n".encode()
+
+
+async def websocket_events(
+    websocket: WebSocket, user_id: int, last_id: int | None
+) -> None:
+    """
+    Send the user's events as JSON messages on the accepted `websocket`,
+    after `last_id` if given, until either side closes it. A subscription
+    closed by the server closes the WebSocket with code 1013, try again
+    later, and the reason.
+    """
+
+    async def forward(subscription: Subscription):
+        async for event in subscription.events(last_id):
+            # The server pings WebSockets itself
+            if event is not KEEPALIVE:
+                await websocket.send_json(event.message())
+        await websocket.close(1013, subscription.closed)
+
+    async def receive():
+        # Client messages are ignored, reading notices when the client leaves
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    with event_dispatcher.subscribe(user_id) as subscription:
+        tasks = [
+            asyncio.create_task(forward(subscription)),
+            asyncio.create_task(receive()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            # The client leaving in the middle of a send is no error
+            with contextlib.suppress(WebSocketDisconnect):
+                task.result()
@@ -0,0 +1,93 @@
+import csv
+import io
+from datetime import datetime, timezone
+from typing import AsyncIterator, Literal, Sequence
+
+from pydantic import TypeAdapter
+from sqlalchemy import Row
+
+from app.models import TransferStatusEnum
+from app.services.pydantic_models import TransferDict, transfer_dict
+from app.services.selectors import user_transfers_export_query
+from app.shards import router
+
+ExportFormat = Literal["ndjson", "csv"]
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Rows fetched from the cursor, and encoded, at a time
+EXPORT_BATCH_SIZE = 1_000
+
+CSV_COLUMNS = [
+    "id",
+    "status",
+    "amount",
+    "created_at",
+    "updated_at",
+    "sender_id",
+    "sender_username",
+    "receiver_id",
+    "receiver_username",
+]
+
+transfer_json = TypeAdapter(TransferDict)
+
+
+def ndjson_lines(rows: Sequence[Row]) -> bytes:
+    """One `TransferValidator`-like JSON object per line."""
+    return b"".join(transfer_json.dump_json(transfer_dict(row)) + b"\n" for row in rows)
+
+
+def csv_lines(rows: Sequence[Row]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for transfer_id, status, amount, created_at, updated_at, *parties in rows:
+        writer.writerow(
+            [
+                transfer_id,
+                status.value,
+                amount,
+                created_at.isoformat(),
+                updated_at.isoformat(),
+                *parties,
+            ]
+        )
+    return buffer.getvalue().encode()
+
+
+def _as_stored(moment: datetime | None) -> datetime | None:
+    # Timestamps are stored as naive UTC
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def export_transfers(
+    user_id: int,
+    export_format: ExportFormat,
+    status: TransferStatusEnum = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Stream a user's transfers, oldest first, in chunks of `EXPORT_BATCH_SIZE`
+    encoded rows. Rows are read from a server-side cursor, so memory does not
+    grow with the history.
+
+    The generator opens its own read session: it runs after the request's
+    dependencies have been closed.
+    """
+    qry = user_transfers_export_query(
+        user_id, status, _as_stored(created_from), _as_stored(created_to)
+    )
+    encode = csv_lines if export_format == "csv" else ndjson_lines
+    if export_format == "csv":
+        yield (",".join(CSV_COLUMNS) + "\r\n").encode()
+    async with router.shard_for(user_id).database.read_session_factory() as session:
+        # Core execution: the rows are plain tuples, no ORM loading involved
+        connection = await session.connection()
+        result = await connection.stream(
+            qry.execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for rows in result.partitions():
+            yield encode(rows)
@@ -0,0 +1,93 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Hashable
+
+from fastapi import HTTPException
+from option import Err, Result
+
+from app.cache import TTLCache
+
+
+class IdempotencyStore:
+    """
+    Results of writes by `Idempotency-Key`, per user. A repeated key gets the
+    stored result back without running the write again, and a repeat that
+    arrives while the first request is still running waits for its result.
+
+    Keys live in the worker that served the first request, for `ttl`
+    seconds or until evicted.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.replays = 0
+        self._results = TTLCache(maxsize, ttl)
+        self._in_flight: dict[Hashable, tuple[Hashable, asyncio.Task]] = {}
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    async def run(
+        self,
+        user_id: int,
+        idempotency_key: str | None,
+        fingerprint: Hashable,
+        operation: Callable[[], Awaitable[Result]],
+    ) -> Result:
+        """
+        Run `operation` once per `(user_id, idempotency_key)`. `fingerprint`
+        identifies the request, reusing a key for another request is an error.
+        """
+        if idempotency_key is None:
+            return await operation()
+        key = (user_id, idempotency_key)
+        if stored := self._results.get(key):
+            self.replays += 1
+            return _replay(stored, fingerprint)
+        if in_flight := self._in_flight.get(key):
+            if in_flight[0] != fingerprint:
+                return _key_reused()
+            self.replays += 1
+            return await asyncio.shield(in_flight[1])
+
+        # In a task of its own, so that the write goes through even if the
+        # client that sent it disconnects while others wait for it
+        task = asyncio.ensure_future(operation())
+        self._in_flight[key] = (fingerprint, task)
+        task.add_done_callback(lambda task: self._finish(key, fingerprint, task))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, fingerprint: Hashable, task: asyncio.Task):
+        del self._in_flight[key]
+        # Failures are not stored, the request can be retried with its key
+        if not task.cancelled() and task.exception() is None:
+            self._results.set(key, (fingerprint, task.result()))
+
+    def clear(self) -> None:
+        self._results.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            **self._results.stats(),
+            "in_flight": len(self._in_flight),
+            "replays": self.replays,
+        }
+
+
+def _replay(stored: tuple[Hashable, Result], fingerprint: Hashable) -> Result:
+    stored_fingerprint, result = stored
+    return result if stored_fingerprint == fingerprint else _key_reused()
+
+
+def _key_reused() -> Result:
+    return Err(
+        HTTPException(
+            status_code=422,
+            detail="Idempotency-Key was already used for another request",
+        )
+    )
+
+
+idempotent_results = IdempotencyStore(
+    maxsize=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 100_000)),
+    ttl=float(os.environ.get("IDEMPOTENCY_TTL", 24 * 3600)),
+)
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable
+
+from option import Result
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.db import write_session_factory
+from app.services.entries import checkpoint_balances
+from app.tasks import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+Operation = Callable[[AsyncSession], Awaitable[Result[Any, Any]]]
+
+
+class LedgerWriter:
+    """
+    Single writer task applying queued write operations in group commits.
+
+    Callers `submit` an operation, a coroutine function taking a session and
+    returning a `Result`, and await its outcome. The writer takes everything
+    queued, up to `max_batch` operations, and runs them one after the other in
+    one transaction, each in its own SAVEPOINT: an `Err` or an exception only
+    rolls back that operation. Under load (the previous batch had more than
+    one operation) it first waits `max_delay` seconds for the batch to fill
+    up, a lone caller is not delayed. Callers are answered once the batch has
+    been committed, a failed commit fails the whole batch.
+
+    Every `checkpoint_every` operations, the writer runs `checkpoint` in its
+    own transaction between two batches.
+
+    Operations must not commit or roll back the session themselves. Not
+    thread-safe, it is meant to be used from the event loop.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        max_batch: int = 256,
+        max_delay: float = 0.002,
+        checkpoint: Callable[[AsyncSession], Awaitable[Any]] | None = None,
+        checkpoint_every: int = 10_000,
+    ):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.checkpoints = 0
+        self._since_checkpoint = 0
+        self.batches = 0
+        self.operations = 0
+        self._queue: asyncio.Queue | None = None
+        self._task = BackgroundTask(self._run)
+
+    async def submit(self, operation: Operation) -> Result[Any, Any]:
+        future = asyncio.get_running_loop().create_future()
+        self._ensure_running().put_nowait((operation, future))
+        return await future
+
+    async def close(self) -> None:
+        """Apply the operations already queued and stop the writer task."""
+        if not self._task.running:
+            return
+        self._queue.put_nowait(None)
+        await self._task.join()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "batches": self.batches,
+            "operations": self.operations,
+            "checkpoints": self.checkpoints,
+            "queued": self._queue.qsize() if self._queue else 0,
+        }
+
+    def _ensure_running(self) -> asyncio.Queue:
+        if self._task.ensure_running():
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def _run(self) -> None:
+        queue = self._queue
+        stopping, concurrent = False, False
+        while not stopping:
+            batch = [await queue.get()]
+            if concurrent and self.max_delay and queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                await self._apply(batch)
+            concurrent = len(batch) > 1
+            self._since_checkpoint += len(batch)
+            if self.checkpoint and self._since_checkpoint >= self.checkpoint_every:
+                await self._checkpoint()
+
+    async def _apply(self, batch: list[tuple[Operation, asyncio.Future]]) -> None:
+        batch = [
+            (operation, future) for operation, future in batch if not future.done()
+        ]
+        if not batch:  # every caller went away
+            return
+        outcomes = []
+        try:
+            async with self.session_factory() as session:
+                if len(batch) == 1:
+                    # Nothing to isolate from, the transaction is enough
+                    operation, future = batch[0]
+                    outcomes.append(
+                        (future, await self._apply_alone(session, operation))
+                    )
+                else:
+                    for operation, future in batch:
+                        outcomes.append(
+                            (future, await self._apply_one(session, operation))
+                        )
+                await session.commit()
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        finally:
+            self.batches += 1
+            self.operations += len(batch)
+
+        for future, (result, exc) in outcomes:
+            if future.done():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    async def _checkpoint(self) -> None:
+        self._since_checkpoint = 0
+        try:
+            async with self.session_factory() as session:
+                await self.checkpoint(session)
+                await session.commit()
+        except Exception:
+            # The next checkpoint covers the entries this one missed
+            logger.exception("Ledger checkpoint failed")
+        else:
+            self.checkpoints += 1
+
+    @staticmethod
+    async def _apply_alone(session: AsyncSession, operation: Operation):
+        try:
+            result = await operation(session)
+        except Exception as exc:
+            await session.rollback()
+            return None, exc
+        if result.is_err:
+            await session.rollback()
+        return result, None
+
+    @staticmethod
+    async def _apply_one(session: AsyncSession, operation: Operation):
+        savepoint = await session.begin_nested()
+        try:
+            result = await operation(session)
+        except Exception as exc:
+            await savepoint.rollback()
+            return None, exc
+        if result.is_err:
+            await savepoint.rollback()
+        else:
+            await savepoint.commit()
+        return result, None
+
+
+async def _checkpoint_balances(session: AsyncSession) -> None:
+    await session.execute(checkpoint_balances())
+
+
+def ledger_writer(
+    session_factory: async_sessionmaker[AsyncSession],
+) -> LedgerWriter:
+    """A writer for the database of `session_factory`, configured from the env."""
+    return LedgerWriter(
+        session_factory,
+        max_batch=int(os.environ.get("LEDGER_MAX_BATCH", 256)),
+        max_delay=float(os.environ.get("LEDGER_MAX_DELAY", 0.002)),
+        checkpoint=_checkpoint_balances,
+        checkpoint_every=int(os.environ.get("LEDGER_CHECKPOINT_EVERY", 10_000)),
+    )
+
+
+ledger = ledger_writer(write_session_factory)
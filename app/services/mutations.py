@@ -0,0 +1,106 @@
+from decimal import Decimal
+
+from sqlalchemy import ColumnElement
+from sqlalchemy import Integer
+from sqlalchemy import ScalarSelect
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import type_coerce
+from sqlalchemy import Update
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Transfer, TransferStatusEnum, User
+
+
+FEE_PERCENT = 2
+
+
+def transfer_fee(amount: ColumnElement[int]) -> ColumnElement[int]:
+    """
+    Fee in minor units for an amount in minor units, rounded half up with
+    integer arithmetic in SQL.
+    """
+    return (amount * FEE_PERCENT + 50) // 100
+
+
+def transfers_amount(transfer_ids, net: bool = False) -> ScalarSelect:
+    """
+    Total amount of the given transfers in minor units, minus the fee when
+    `net`, as a scalar subquery to be used as a balance delta.
+    """
+    amount = type_coerce(Transfer.amount, Integer)
+    if net:
+        amount = amount - transfer_fee(amount)
+    return (
+        select(func.coalesce(func.sum(amount), 0))
+        .where(Transfer.id.in_(transfer_ids))
+        .scalar_subquery()
+    )
+
+
+async def adjust_balance(
+    session: AsyncSession, user_id: int, delta: Decimal | ColumnElement[int]
+) -> Decimal | None:
+    """
+    Add `delta` to a user's balance in a single conditional UPDATE, so that
+    concurrent writers cannot lose updates or overdraw the account. `delta` is
+    either a `Decimal` amount or a SQL expression in minor units, such as
+    `transfers_amount`.
+
+    Returns the new balance, or None when the user does not exist or the
+    balance would become negative (nothing is written then).
+    """
+    qry = (
+        update(User)
+        .where(User.id == user_id, User.balance + delta >= 0)
+        .values(balance=User.balance + delta)
+        .returning(User.balance)
+    )
+    return await session.scalar(qry)
+
+
+def release_holds(transfer_ids) -> Update:
+    """
+    Give the amounts of the given transfers held on this shard back to their
+    senders, all of them in a single UPDATE.
+    """
+    released = Transfer.id.in_(transfer_ids) & Transfer.held & ~Transfer.remote_hold
+    amount = (
+        select(func.sum(type_coerce(Transfer.amount, Integer)))
+        .where(released, Transfer.sender_id == User.id)
+        .scalar_subquery()
+    )
+    return (
+        update(User)
+        .where(User.id.in_(select(Transfer.sender_id).where(released)))
+        .values(balance=User.balance + amount)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def transition_transfers(
+    session: AsyncSession,
+    transfer_ids,
+    receiver_id: int | None,
+    new_status: TransferStatusEnum,
+    old_status: TransferStatusEnum = TransferStatusEnum.PENDING,
+) -> set[int]:
+    """
+    Move the receiver's transfers from `old_status` to `new_status` in a
+    single conditional UPDATE and return the ids that actually changed, so
+    that a transfer can only ever be accepted or rejected once. Any party's
+    when `receiver_id` is None, for changes the receiver made on another
+    shard.
+    """
+    changing = [Transfer.id.in_(transfer_ids), Transfer.status == old_status]
+    if receiver_id is not None:
+        changing.append(Transfer.receiver_id == receiver_id)
+    qry = (
+        update(Transfer)
+        .where(*changing)
+        .values(status=new_status)
+        .returning(Transfer.id)
+    )
+    changed = await session.scalars(qry)
+    return set(changed)
@@ -0,0 +1,25 @@
+import base64
+import binascii
+from datetime import datetime
+
+from fastapi import HTTPException
+from option import Ok, Err, Result
+
+from app.models import Transfer
+
+
+def encode_cursor(transfer: Transfer) -> str:
+    """
+    Encode the keyset position `(created_at, id)` of a transfer as an opaque cursor.
+    """
+    raw = f"{transfer.created_at.isoformat()}|{transfer.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Result[tuple[datetime, int], HTTPException]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, transfer_id = raw.split("|")
+        return Ok((datetime.fromisoformat(created_at), int(transfer_id)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return Err(HTTPException(status_code=400, detail="Invalid cursor"))
@@ -1,10 +1,18 @@
+import os
 from datetime import datetime
 from decimal import Decimal
 
 from pydantic import BaseModel
+from pydantic import Field
+from pydantic import TypeAdapter
+from sqlalchemy import Row
+from typing_extensions import TypedDict
 
 from app.models import TransferStatusEnum
 
+# Most transfers a bulk submission may create, e.g. a payroll run
+TRANSFER_BULK_MAX = int(os.environ.get("TRANSFER_BULK_MAX", 50_000))
+
 
 class User(BaseModel):
     id: int
@@ -28,7 +36,106 @@ class TransferValidator(BaseModel):
 
 
 class TransferPageValidator(BaseModel):
-    page: int
+    page: int | None
     limit: int
     transfers: list[TransferValidator]
-    total_transfers: int
+    total_transfers: int | None = None
+    next_cursor: str | None = None
+    has_more: bool = False
+
+
+class UserDict(TypedDict):
+    id: int
+    username: str
+
+
+class TransferDict(TypedDict):
+    id: int
+    status: TransferStatusEnum
+    amount: Decimal
+    created_at: datetime
+    updated_at: datetime
+    sender: UserDict
+    receiver: UserDict
+
+
+class TransferPageDict(TypedDict):
+    page: int | None
+    limit: int
+    transfers: list[TransferDict]
+    total_transfers: int | None
+    next_cursor: str | None
+    has_more: bool
+
+
+# Same JSON as `TransferPageValidator`, dumped from plain dicts: the schema is
+# compiled once and nothing is validated on the way out
+transfer_page_json = TypeAdapter(TransferPageDict)
+
+
+def transfer_dict(row: Row) -> TransferDict:
+    """Shape a row of `user_transfer_rows_query` like `TransferValidator`."""
+    # Unpacked by position, attribute access by name costs more per row
+    (transfer_id, status, amount, created_at, updated_at, *parties) = row
+    sender_id, sender_username, receiver_id, receiver_username = parties
+    return {
+        "id": transfer_id,
+        "status": status,
+        "amount": amount,
+        "created_at": created_at,
+        "updated_at": updated_at,
+        "sender": {"id": sender_id, "username": sender_username},
+        "receiver": {"id": receiver_id, "username": receiver_username},
+    }
+
+
+class TransferBatchValidator(BaseModel):
+    transfer_ids: list[int] = Field(min_length=1, max_length=1000)
+
+
+class TransferBatchItemValidator(BaseModel):
+    transfer_id: int
+    status_code: int
+    detail: str
+
+
+class TransferBatchResultValidator(BaseModel):
+    results: list[TransferBatchItemValidator]
+
+
+class TransferCreateValidator(BaseModel):
+    receiver_id: int
+    amount: Decimal = Field(gt=0, decimal_places=2)
+
+
+class TransferBulkCreateValidator(BaseModel):
+    transfers: list[TransferCreateValidator] = Field(
+        min_length=1, max_length=TRANSFER_BULK_MAX
+    )
+
+
+class TransferCreatedValidator(BaseModel):
+    id: int
+
+
+class TransferBulkCreatedValidator(BaseModel):
+    transfer_ids: list[int]
+
+
+# Money goes out as exact decimal strings, like transfer amounts, never floats
+class BalanceValidator(BaseModel):
+    balance: Decimal
+
+
+class BalanceChangeValidator(BaseModel):
+    status: str
+    balance: Decimal
+
+
+class LeaderboardEntryValidator(BaseModel):
+    """A leaderboard row, with the `transfer_count` or `total_transferred` ranked by."""
+
+    id: int
+    username: str
+    transfer_count: int | None = None
+    total_transferred: Decimal | None = None
@@ -0,0 +1,83 @@
+import os
+import zlib
+from dataclasses import dataclass, replace
+from datetime import datetime
+
+from fastapi import Response
+from sqlalchemy import event, inspect
+
+from app.cache import TTLCache
+from app.models import TransferStatusEnum, User
+from app.services.counters import renamed_user_versions
+
+# Completed, rejected and expired transfers never change again
+FINAL_STATUSES = {
+    TransferStatusEnum.COMPLETED,
+    TransferStatusEnum.REJECTED,
+    TransferStatusEnum.EXPIRED,
+}
+
+# Serialized bodies of single transfers by id, and of listing pages by user,
+# listing version and query. Final transfers are served until they expire,
+# the other entries are revalidated against the database before being served.
+transfer_responses = TTLCache(
+    maxsize=int(os.environ.get("RESPONSE_CACHE_SIZE", 10_000)),
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 60)),
+)
+listing_responses = TTLCache(
+    maxsize=int(os.environ.get("RESPONSE_CACHE_SIZE", 10_000)),
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 60)),
+)
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    """
+    A JSON body and its ETag. `body` is None when the client's copy is
+    current, `parties` are the users allowed to read it. `final` bodies are
+    served without revalidation while cached.
+    """
+
+    etag: str
+    body: bytes | None
+    parties: frozenset[int] = frozenset()
+    final: bool = False
+
+    def not_modified(self) -> "CachedResponse":
+        return replace(self, body=None)
+
+
+def transfer_etag(
+    transfer_id: int, updated_at: datetime, usernames: tuple[str, str]
+) -> str:
+    # The body shows the parties' usernames, which change without the transfer
+    names = zlib.crc32("\0".join(usernames).encode())
+    return f'"t{transfer_id}-{updated_at:%Y%m%d%H%M%S%f}-{names:08x}"'
+
+
+def listing_etag(user_id: int, version: int, query: tuple) -> str:
+    return f'"u{user_id}-{version}-{zlib.crc32(repr(query).encode()):08x}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an `If-None-Match` header lists `etag` (weakly compared)."""
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+@event.listens_for(User, "after_update")
+def _renamed_user(mapper, connection, target):
+    if not inspect(target).attrs.username.history.has_changes():
+        return
+    # Their counterparties' listings show the username too
+    connection.execute(renamed_user_versions(target.id))
+    transfer_responses.invalidate_matching(lambda cached: target.id in cached.parties)
+
+
+def cached_response(cached: CachedResponse) -> Response:
+    headers = {"ETag": cached.etag, "Cache-Control": "private, no-cache"}
+    if cached.body is None:
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
@@ -1,61 +1,307 @@
+import json
+from datetime import datetime
+
+from sqlalchemy import CompoundSelect
+from sqlalchemy import Row
+from sqlalchemy import Select
+from sqlalchemy import Subquery
+from sqlalchemy import and_
+from sqlalchemy import desc
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy import union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm import joinedload
 
-from app.models import Transfer, TransferStatusEnum, User
+from app.models import (
+    Transfer,
+    TransferStatusEnum,
+    User,
+    UserTransferCount,
+    UserTransferStats,
+    UserTransferVersion,
+)
 
 
-def count_transfers_by_user(
-    session, user: User, status: TransferStatusEnum = None
-) -> int:
-    filters = (Transfer.sender_id == user.id) | (Transfer.receiver_id == user.id)
+def _user_transfer_filters(
+    user_id: int,
+    status: TransferStatusEnum = None,
+    before=None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+):
+    """
+    One filter per side of a user's transfers, each answerable from a single
+    `(<side>_id, status, created_at, id)` index. `sender_id = ? OR receiver_id = ?`
+    cannot use an index, so callers combine these with UNION ALL instead; the
+    receiving side skips self-transfers so that they are not returned twice.
+    """
+    sides = [
+        Transfer.sender_id == user_id,
+        and_(Transfer.receiver_id == user_id, Transfer.sender_id != user_id),
+    ]
+    conditions = []
     if status:
-        filters &= Transfer.status == status
+        conditions.append(Transfer.status == status)
+    if before:
+        conditions.append(tuple_(Transfer.created_at, Transfer.id) < tuple_(*before))
+    if created_from:
+        conditions.append(Transfer.created_at >= created_from)
+    if created_to:
+        conditions.append(Transfer.created_at < created_to)
+    return [and_(side, *conditions) for side in sides]
 
-    qry = (
-        session.query(
-            Transfer,
+
+NEWEST_FIRST = (desc(Transfer.created_at), desc(Transfer.id))
+
+
+def _user_transfer_ids(
+    user_id: int,
+    status: TransferStatusEnum = None,
+    offset: int = 0,
+    limit: int = 10,
+    before: tuple[datetime, int] | None = None,
+) -> Subquery:
+    # Each side reads at most `offset + limit` rows straight off its index
+    branches = [
+        select(
+            select(Transfer.id)
+            .filter(filters)
+            .order_by(*NEWEST_FIRST)
+            .limit(offset + limit)
+            .subquery()
         )
+        for filters in _user_transfer_filters(user_id, status, before)
+    ]
+    return union_all(*branches).subquery()
+
+
+def user_transfers_query(
+    user_id: int,
+    status: TransferStatusEnum = None,
+    offset: int = 0,
+    limit: int = 10,
+    before: tuple[datetime, int] | None = None,
+) -> Select:
+    candidates = _user_transfer_ids(user_id, status, offset, limit, before)
+    return (
+        select(Transfer)
+        .join(candidates, Transfer.id == candidates.c.id)
         .options(joinedload(Transfer.sender), joinedload(Transfer.receiver))
-        .filter(filters)
+        .order_by(*NEWEST_FIRST)
+        .offset(offset)
+        .limit(limit)
+    )
+
+
+def _transfer_row_columns(sender: User, receiver: User) -> list:
+    return [
+        # Labelled for the export's ORDER BY, SQLite would not match a bare
+        # "id" to the result column once users are joined
+        Transfer.id.label("id"),
+        Transfer.status,
+        Transfer.amount,
+        Transfer.created_at,
+        Transfer.updated_at,
+        Transfer.sender_id,
+        sender.username.label("sender_username"),
+        Transfer.receiver_id,
+        receiver.username.label("receiver_username"),
+    ]
+
+
+def user_transfer_rows_query(
+    user_id: int,
+    status: TransferStatusEnum = None,
+    offset: int = 0,
+    limit: int = 10,
+    before: tuple[datetime, int] | None = None,
+) -> Select:
+    """
+    `user_transfers_query` projected on the columns of `TransferValidator`,
+    with the parties' usernames joined in, as plain rows.
+    """
+    candidates = _user_transfer_ids(user_id, status, offset, limit, before)
+    sender, receiver = aliased(User), aliased(User)
+    return (
+        select(*_transfer_row_columns(sender, receiver))
+        .join(candidates, Transfer.id == candidates.c.id)
+        .join(sender, sender.id == Transfer.sender_id)
+        .join(receiver, receiver.id == Transfer.receiver_id)
+        .order_by(*NEWEST_FIRST)
+        .offset(offset)
+        .limit(limit)
+    )
+
+
+def user_transfers_export_query(
+    user_id: int,
+    status: TransferStatusEnum = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+) -> CompoundSelect:
+    """
+    All of a user's transfers oldest first, as rows like
+    `user_transfer_rows_query`. Each side is read in order off its index and
+    SQLite merges both, there is no sort however many rows there are.
+    """
+    sender, receiver = aliased(User), aliased(User)
+    export = union_all(
+        *(
+            select(*_transfer_row_columns(sender, receiver))
+            .join(sender, sender.id == Transfer.sender_id)
+            .join(receiver, receiver.id == Transfer.receiver_id)
+            .filter(filters)
+            for filters in _user_transfer_filters(
+                user_id, status, created_from=created_from, created_to=created_to
+            )
+        )
+    )
+    columns = export.selected_columns
+    return export.order_by(columns.created_at, columns.id)
+
+
+def user_transfers_count_query(
+    user_id: int, status: TransferStatusEnum = None
+) -> Select:
+    counts = [
+        select(func.count()).select_from(Transfer).filter(filters).scalar_subquery()
+        for filters in _user_transfer_filters(user_id, status)
+    ]
+    return select(counts[0] + counts[1])
+
+
+LEADERBOARD_COLUMNS = {
+    "count": UserTransferStats.transfer_count.label("transfer_count"),
+    "amount": UserTransferStats.total_amount.label("total_transferred"),
+}
+
+
+def leaderboard_query(by: str, limit: int = 10) -> Select:
+    """
+    Top `limit` users by completed transfer count or amount, read backwards
+    off the matching `user_transfer_stats` index.
+    """
+    column = LEADERBOARD_COLUMNS[by]
+    return (
+        select(User.id, User.username, column)
+        .join(UserTransferStats, UserTransferStats.user_id == User.id)
+        .order_by(desc(column.element))
+        .limit(limit)
+    )
+
+
+async def count_transfers_by_user(
+    session: AsyncSession, user: User, status: TransferStatusEnum = None
+) -> int:
+    qry = select(func.coalesce(func.sum(UserTransferCount.transfer_count), 0)).filter(
+        UserTransferCount.user_id == user.id
     )
-    count = qry.count()
+    if status:
+        qry = qry.filter(UserTransferCount.status == status)
+    count = await session.scalar(qry)
     return count
 
 
-def list_transfers(
-    session,
+async def list_transfers(
+    session: AsyncSession,
     user: User,
     status: TransferStatusEnum,
     offset: int = 1,
     limit: int = 10,
+    before: tuple[datetime, int] | None = None,
 ) -> list[Transfer]:
     """
     List transfers for a user with a given status associated with label "sending" or "receiving".
+
+    Transfers are returned newest first. When `before` holds a `(created_at, id)`
+    keyset position, only older transfers are returned and `offset` should be 0,
+    so that every page costs the same regardless of its depth.
     """
-    filters = (Transfer.sender_id == user.id) | (Transfer.receiver_id == user.id)
+    qry = user_transfers_query(user.id, status, offset, limit, before)
+    transactions = await session.scalars(qry)
+    return transactions.all()
 
-    if status:
-        filters &= Transfer.status == status
 
-    transactions = (
-        session.query(
-            Transfer,
-        )
-        .options(joinedload(Transfer.sender), joinedload(Transfer.receiver))
-        .filter(filters)
-        .offset(offset)
-        .limit(limit)
-        .all()
+async def list_transfer_rows(
+    session: AsyncSession,
+    user: User,
+    status: TransferStatusEnum,
+    offset: int = 0,
+    limit: int = 10,
+    before: tuple[datetime, int] | None = None,
+) -> list[Row]:
+    """
+    `list_transfers` as rows of columns, nothing goes through the identity map.
+    """
+    qry = user_transfer_rows_query(user.id, status, offset, limit, before)
+    result = await session.execute(qry)
+    return result.all()
+
+
+async def get_user_by_id(session: AsyncSession, user_id, lock_for_update=False) -> User:
+    qry = select(User).filter(User.id == user_id)
+    if lock_for_update:
+        qry = qry.with_for_update()
+    return await session.scalar(qry)
+
+
+async def get_unknown_user_ids(session: AsyncSession, user_ids) -> list[int]:
+    """
+    Those of `user_ids` that are not users. The ids are sent as a single JSON
+    array, so that any number of them fits under SQLite's variable limit.
+    """
+    ids = func.json_each(json.dumps(sorted(user_ids))).table_valued("value")
+    qry = select(ids.c.value).where(~exists().where(User.id == ids.c.value))
+    return list(await session.scalars(qry))
+
+
+async def get_transfers_by_ids(
+    session: AsyncSession, transfer_ids
+) -> dict[int, Transfer]:
+    transfers = await session.scalars(
+        select(Transfer).filter(Transfer.id.in_(transfer_ids))
     )
+    return {transfer.id: transfer for transfer in transfers}
 
-    return transactions
 
+async def get_transfer_by_id(session: AsyncSession, transfer_id) -> Transfer:
+    # Relationships are loaded eagerly: lazy loading is not available under asyncio
+    qry = (
+        select(Transfer)
+        .options(joinedload(Transfer.sender), joinedload(Transfer.receiver))
+        .filter(Transfer.id == transfer_id)
+    )
+    return await session.scalar(qry)
 
-def get_user_by_id(session, user_id, lock_for_update=False) -> User:
-    qry = session.query(User).filter(User.id == user_id)
-    if lock_for_update:
-        return qry.with_for_update().first()
-    return qry.first()
 
+async def get_transfer_state(session: AsyncSession, transfer_id) -> Row | None:
+    """
+    Parties and their usernames, status and last update of a transfer,
+    without loading it.
+    """
+    sender, receiver = aliased(User), aliased(User)
+    qry = (
+        select(
+            Transfer.sender_id,
+            Transfer.receiver_id,
+            Transfer.status,
+            Transfer.updated_at,
+            sender.username.label("sender_username"),
+            receiver.username.label("receiver_username"),
+        )
+        .join(sender, sender.id == Transfer.sender_id)
+        .join(receiver, receiver.id == Transfer.receiver_id)
+        .filter(Transfer.id == transfer_id)
+    )
+    return (await session.execute(qry)).first()
 
-def get_transfer_by_id(session, transfer_id) -> Transfer:
-    return session.query(Transfer).filter(Transfer.id == transfer_id).first()
+
+async def get_transfers_version(session: AsyncSession, user_id) -> int:
+    qry = select(UserTransferVersion.version).filter(
+        UserTransferVersion.user_id == user_id
+    )
+    return await session.scalar(qry) or 0
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from option import Ok, Result
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import ShardInbox, ShardMessage
+from app.shards import Shard, ShardRouter, router
+from app.tasks import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[AsyncSession, Shard, Any], Awaitable[Result[Any, Any]]]
+
+
+class ShardRelay:
+    """
+    Delivers the `ShardMessage` outboxes of the shards: every message is
+    applied on its target shard by that shard's ledger writer, in the order
+    it was written, by the handler registered for its kind. The target keeps
+    the id of the last message applied from each shard in `ShardInbox`, in
+    the transaction applying it, so that a message delivered again after a
+    failure is skipped. Delivered messages are then deleted.
+
+    `notify` schedules the delivery of a shard's outbox, after a write that
+    may have added to it. Every `interval` seconds all outboxes are checked,
+    for messages whose delivery failed or was interrupted. Nothing runs with
+    a single shard.
+    """
+
+    def __init__(
+        self, router: ShardRouter, interval: float = 1.0, batch_size: int = 100
+    ):
+        self.router = router
+        self.interval = interval
+        self.batch_size = batch_size
+        self.handlers: dict[str, Handler] = {}
+        self.delivered = 0
+        self.failures = 0
+        self._pending: set[int] = set()
+        self._wakeup: asyncio.Event | None = None
+        self._task = BackgroundTask(self._run)
+        self._locks: dict[int, asyncio.Lock] = {}
+
+    def handles(self, kind: str) -> Callable[[Handler], Handler]:
+        """Register the decorated coroutine function as the `kind` handler."""
+
+        def register(handler: Handler) -> Handler:
+            self.handlers[kind] = handler
+            return handler
+
+        return register
+
+    def notify(self, shard: Shard) -> None:
+        if len(self.router) == 1:
+            return
+        self._pending.add(shard.index)
+        self._ensure_running().set()
+
+    async def deliver(self, shard: Shard) -> int:
+        """Deliver everything in the shard's outbox, return the count."""
+        lock = self._locks.setdefault(shard.index, asyncio.Lock())
+        delivered = 0
+        async with lock:
+            while messages := await self._outbox(shard):
+                for message in messages:
+                    await self._deliver_one(shard, message)
+                    delivered += 1
+                last_id = messages[-1].id
+                await shard.ledger.submit(
+                    lambda session: _delete_delivered(session, last_id)
+                )
+        self.delivered += delivered
+        return delivered
+
+    async def close(self) -> None:
+        self._task.cancel()
+
+    def stats(self) -> dict[str, int]:
+        return {"delivered": self.delivered, "failures": self.failures}
+
+    def _ensure_running(self) -> asyncio.Event:
+        if self._task.ensure_running():
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except TimeoutError:
+                self._pending.update(shard.index for shard in self.router.shards)
+            self._wakeup.clear()
+            pending, self._pending = self._pending, set()
+            for index in sorted(pending):
+                try:
+                    await self.deliver(self.router.shards[index])
+                except Exception:
+                    # Retried on the next round, messages stay in order
+                    self.failures += 1
+                    logger.exception("Delivering the outbox of shard %d failed", index)
+
+    async def _outbox(self, shard: Shard) -> list[ShardMessage]:
+        async with shard.database.read_session_factory() as session:
+            qry = select(ShardMessage).order_by(ShardMessage.id).limit(self.batch_size)
+            return list(await session.scalars(qry))
+
+    async def _deliver_one(self, source: Shard, message: ShardMessage) -> None:
+        target = self.router.shards[message.shard]
+
+        async def apply(session: AsyncSession):
+            applied = await session.scalar(
+                select(ShardInbox.message_id).where(ShardInbox.source == source.index)
+            )
+            if applied is not None and message.id <= applied:
+                return Ok(None)
+            result = await self.handlers[message.kind](session, target, message.payload)
+            if result.is_ok:
+                stmt = sqlite_insert(ShardInbox).values(
+                    source=source.index, message_id=message.id
+                )
+                await session.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=[ShardInbox.source],
+                        set_={"message_id": stmt.excluded.message_id},
+                    )
+                )
+            return result
+
+        result = await target.ledger.submit(apply)
+        if result.is_err:
+            raise RuntimeError(
+                f"Message {message.id} of shard {source.index} failed on shard "
+                f"{target.index}: {result.unwrap_err()!r}"
+            )
+
+
+async def _delete_delivered(session: AsyncSession, last_id: int):
+    await session.execute(delete(ShardMessage).where(ShardMessage.id <= last_id))
+    return Ok(None)
+
+
+shard_relay = ShardRelay(router)
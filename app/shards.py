@@ -0,0 +1,156 @@
+"""
+Users are spread over N SQLite databases, the shards, each with its own
+writer, so that writes on different shards do not wait for each other.
+
+A user's balance, ledger entries and transfers live on their home shard,
+found from their id: ids map to one of `SHARD_BUCKETS` buckets, and buckets
+to shards. The bucket map is kept next to the first database (`db.sqlite`
+-> `db.shards.json`), written by `app.rebalance_shards`. Without one, there
+is a single shard: the database the app always used.
+
+Every shard also has a row for every user, with a zero balance on the shards
+that are not their home, so that usernames can be joined and receivers
+checked locally. A transfer between users of different shards has a copy on
+each of them, with the same id: the sender's shard holds the amount, the
+receiver's shard copy is `remote_hold`, and changes made on one side reach
+the other through `ShardMessage` outboxes.
+"""
+
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from sqlalchemy import ColumnElement, true
+from sqlalchemy.engine import make_url
+
+from app.db import DATABASE_URL, Database, database, open_database
+from app.services.ledger import LedgerWriter, ledger, ledger_writer
+
+SHARD_BUCKETS = 4096
+
+
+def shard_url(url: str, index: int) -> str:
+    """URL of shard `index` of the database at `url`, `db.shard1.sqlite`..."""
+    if index == 0:
+        return url
+    url = make_url(url)
+    path = Path(url.database)
+    path = path.with_suffix(f".shard{index}{path.suffix}")
+    return url.set(database=str(path)).render_as_string(hide_password=False)
+
+
+def shard_map_path(url: str = DATABASE_URL) -> Path:
+    return Path(make_url(url).database).with_suffix(".shards.json")
+
+
+def shard_urls(url: str = DATABASE_URL) -> list[str]:
+    """URLs of every shard of the database at `url`, as per its bucket map."""
+    path = shard_map_path(url)
+    if not path.exists():
+        return [url]
+    count = max(json.loads(path.read_text())["buckets"]) + 1
+    return [shard_url(url, index) for index in range(count)]
+
+
+@dataclass
+class Shard:
+    index: int
+    database: Database
+    ledger: LedgerWriter
+
+    @property
+    def label(self) -> str:
+        # Suffix of the shard's metric labels, none for the first one
+        return f"@{self.index}" if self.index else ""
+
+
+@dataclass
+class ShardRouter:
+    """
+    Maps user ids to shards. `buckets[user_id % SHARD_BUCKETS]` is the index
+    of the user's home shard. Ids of new transfers are above `first_id`.
+    """
+
+    shards: list[Shard]
+    buckets: list[int] = field(default_factory=lambda: [0] * SHARD_BUCKETS)
+    first_id: int = 1
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def shard_for(self, user_id: int) -> Shard:
+        return self.shards[self.buckets[user_id % SHARD_BUCKETS]]
+
+    def is_home(self, shard: Shard, user_id: int) -> bool:
+        return self.buckets[user_id % SHARD_BUCKETS] == shard.index
+
+    def lives_on(
+        self, shard: Shard, user_id: ColumnElement[int]
+    ) -> ColumnElement[bool]:
+        """SQL condition: the user of the `user_id` column lives on `shard`."""
+        if len(self.shards) == 1:
+            return true()
+        buckets = [
+            bucket for bucket, index in enumerate(self.buckets) if index == shard.index
+        ]
+        return (user_id % SHARD_BUCKETS).in_(buckets)
+
+    def transfer_ids(self, shard: Shard, last_id: int, count: int) -> range:
+        """
+        Ids for `count` new transfers on `shard`, after its `last_id`: shards
+        take every N-th id, so the copies of a transfer on other shards never
+        collide with their own transfers.
+        """
+        last_id = max(last_id, self.first_id - 1)
+        first = last_id + 1 + (shard.index - last_id - 1) % len(self.shards)
+        return range(first, first + count * len(self.shards), len(self.shards))
+
+    async def close(self) -> None:
+        """Commit the writes already queued on every shard."""
+        for shard in self.shards:
+            await shard.ledger.close()
+
+
+def rebalanced_buckets(buckets: list[int], count: int) -> list[int]:
+    """
+    The bucket map spread evenly over `count` shards, moving as few buckets
+    as possible: adding a shard only moves buckets to the new one.
+    """
+    quota = [
+        SHARD_BUCKETS // count + (index < SHARD_BUCKETS % count)
+        for index in range(count)
+    ]
+    rebalanced, moving = [], []
+    for bucket, index in enumerate(buckets):
+        if index < count and quota[index]:
+            quota[index] -= 1
+            rebalanced.append(index)
+        else:
+            rebalanced.append(None)
+            moving.append(bucket)
+    spare = [index for index in range(count) for _ in range(quota[index])]
+    for bucket, index in zip(moving, spare):
+        rebalanced[bucket] = index
+    return rebalanced
+
+
+def load_router() -> ShardRouter:
+    """The shards of the app's database, as described by its bucket map."""
+    shards = [Shard(0, database, ledger)]
+    path = shard_map_path()
+    if not path.exists():
+        return ShardRouter(shards)
+    shard_map = json.loads(path.read_text())
+    for index, url in enumerate(shard_urls()[1:], start=1):
+        shard_database = open_database(url, f"@{index}")
+        shards.append(
+            Shard(
+                index,
+                shard_database,
+                ledger_writer(shard_database.write_session_factory),
+            )
+        )
+    return ShardRouter(shards, shard_map["buckets"], shard_map["first_id"])
+
+
+router = load_router()
@@ -0,0 +1,42 @@
+import asyncio
+import contextvars
+from typing import Any, Callable, Coroutine
+
+
+class BackgroundTask:
+    """
+    The task of a long-lived service, running `run()`. It is started on the
+    running loop, and again on a later one, e.g. from one test to the next,
+    when the loop it ran on is gone. It runs in an empty context: on behalf
+    of every request, not of the one that happened to start it.
+    """
+
+    def __init__(self, run: Callable[[], Coroutine[Any, Any, None]]):
+        self.run = run
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def ensure_running(self) -> bool:
+        """
+        Start the task unless it is running on this loop, return whether it
+        was started. It only runs from the loop's next iteration on: set up
+        the state it starts from after a True.
+        """
+        loop = asyncio.get_running_loop()
+        if self.running and self._task.get_loop() is loop:
+            return False
+        self._task = loop.create_task(self.run(), context=contextvars.Context())
+        return True
+
+    def cancel(self) -> None:
+        if self.running:
+            self._task.cancel()
+        self._task = None
+
+    async def join(self) -> None:
+        """Wait for the task to end by itself."""
+        if self._task is not None:
+            await self._task
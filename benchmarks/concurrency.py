@@ -0,0 +1,141 @@
+"""
+Throughput of a read/write request mix under concurrency, for each engine
+profile in `app.db.PROFILES`. Every profile runs in fresh worker processes
+sharing one database file, like uvicorn workers would.
+
+    PYTHONPATH=. python -m benchmarks.concurrency --processes 4 --clients 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+USERS = 1_000
+
+
+def setup_database():
+    from sqlalchemy import insert
+
+    from app.db import engine
+    from app.models import Base, User
+
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(User),
+            [
+                {"id": i, "username": f"user_{i}", "balance": 1_000}
+                for i in range(1, USERS + 1)
+            ],
+        )
+
+
+async def run_clients(clients, duration, write_ratio, seed):
+    from httpx import ASGITransport, AsyncClient
+
+    from app.main import app
+
+    app.state.limiter.enabled = False
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def client_loop(client, rnd):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            headers = {"user_id": str(rnd.randint(1, USERS))}
+            started = time.perf_counter()
+            if rnd.random() < write_ratio:
+                response = await client.post(
+                    "/deposit", params={"amount": "1.00"}, headers=headers
+                )
+            else:
+                response = await client.get("/transfers", headers=headers)
+            latencies.append(time.perf_counter() - started)
+            errors += response.status_code >= 500
+
+    transport = ASGITransport(app=app, raise_app_exceptions=False)
+    async with AsyncClient(transport=transport, base_url="http://bench") as client:
+        await asyncio.gather(
+            *(client_loop(client, random.Random(seed + i)) for i in range(clients))
+        )
+    return {"latencies": latencies, "errors": errors}
+
+
+def worker(args):
+    result = asyncio.run(
+        run_clients(args.clients, args.duration, args.write_ratio, args.seed)
+    )
+    json.dump(result, sys.stdout)
+
+
+def run_profile(name, args):
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "DB_PROFILE": name,
+            "DATABASE_URL": f"sqlite:///{directory}/bench.sqlite",
+        }
+        setup = [sys.executable, "-m", "benchmarks.concurrency", "--setup"]
+        subprocess.run(setup, env=env, check=True)
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.concurrency",
+            "--worker",
+            f"--clients={args.clients}",
+            f"--duration={args.duration}",
+            f"--write-ratio={args.write_ratio}",
+        ]
+        processes = [
+            subprocess.Popen(
+                [*command, f"--seed={i * 1000}"], env=env, stdout=subprocess.PIPE
+            )
+            for i in range(args.processes)
+        ]
+        results = [json.loads(process.communicate()[0]) for process in processes]
+
+    latencies = sorted(ms for r in results for ms in r["latencies"])
+    errors = sum(r["errors"] for r in results)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name:<12} {len(latencies) / args.duration:9.0f} req/s"
+        f"  p50 {quantiles[49] * 1000:7.2f} ms  p99 {quantiles[98] * 1000:7.2f} ms"
+        f"  5xx {errors}"
+    )
+
+
+def main():
+    from app.db import PROFILES
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=16, help="per process")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--write-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", action="append", choices=sorted(PROFILES))
+    parser.add_argument("--setup", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.setup:
+        return setup_database()
+    if args.worker:
+        return worker(args)
+    print(
+        f"{args.processes} processes x {args.clients} clients,"
+        f" {args.write_ratio:.0%} writes, {args.duration:.0f}s"
+    )
+    for name in args.profile or ["legacy", "production"]:
+        run_profile(name, args)
+
+
+if __name__ == "__main__":
+    main()
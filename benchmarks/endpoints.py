@@ -0,0 +1,520 @@
+"""
+Throughput, latency quantiles and SQL statements per request of every route,
+on a bulk seeded database, in process (httpx over ASGI) or against a uvicorn
+worker. Results can be saved as a JSON baseline and compared with later runs.
+
+The event routes, `GET /events` and `WS /events/ws`, are measured from
+connecting to the first event: a deposit by the subscribed user, made once
+connected, and its `balance` event pushed back. `/docs`, `/redoc` and
+`/openapi.json` are not measured, see `benchmarks.startup` for the schema.
+
+    PYTHONPATH=. python -m benchmarks.endpoints --transfers 10000000 --save base.json
+    PYTHONPATH=. python -m benchmarks.endpoints --reuse --compare base.json
+    PYTHONPATH=. python -m benchmarks.endpoints --reuse --mode uvicorn --only balance
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable
+
+
+@dataclass
+class Fixtures:
+    """Ids the scenarios draw their requests from."""
+
+    users: int
+    # (transfer id, sender id) of a random sample of transfers
+    transfers: list[tuple[int, int]]
+    # Pending transfer ids by receiver, taken by accepts and rejects
+    pending: dict[int, list[int]] = field(default_factory=dict)
+
+    def take_pending(self, rnd: random.Random, count: int = 1):
+        while self.pending:
+            receiver_id = rnd.choice(list(self.pending))
+            ids = self.pending[receiver_id]
+            taken, self.pending[receiver_id] = ids[:count], ids[count:]
+            if not self.pending[receiver_id]:
+                del self.pending[receiver_id]
+            if taken:
+                return receiver_id, taken
+        return None
+
+
+def _user(rnd, fixtures):
+    return {"user_id": str(rnd.randint(1, fixtures.users))}
+
+
+def _get(path, **params):
+    return lambda rnd, fixtures: ("GET", path, params, _user(rnd, fixtures))
+
+
+def _get_transfer(rnd, fixtures):
+    transfer_id, sender_id = rnd.choice(fixtures.transfers)
+    return "GET", f"/transfers/{transfer_id}", {}, {"user_id": str(sender_id)}
+
+
+# Transfers per bulk request, a payout run's worth
+BULK_SIZE = 100
+
+
+def _create_transfers(count):
+    # A cent each, so that senders do not run out of funds
+    def request(rnd, fixtures):
+        sender_id = rnd.randint(1, fixtures.users)
+        receivers = [rnd.randint(1, fixtures.users - 1) for _ in range(count)]
+        transfers = [
+            {"receiver_id": receiver_id + (receiver_id >= sender_id), "amount": "0.01"}
+            for receiver_id in receivers
+        ]
+        if count == 1:
+            path, body = "/transfers", transfers[0]
+        else:
+            path, body = "/transfers/bulk", {"transfers": transfers}
+        return "POST", path, {"json": body}, {"user_id": str(sender_id)}
+
+    return request
+
+
+def _decide(action):
+    def request(rnd, fixtures):
+        if (taken := fixtures.take_pending(rnd)) is None:
+            return None
+        receiver_id, [transfer_id] = taken
+        path = f"/transfers/{transfer_id}/{action}"
+        return "POST", path, {}, {"user_id": str(receiver_id)}
+
+    return request
+
+
+def _decide_batch(action):
+    def request(rnd, fixtures):
+        if (taken := fixtures.take_pending(rnd, 10)) is None:
+            return None
+        receiver_id, transfer_ids = taken
+        path = f"/transfers/batch/{action}"
+        body = {"transfer_ids": transfer_ids}
+        return "POST", path, {"json": body}, {"user_id": str(receiver_id)}
+
+    return request
+
+
+def _post(path, **params):
+    return lambda rnd, fixtures: ("POST", path, params, _user(rnd, fixtures))
+
+
+def _subscribe(path):
+    return lambda rnd, fixtures: ("EVENTS", path, {}, _user(rnd, fixtures))
+
+
+# Every route of `app.main`, returning None once out of data
+SCENARIOS: dict[str, Callable] = {
+    "GET /transfers": _get("/transfers"),
+    "GET /transfers?page=50": _get("/transfers", page=50),
+    "GET /transfers?status=pending&include_total=false": _get(
+        "/transfers", status="pending", include_total="false"
+    ),
+    "GET /transfers/{id}": _get_transfer,
+    "GET /transfers/export": _get("/transfers/export", format="ndjson"),
+    "POST /transfers": _create_transfers(1),
+    f"POST /transfers/bulk ({BULK_SIZE} transfers)": _create_transfers(BULK_SIZE),
+    "POST /transfers/{id}/accept": _decide("accept"),
+    "POST /transfers/{id}/reject": _decide("reject"),
+    "POST /transfers/batch/accept": _decide_batch("accept"),
+    "POST /transfers/batch/reject": _decide_batch("reject"),
+    "POST /deposit": _post("/deposit", amount="1.00"),
+    "POST /withdraw": _post("/withdraw", amount="1.00"),
+    "GET /balance": _get("/balance"),
+    "GET /leaderboard/top-transfers?by=count": _get(
+        "/leaderboard/top-transfers", by="count"
+    ),
+    "GET /leaderboard/top-transfers?by=amount": _get(
+        "/leaderboard/top-transfers", by="amount"
+    ),
+    "GET /events (connect + first event)": _subscribe("/events"),
+    "WS /events/ws (connect + first event)": _subscribe("/events/ws"),
+    "GET /metrics": _get("/metrics"),
+}
+
+# Seconds to wait for an event, after which the subscription counts as a 504
+EVENT_TIMEOUT = 10
+
+
+async def first_event(client, subscribe, path, headers) -> int:
+    """
+    Subscribe to the user's events, deposit once connected and read until
+    the deposit's `balance` event, return the subscription's status.
+    """
+    async with subscribe(path, headers) as (status, messages):
+        if status >= 400:
+            return status
+        await client.post("/deposit", params={"amount": "1.00"}, headers=headers)
+        async for message in messages:
+            if b"balance" in message:
+                return status
+    return 504
+
+
+def asgi_subscriber(app):
+    """
+    Event streams straight over ASGI: httpx's ASGI transport only returns
+    a response once it is complete, and has no WebSockets.
+    """
+
+    @contextlib.asynccontextmanager
+    async def subscribe(path, headers):
+        websocket = path.endswith("/ws")
+        scope = {
+            "type": "websocket" if websocket else "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "ws" if websocket else "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+        incoming.put_nowait(
+            {"type": "websocket.connect"}
+            if websocket
+            else {"type": "http.request", "body": b"", "more_body": False}
+        )
+
+        async def messages():
+            while True:
+                message = await outgoing.get()
+                if message["type"] not in ("http.response.body", "websocket.send"):
+                    return
+                yield message.get("body") or message.get("text", "").encode()
+
+        task = asyncio.create_task(app(scope, incoming.get, outgoing.put))
+        try:
+            # The response's start, or a WebSocket's accept or refusal
+            start = await outgoing.get()
+            accepted = start["type"] == "websocket.accept"
+            yield start.get("status", 101 if accepted else 403), messages()
+        finally:
+            incoming.put_nowait(
+                {"type": "websocket.disconnect", "code": 1000}
+                if websocket
+                else {"type": "http.disconnect"}
+            )
+            await asyncio.wait([task], timeout=EVENT_TIMEOUT)
+            task.cancel()
+
+    return subscribe
+
+
+def http_subscriber(client, base_url):
+    """Event streams from a server, WebSockets with uvicorn's `websockets`."""
+
+    @contextlib.asynccontextmanager
+    async def subscribe(path, headers):
+        if not path.endswith("/ws"):
+            async with client.stream("GET", path, headers=headers) as response:
+                yield response.status_code, response.aiter_bytes()
+            return
+
+        from websockets.asyncio.client import connect
+        from websockets.exceptions import InvalidStatus
+
+        url = base_url.replace("http", "ws", 1) + path
+        try:
+            connection = await connect(url, additional_headers=headers)
+        except InvalidStatus as exc:
+            yield exc.response.status_code, None
+            return
+        try:
+            yield 101, (message.encode() async for message in connection)
+        finally:
+            await connection.close()
+
+    return subscribe
+
+
+def setup_database(args):
+    from sqlalchemy import func, select
+
+    from app.db import engine, session_factory
+    from app.models import Base, User
+    from app.seed import bulk_seed
+
+    Base.metadata.create_all(engine)
+    with session_factory() as session:
+        seeded = session.scalar(select(func.count(User.id)))
+        if not (args.reuse and seeded):
+            started = time.perf_counter()
+            bulk_seed(args.users, args.transfers, args.seed)
+            print(
+                f"seeded {args.users} users and {args.transfers} transfers"
+                f" in {time.perf_counter() - started:.1f}s"
+            )
+
+
+def load_fixtures(args) -> Fixtures:
+    from sqlalchemy import func, select
+
+    from app.db import session_factory
+    from app.models import Transfer, TransferStatusEnum, User
+
+    rnd = random.Random(args.seed)
+    with session_factory() as session:
+        users = session.scalar(select(func.max(User.id)))
+        last_id = session.scalar(select(func.max(Transfer.id))) or 0
+        sample = rnd.sample(range(1, last_id + 1), min(10_000, last_id))
+        transfers = session.execute(
+            select(Transfer.id, Transfer.sender_id).where(Transfer.id.in_(sample))
+        ).all()
+        pending = defaultdict(list)
+        rows = session.execute(
+            select(Transfer.id, Transfer.receiver_id)
+            .where(Transfer.status == TransferStatusEnum.PENDING)
+            .order_by(Transfer.id.desc())
+            .limit(100_000)
+        )
+        for transfer_id, receiver_id in rows:
+            pending[receiver_id].append(transfer_id)
+    return Fixtures(users, [tuple(row) for row in transfers], dict(pending))
+
+
+def statements(metrics: str) -> float:
+    """Statements run so far, by all engines, from a /metrics page."""
+    return sum(
+        float(line.rsplit(" ", 1)[1])
+        for line in metrics.splitlines()
+        if line.startswith("db_statement_duration_seconds_count")
+    )
+
+
+async def run_scenario(client, subscribe, name, fixtures, args) -> dict:
+    make_request = SCENARIOS[name]
+    latencies, statuses = [], Counter()
+    before = statements((await client.get("/metrics")).text)
+    started = time.perf_counter()
+    deadline = started + args.duration
+
+    async def client_loop(rnd):
+        while time.perf_counter() < deadline:
+            if (request := make_request(rnd, fixtures)) is None:
+                return
+            method, path, params, headers = request
+            params = dict(params)
+            body = {"json": params.pop("json")} if "json" in params else {}
+            sent = time.perf_counter()
+            if method == "EVENTS":
+                try:
+                    status = await asyncio.wait_for(
+                        first_event(client, subscribe, path, headers), EVENT_TIMEOUT
+                    )
+                except TimeoutError:
+                    status = 504
+            else:
+                response = await client.request(
+                    method, path, params=params, headers=headers, **body
+                )
+                status = response.status_code
+            latencies.append(time.perf_counter() - sent)
+            statuses[status] += 1
+
+    await asyncio.gather(
+        *(
+            client_loop(random.Random(f"{args.seed}-{name}-{i}"))
+            for i in range(args.concurrency)
+        )
+    )
+    elapsed = time.perf_counter() - started
+    after = statements((await client.get("/metrics")).text)
+
+    if len(latencies) < 2:
+        return {"requests": len(latencies), "statuses": dict(statuses)}
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "statements_per_request": (after - before) / len(latencies),
+        "errors": sum(n for status, n in statuses.items() if status >= 500),
+        "statuses": {str(status): n for status, n in sorted(statuses.items())},
+    }
+
+
+async def run_in_process(names, fixtures, args) -> dict:
+    from httpx import ASGITransport, AsyncClient
+
+    from app.main import app
+    from app.shards import router
+
+    app.state.limiter.enabled = False
+    transport = ASGITransport(app=app, raise_app_exceptions=False)
+    subscribe = asgi_subscriber(app)
+    # Under the app's lifespan, like a uvicorn worker: it starts the event
+    # dispatcher, and stops it, the relay and every shard's ledger writer
+    # (`router.close()`) on the way out, then every shard's engines are disposed of
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=transport, base_url="http://bench") as client:
+            results = {}
+            for name in names:
+                results[name] = await run_scenario(
+                    client, subscribe, name, fixtures, args
+                )
+                report(name, results[name])
+    for shard in router.shards:
+        await shard.database.write_engine.dispose()
+        await shard.database.read_engine.dispose()
+    return results
+
+
+async def run_against_uvicorn(names, fixtures, args) -> dict:
+    from httpx import AsyncClient, Limits
+
+    from app.dependencies.rate_limit import RATE_LIMITS
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    # Limits out of the way, the rate limiter's own cost is still measured
+    env = {
+        **os.environ,
+        **{f"RATE_LIMIT_{scope.upper()}": "1000000/second" for scope in RATE_LIMITS},
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", f"--port={port}"]
+        + ["--log-level=warning", "--no-access-log"],
+        env=env,
+    )
+    limits = Limits(max_connections=args.concurrency)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        # Streams on clients of their own, held open while the deposits are sent
+        async with (
+            AsyncClient(base_url=base_url, limits=limits) as client,
+            AsyncClient(base_url=base_url, limits=limits) as streams,
+        ):
+            for _ in range(100):
+                try:
+                    await client.get("/metrics")
+                    break
+                except OSError:
+                    await asyncio.sleep(0.1)
+            subscribe = http_subscriber(streams, base_url)
+            results = {}
+            for name in names:
+                results[name] = await run_scenario(
+                    client, subscribe, name, fixtures, args
+                )
+                report(name, results[name])
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def report(name, result):
+    if "rps" not in result:
+        print(f"{name:<52} {result['requests']:>8} requests, out of data")
+        return
+    print(
+        f"{name:<52} {result['rps']:8.0f} req/s"
+        f"  p50 {result['p50_ms']:7.2f}  p95 {result['p95_ms']:7.2f}"
+        f"  p99 {result['p99_ms']:7.2f} ms"
+        f"  {result['statements_per_request']:5.1f} SQL/req  5xx {result['errors']}"
+    )
+
+
+def compare(results, baseline, tolerance) -> list[str]:
+    """Scenarios slower than the baseline by more than `tolerance`."""
+    print(f"\ncompared with the baseline of {baseline['meta']['created_at']}")
+    regressions = []
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if not base or "rps" not in base or "rps" not in result:
+            continue
+        rps = result["rps"] / base["rps"] - 1
+        p95 = result["p95_ms"] / base["p95_ms"] - 1
+        statements_delta = (
+            result["statements_per_request"] - base["statements_per_request"]
+        )
+        regressed = rps < -tolerance or p95 > tolerance or statements_delta >= 1
+        print(
+            f"{name:<52} req/s {rps:+7.1%}  p95 {p95:+7.1%}"
+            f"  SQL/req {statements_delta:+5.1f}" + ("  REGRESSION" * regressed)
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default="./bench.sqlite")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--transfers", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reuse", action="store_true", help="keep a seeded --db")
+    parser.add_argument(
+        "--mode", choices=["in-process", "uvicorn"], default="in-process"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0, help="per route")
+    parser.add_argument("--only", action="append", help="routes containing this")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="of a regression, 0.2 is 20%%"
+    )
+    args = parser.parse_args()
+
+    # The engines are created at import time, from the environment
+    os.environ["DATABASE_URL"] = f"sqlite:///{args.db}"
+    setup_database(args)
+    fixtures = load_fixtures(args)
+    names = [
+        name
+        for name in SCENARIOS
+        if not args.only or any(part in name for part in args.only)
+    ]
+    run = run_against_uvicorn if args.mode == "uvicorn" else run_in_process
+    print(f"{args.mode}, {args.concurrency} clients, {args.duration:g}s per route")
+    results = asyncio.run(run(names, fixtures, args))
+
+    if args.save:
+        meta = {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "mode": args.mode,
+            "db_profile": os.environ.get("DB_PROFILE", "production"),
+            "python": platform.python_version(),
+            **{
+                key: getattr(args, key)
+                for key in ["users", "transfers", "seed", "concurrency", "duration"]
+            },
+        }
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(f"{len(regressions)} regression(s)")
+
+
+if __name__ == "__main__":
+    main()
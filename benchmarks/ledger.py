@@ -0,0 +1,75 @@
+"""
+Deposit throughput and latency through the ledger writer, with group commit
+and with one commit per operation (`max_batch=1`, no delay).
+
+    PYTHONPATH=. python -m benchmarks.ledger --clients 1 8 64
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+USERS = 1_000
+
+
+async def run_clients(clients, duration):
+    from decimal import Decimal
+
+    from app.services.business_logic import deposit_balance
+
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def client_loop(user_id):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            (await deposit_balance(user_id, Decimal(1))).unwrap()
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(client_loop(i % USERS + 1) for i in range(clients)))
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.sqlite"
+
+    from sqlalchemy import insert
+
+    from app.db import engine
+    from app.models import Base, User
+    from app.services.ledger import ledger
+
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(User),
+            [{"username": f"user_{i}", "balance": 0} for i in range(1, USERS + 1)],
+        )
+
+    modes = {
+        "per-op commit": (1, 0.0),
+        "group commit": (ledger.max_batch, ledger.max_delay),
+    }
+    print(f"{'mode':<14} {'clients':>7} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for clients in args.clients:
+        for name, (max_batch, max_delay) in modes.items():
+            ledger.max_batch, ledger.max_delay = max_batch, max_delay
+            latencies = asyncio.run(run_clients(clients, args.duration))
+            quantiles = statistics.quantiles(latencies, n=100)
+            print(
+                f"{name:<14} {clients:>7} {len(latencies) / args.duration:>9.0f}"
+                f" {quantiles[49] * 1000:>8.2f} {quantiles[98] * 1000:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Query and serialization time of a page of transfers, through ORM objects and
+`TransferPageValidator` and through projected rows and `transfer_page_json`.
+
+    PYTHONPATH=. python -m benchmarks.serialization --limit 500
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def setup_database(transfers):
+    from sqlalchemy import insert
+
+    from app.db import engine
+    from app.models import Base, Transfer, User
+
+    Base.metadata.create_all(engine)
+    start = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": i, "username": f"user_{i}"} for i in (1, 2)])
+        conn.execute(
+            insert(Transfer),
+            [
+                {
+                    "sender_id": 1 + i % 2,
+                    "receiver_id": 2 - i % 2,
+                    "amount": i,
+                    "created_at": start + timedelta(seconds=i),
+                    "updated_at": start + timedelta(seconds=i),
+                }
+                for i in range(transfers)
+            ],
+        )
+
+
+async def orm_page(session, user, limit):
+    from app.services.pydantic_models import TransferPageValidator
+    from app.services.selectors import list_transfers
+
+    transfers = await list_transfers(session, user, None, offset=0, limit=limit)
+    page = {"page": 1, "limit": limit, "transfers": transfers, "has_more": True}
+    page.update(total_transfers=None, next_cursor=None)
+    return TransferPageValidator.model_validate(page).model_dump_json().encode()
+
+
+async def rows_page(session, user, limit):
+    from app.services.pydantic_models import transfer_dict, transfer_page_json
+    from app.services.selectors import list_transfer_rows
+
+    rows = await list_transfer_rows(session, user, None, offset=0, limit=limit)
+    page = {"page": 1, "limit": limit, "transfers": [transfer_dict(r) for r in rows]}
+    page.update(total_transfers=None, next_cursor=None, has_more=True)
+    return transfer_page_json.dump_json(page)
+
+
+async def measure(paths, limit, runs):
+    from app.db import read_session_factory
+    from app.services.pydantic_models import User
+
+    user = User(id=1, username="user_1")
+    bodies, timings = {}, {name: [] for name in paths}
+    for _ in range(runs):
+        for name, path in paths.items():
+            # A new session per run, like a request
+            async with read_session_factory() as session:
+                started = time.perf_counter()
+                bodies[name] = await path(session, user, limit)
+                timings[name].append(time.perf_counter() - started)
+    return bodies, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.sqlite"
+    setup_database(args.limit * 2)
+
+    paths = {"orm + validator": orm_page, "rows + adapter": rows_page}
+    bodies, timings = asyncio.run(measure(paths, args.limit, args.runs))
+    assert len(set(bodies.values())) == 1, "the paths serialize differently"
+
+    print(f"limit={args.limit}, median of {args.runs} runs")
+    for name, runs in timings.items():
+        print(f"{name:<16} {statistics.median(runs) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
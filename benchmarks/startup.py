@@ -0,0 +1,193 @@
+"""
+Cold start of a worker, over fresh processes: the time to import `app.main`,
+which builds the app, with every module's share from `python -X importtime`,
+and the time to get the OpenAPI schema, loaded from its artifact or built.
+Results can be saved as a JSON baseline and compared with later runs, and
+checked against a budget: the exit status is non-zero when over it.
+
+    PYTHONPATH=. python -m benchmarks.startup --budget-ms 1500
+    PYTHONPATH=. python -m benchmarks.startup --save base.json
+    PYTHONPATH=. python -m benchmarks.startup --compare base.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timezone
+
+# Run in each fresh process, prints the phases in ms as JSON
+CHILD = """
+import json, time
+started = time.perf_counter()
+from app.main import openapi
+imported = time.perf_counter()
+openapi.encoded()
+done = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "openapi_ms": (done - imported) * 1000,
+    "openapi_loaded": openapi.loaded,
+}))
+"""
+
+
+def run_child(env, importtime: bool) -> tuple[dict, str]:
+    command = [sys.executable] + ["-X", "importtime"] * importtime + ["-c", CHILD]
+    done = subprocess.run(command, env=env, capture_output=True, text=True)
+    if done.returncode:
+        sys.exit(done.stderr)
+    return json.loads(done.stdout.splitlines()[-1]), done.stderr
+
+
+def parse_importtime(output: str) -> dict[str, tuple[float, float]]:
+    """Self and cumulative import time in ms of every module imported."""
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        modules[name.strip()] = (int(self_us) / 1000, int(cumulative_us) / 1000)
+    return modules
+
+
+def profile(args) -> dict:
+    env = {**os.environ, "PYTHONPATH": os.getcwd()}
+    # The engines are created at import time, nothing connects
+    env["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/startup.sqlite"
+    if args.artifact_dir:
+        env["OPENAPI_ARTIFACT_DIR"] = args.artifact_dir
+
+    # Timed apart from the import profile, which slows imports down
+    phases = [run_child(env, importtime=False)[0] for _ in range(args.runs)]
+    imports = defaultdict(list)
+    for _ in range(args.runs):
+        for name, times in parse_importtime(run_child(env, importtime=True)[1]).items():
+            imports[name].append(times)
+
+    def median(values):
+        return statistics.median(values) if values else 0.0
+
+    modules = {
+        name: {
+            "self_ms": median([self_ms for self_ms, _ in times]),
+            "cumulative_ms": median([cumulative for _, cumulative in times]),
+        }
+        for name, times in imports.items()
+    }
+    packages = defaultdict(float)
+    for name, times in modules.items():
+        packages[name.split(".")[0]] += times["self_ms"]
+    result = {
+        "import_ms": median([phase["import_ms"] for phase in phases]),
+        "openapi_ms": median([phase["openapi_ms"] for phase in phases]),
+        "openapi_loaded": all(phase["openapi_loaded"] for phase in phases),
+        "app_modules": {
+            name: times
+            for name, times in sorted(modules.items())
+            if name == "app" or name.startswith("app.")
+        },
+        "packages_ms": dict(sorted(packages.items(), key=lambda item: -item[1])),
+    }
+    result["total_ms"] = result["import_ms"] + result["openapi_ms"]
+    return result
+
+
+def report(result, top):
+    openapi = "loaded from its artifact" if result["openapi_loaded"] else "built"
+    print(f"import app.main   {result['import_ms']:8.1f} ms")
+    print(f"OpenAPI schema    {result['openapi_ms']:8.1f} ms, {openapi}")
+    print(f"total             {result['total_ms']:8.1f} ms")
+
+    print("\napp modules, module level code (app construction) and imports")
+    print(f"{'':<40} {'self':>9} {'cumulative':>12}")
+    app_modules = sorted(
+        result["app_modules"].items(), key=lambda item: -item[1]["self_ms"]
+    )
+    for name, times in app_modules:
+        print(f"{name:<40} {times['self_ms']:6.1f} ms {times['cumulative_ms']:9.1f} ms")
+
+    print(f"\ntop {top} packages, all their modules")
+    for name, self_ms in list(result["packages_ms"].items())[:top]:
+        print(f"{name:<40} {self_ms:6.1f} ms")
+
+
+def compare(result, baseline, tolerance, min_ms) -> list[str]:
+    """
+    Phases and app modules slower than the baseline by more than `tolerance`
+    and `min_ms`, process start times being noisy.
+    """
+    print(f"\ncompared with the baseline of {baseline['meta']['created_at']}")
+    base = baseline["results"]
+    timings = {
+        phase: (result[phase], base[phase])
+        for phase in ["import_ms", "openapi_ms", "total_ms"]
+    }
+    for name, times in result["app_modules"].items():
+        if name in base["app_modules"]:
+            timings[name] = (times["self_ms"], base["app_modules"][name]["self_ms"])
+    regressions = []
+    for name, (value, base_value) in timings.items():
+        delta = value - base_value
+        regressed = delta > min_ms and delta > base_value * tolerance
+        if regressed or name.endswith("_ms"):
+            print(
+                f"{name:<40} {base_value:8.1f} -> {value:8.1f} ms"
+                + ("  REGRESSION" * regressed)
+            )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="processes per phase")
+    parser.add_argument("--top", type=int, default=15, help="packages shown")
+    parser.add_argument(
+        "--artifact-dir", help="OPENAPI_ARTIFACT_DIR of the workers, see app.scheme"
+    )
+    parser.add_argument("--budget-ms", type=float, help="of the total, to fail over")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="of a regression, 0.2 is 20%%"
+    )
+    parser.add_argument(
+        "--min-ms", type=float, default=5.0, help="of a regression, below is noise"
+    )
+    args = parser.parse_args()
+
+    result = profile(args)
+    report(result, args.top)
+
+    if args.save:
+        meta = {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "runs": args.runs,
+        }
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "results": result}, f, indent=2)
+    failures = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance, args.min_ms)
+        if regressions:
+            failures.append(f"{len(regressions)} regression(s)")
+    if args.budget_ms is not None and result["total_ms"] > args.budget_ms:
+        failures.append(
+            f"cold start of {result['total_ms']:.0f} ms over the budget of "
+            f"{args.budget_ms:g} ms"
+        )
+    if failures:
+        sys.exit(", ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
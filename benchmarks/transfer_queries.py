@@ -0,0 +1,169 @@
+"""
+Query plans and timings of the transfer access patterns, before and after the
+composite indexes and leaderboard aggregates, on a synthetic database.
+
+    PYTHONPATH=. python -m benchmarks.transfer_queries --transfers 10000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, desc, func, select, text
+from sqlalchemy.orm import joinedload
+
+from app.models import Base, Transfer, TransferStatusEnum, User
+from app.services.counters import rebuild_transfer_stats
+from app.services.selectors import (
+    leaderboard_query,
+    user_transfers_count_query,
+    user_transfers_query,
+)
+
+STATUSES = [status.name for status in TransferStatusEnum]
+
+
+def populate(path, users, transfers, seed, batch_size=100_000):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    rnd = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    with sqlite3.connect(path) as conn:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        # Load without the indexes, they are measured separately
+        for index in Transfer.__table__.indexes:
+            conn.execute(f"DROP INDEX IF EXISTS {index.name}")
+        conn.executemany(
+            "INSERT INTO users (id, username, balance) VALUES (?, ?, ?)",
+            ((i, f"user_{i}", 1_000_000) for i in range(1, users + 1)),
+        )
+        for offset in range(0, transfers, batch_size):
+            rows = []
+            for i in range(offset, min(offset + batch_size, transfers)):
+                created_at = (start + timedelta(seconds=i)).isoformat(" ")
+                rows.append(
+                    (
+                        i + 1,
+                        created_at,
+                        created_at,
+                        rnd.randint(100, 100_000),  # minor units
+                        rnd.choice(STATUSES),
+                        rnd.randint(1, users),
+                        rnd.randint(1, users),
+                    )
+                )
+            conn.executemany(
+                "INSERT INTO transfers (id, created_at, updated_at, amount, status,"
+                " sender_id, receiver_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+
+
+def legacy_queries(user_id):
+    """The OR-predicate queries the selectors issued before the indexes."""
+    either_side = (Transfer.sender_id == user_id) | (Transfer.receiver_id == user_id)
+    pending = either_side & (Transfer.status == TransferStatusEnum.PENDING)
+    parties = (Transfer.sender_id == User.id) | (Transfer.receiver_id == User.id)
+    return {
+        "list first page": select(Transfer)
+        .options(joinedload(Transfer.sender), joinedload(Transfer.receiver))
+        .filter(pending)
+        .order_by(desc(Transfer.created_at), desc(Transfer.id))
+        .limit(10),
+        "list page 50": select(Transfer)
+        .options(joinedload(Transfer.sender), joinedload(Transfer.receiver))
+        .filter(pending)
+        .order_by(desc(Transfer.created_at), desc(Transfer.id))
+        .offset(490)
+        .limit(10),
+        "count": select(func.count(Transfer.id)).filter(pending),
+        "leaderboard": select(User.id, func.count(Transfer.id).label("c"))
+        .join(Transfer, parties)
+        .group_by(User.id)
+        .order_by(desc("c"))
+        .limit(10),
+    }
+
+
+def current_queries(user_id):
+    pending = TransferStatusEnum.PENDING
+    return {
+        "list first page": user_transfers_query(user_id, pending, 0, 10),
+        "list page 50": user_transfers_query(user_id, pending, 490, 10),
+        "count": user_transfers_count_query(user_id, pending),
+        "leaderboard": leaderboard_query("count", 10),
+    }
+
+
+def measure(conn, queries, runs):
+    for name, qry in queries.items():
+        plan = conn.execute(text("EXPLAIN QUERY PLAN " + str(compile_(qry, conn))))
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            conn.execute(qry).all()
+            timings.append((time.perf_counter() - started) * 1000)
+        print(
+            f"  {name:<16} median {statistics.median(timings):9.2f} ms"
+            f"  max {max(timings):9.2f} ms"
+        )
+        for row in plan:
+            print(f"      {row[-1]}")
+
+
+def compile_(qry, conn):
+    return qry.compile(conn, compile_kwargs={"literal_binds": True})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default="./bench.sqlite")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--transfers", type=int, default=10_000_000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reuse", action="store_true", help="keep an existing --db")
+    args = parser.parse_args()
+
+    if not (args.reuse and os.path.exists(args.db)):
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        started = time.perf_counter()
+        populate(args.db, args.users, args.transfers, args.seed)
+        print(f"populated in {time.perf_counter() - started:.1f}s")
+
+    user_id = args.users // 2
+    engine = create_engine(f"sqlite:///{args.db}")
+    with engine.connect() as conn:
+        for index in Transfer.__table__.indexes:
+            index.drop(conn, checkfirst=True)
+        print(f"without indexes, OR predicates ({args.transfers} transfers)")
+        measure(conn, legacy_queries(user_id), args.runs)
+
+        started = time.perf_counter()
+        for index in Transfer.__table__.indexes:
+            index.create(conn)
+        conn.execute(text("ANALYZE transfers"))
+        conn.commit()
+        print(f"indexes built in {time.perf_counter() - started:.1f}s")
+        print("with indexes, OR predicates")
+        measure(conn, legacy_queries(user_id), args.runs)
+        started = time.perf_counter()
+        for stmt in rebuild_transfer_stats():
+            conn.execute(stmt)
+        conn.commit()
+        print(f"leaderboard aggregates built in {time.perf_counter() - started:.1f}s")
+        print("with indexes, UNION ALL and leaderboard aggregates")
+        measure(conn, current_queries(user_id), args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+import pytest
+
+# The engines are created at import time, so point them to a throwaway
+# database before anything from `app` is imported
+_db_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_dir}/test.sqlite"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.db import engine, session_factory  # noqa: E402
+from app.dependencies.get_current_user import user_cache  # noqa: E402
+from app.main import app  # noqa: E402
+from app.services.idempotency import idempotent_results  # noqa: E402
+from app.models import Base  # noqa: E402
+from app.services.response_cache import (  # noqa: E402
+    listing_responses,
+    transfer_responses,
+)
+from app.seed import seed  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def api_client():
+    # A single client keeps one event loop alive for the async engine's pool
+    Base.metadata.create_all(engine)
+    app.state.limiter.enabled = False
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def seeded_db(api_client):
+    user_cache.clear()
+    # The seed reuses transfer ids
+    transfer_responses.clear()
+    listing_responses.clear()
+    idempotent_results.clear()
+    with session_factory() as session:
+        seed(session)
+        yield session
@@ -0,0 +1,176 @@
+import asyncio
+from decimal import Decimal
+
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import func, select
+
+from app.main import app
+from app.models import LedgerEntry, Transfer, TransferStatusEnum, User
+from app.services.entries import balance_drift_query
+
+
+def test_deposit_and_withdraw(api_client, seeded_db):
+    headers = {"user_id": "2"}
+    response = api_client.post("/deposit", params={"amount": "5.5"}, headers=headers)
+    assert response.json() == {"status": "Deposit successful", "balance": "10005.50"}
+
+    response = api_client.post("/withdraw", params={"amount": "5.5"}, headers=headers)
+    assert response.json() == {"status": "Withdrawal successful", "balance": "10000.00"}
+
+    response = api_client.post("/withdraw", params={"amount": "10001"}, headers=headers)
+    assert response.status_code == 400
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 2).balance == 10000
+
+
+def test_non_positive_amounts_are_rejected(api_client, seeded_db):
+    for path in ("/deposit", "/withdraw"):
+        response = api_client.post(
+            path, params={"amount": "-1"}, headers={"user_id": "2"}
+        )
+        assert response.status_code == 422
+
+
+def test_accept_moves_funds_once(api_client, seeded_db):
+    transfer = Transfer(sender_id=3, receiver_id=4, amount=100)
+    seeded_db.add(transfer)
+    seeded_db.commit()
+
+    path = f"/transfers/{transfer.id}/accept"
+    assert api_client.post(path, headers={"user_id": "4"}).status_code == 200
+    assert api_client.post(path, headers={"user_id": "4"}).status_code == 403
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 3).balance == 19900
+    assert seeded_db.get(User, 4).balance == 30098
+    assert seeded_db.get(Transfer, transfer.id).status == TransferStatusEnum.COMPLETED
+
+
+def test_accept_without_funds_keeps_transfer_pending(api_client, seeded_db):
+    response = api_client.post("/transfers/1/accept", headers={"user_id": "2"})
+    assert response.status_code == 400
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(Transfer, 1).status == TransferStatusEnum.PENDING
+
+
+def test_concurrent_deposits_are_not_lost(api_client, seeded_db):
+    async def deposit_many():
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            await asyncio.gather(
+                *(
+                    client.post(
+                        "/deposit", params={"amount": 1}, headers={"user_id": "5"}
+                    )
+                    for _ in range(20)
+                )
+            )
+
+    api_client.portal.call(deposit_many)
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 5).balance == 40020
+
+
+def test_fee_is_exact_and_rounded_half_up(api_client, seeded_db):
+    transfer = Transfer(sender_id=3, receiver_id=4, amount=Decimal("0.25"))
+    seeded_db.add(transfer)
+    seeded_db.commit()
+
+    response = api_client.get(f"/transfers/{transfer.id}", headers={"user_id": "4"})
+    assert response.json()["amount"] == "0.25"
+    api_client.post(f"/transfers/{transfer.id}/accept", headers={"user_id": "4"})
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 3).balance == Decimal("19999.75")
+    assert seeded_db.get(User, 4).balance == Decimal("30000.24")
+
+
+def test_amounts_with_more_than_two_decimals_are_rejected(api_client, seeded_db):
+    response = api_client.post(
+        "/deposit", params={"amount": "0.001"}, headers={"user_id": "2"}
+    )
+    assert response.status_code == 422
+
+
+def test_retries_with_an_idempotency_key_apply_once(api_client, seeded_db):
+    headers = {"user_id": "6", "Idempotency-Key": "deposit-1"}
+
+    async def deposit_with_retries():
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(
+                *(
+                    client.post("/deposit", params={"amount": 3}, headers=headers)
+                    for _ in range(10)
+                )
+            )
+
+    responses = api_client.portal.call(deposit_with_retries)
+    retry = api_client.post("/deposit", params={"amount": 3}, headers=headers)
+    assert {response.json()["balance"] for response in [*responses, retry]} == {
+        "50003.00"
+    }
+
+    other_amount = api_client.post("/deposit", params={"amount": 4}, headers=headers)
+    assert other_amount.status_code == 422
+    # Keys are per user
+    response = api_client.post(
+        "/deposit", params={"amount": 3}, headers={**headers, "user_id": "7"}
+    )
+    assert response.json()["balance"] == "60003.00"
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 6).balance == 50003
+
+
+def test_created_transfers_hold_funds_until_accepted_or_rejected(api_client, seeded_db):
+    bulk = {
+        "transfers": [
+            {"receiver_id": 4, "amount": "100"},
+            {"receiver_id": 5, "amount": "50.25"},
+        ]
+    }
+    response = api_client.post("/transfers/bulk", json=bulk, headers={"user_id": "3"})
+    assert response.status_code == 201
+    paid, returned = response.json()["transfer_ids"]
+    assert returned == paid + 1
+    response = api_client.post(
+        "/transfers", json={"receiver_id": 4, "amount": "1"}, headers={"user_id": "3"}
+    )
+    assert response.json() == {"id": returned + 1}
+    listing = api_client.get("/transfers", headers={"user_id": "4"}).json()
+    assert listing["total_transfers"] == 2
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 3).balance == Decimal("19848.75")
+
+    accept = api_client.post(f"/transfers/{paid}/accept", headers={"user_id": "4"})
+    assert accept.status_code == 200
+    reject = api_client.post(f"/transfers/{returned}/reject", headers={"user_id": "5"})
+    assert reject.status_code == 200
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 3).balance == Decimal("19899")
+    assert seeded_db.get(User, 4).balance == 30098
+    assert seeded_db.get(User, 5).balance == 40000
+    assert seeded_db.scalar(select(func.sum(LedgerEntry.amount))) == 0
+    assert seeded_db.execute(balance_drift_query()).all() == []
+
+
+def test_transfers_are_created_all_or_none(api_client, seeded_db):
+    def create(user_id, *receivers, amount="1"):
+        transfers = [{"receiver_id": r, "amount": amount} for r in receivers]
+        return api_client.post(
+            "/transfers/bulk",
+            json={"transfers": transfers},
+            headers={"user_id": str(user_id)},
+        )
+
+    assert create(1, 2).status_code == 400  # no funds
+    assert create(3, 2, 3).status_code == 400  # to themselves
+    assert create(3, 2, 404).status_code == 404
+    assert create(3, 2, amount="0").status_code == 422
+    assert create(3).status_code == 422
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.scalar(select(func.count(Transfer.id))) == 2
+    assert seeded_db.get(User, 3).balance == 20000
@@ -0,0 +1,47 @@
+import time
+
+from app.cache import TTLCache
+from app.dependencies.get_current_user import user_cache
+from app.models import User
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.stats() == {
+        "size": 2,
+        "maxsize": 2,
+        "hits": 1,
+        "misses": 1,
+        "evictions": 1,
+    }
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_current_user_is_cached_until_renamed(api_client, seeded_db):
+    headers = {"user_id": "2"}
+    api_client.get("/transfers", headers=headers)
+    hits = user_cache.hits
+    api_client.get("/transfers", headers=headers)
+    assert user_cache.hits == hits + 1
+
+    user = seeded_db.get(User, 2)
+    user.username = "renamed"
+    seeded_db.commit()
+    assert user_cache.get(2) is None
+
+
+def test_invalid_user_header(api_client, seeded_db):
+    assert api_client.get("/transfers", headers={"user_id": "abc"}).status_code == 401
+    assert api_client.get("/transfers", headers={"user_id": "999"}).status_code == 401
@@ -0,0 +1,53 @@
+from decimal import Decimal
+
+from sqlalchemy import func, select
+
+from app.models import BalanceSnapshot, LedgerEntry, Transfer, User
+from app.services.entries import (
+    balance_drift_query,
+    checkpoint_balances,
+    ledger_balance,
+    rebuild_balance_snapshots,
+)
+
+
+def test_every_movement_is_balanced_in_the_ledger(api_client, seeded_db):
+    transfer = Transfer(sender_id=3, receiver_id=4, amount=Decimal("0.25"))
+    seeded_db.add(transfer)
+    seeded_db.commit()
+
+    headers = {"user_id": "3"}
+    api_client.post("/deposit", params={"amount": "7"}, headers=headers)
+    api_client.post("/withdraw", params={"amount": "2.5"}, headers=headers)
+    api_client.post(f"/transfers/{transfer.id}/accept", headers={"user_id": "4"})
+
+    seeded_db.rollback()  # end the read snapshot
+    amounts = seeded_db.scalars(
+        select(LedgerEntry.amount).where(LedgerEntry.transfer_id == transfer.id)
+    )
+    assert sorted(amounts) == [Decimal("-0.25"), Decimal("0.01"), Decimal("0.24")]
+    assert seeded_db.scalar(select(func.sum(LedgerEntry.amount))) == 0
+    assert seeded_db.execute(balance_drift_query()).all() == []
+
+    response = api_client.get("/balance", headers=headers)
+    assert response.json() == {"balance": "20004.25"}
+
+
+def test_balance_is_snapshot_plus_tail(api_client, seeded_db):
+    seeded_db.execute(checkpoint_balances())
+    seeded_db.commit()
+    snapshot = seeded_db.get(BalanceSnapshot, 5)
+    assert snapshot.balance == 40000
+
+    api_client.post("/deposit", params={"amount": "1.5"}, headers={"user_id": "5"})
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.scalar(select(ledger_balance(5))) == Decimal("40001.5")
+    seeded_db.execute(checkpoint_balances())
+    seeded_db.refresh(snapshot)
+    assert snapshot.balance == Decimal("40001.5")
+    assert snapshot.entry_id == seeded_db.scalar(select(func.max(LedgerEntry.id)))
+
+    for stmt in rebuild_balance_snapshots():
+        seeded_db.execute(stmt)
+    assert seeded_db.get(BalanceSnapshot, 5).balance == seeded_db.get(User, 5).balance
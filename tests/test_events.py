@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import WebSocketDisconnect
+from sqlalchemy import select
+
+from app.models import UserEvent
+from app.services.events import event_dispatcher, sse_events
+
+
+def test_websocket_pushes_transfer_and_balance_changes(api_client, seeded_db):
+    seeded_db.commit()
+    with api_client.websocket_connect("/events/ws", headers={"user_id": "3"}) as ws:
+        transfer = {"receiver_id": 3, "amount": "100"}
+        response = api_client.post(
+            "/transfers", json=transfer, headers={"user_id": "2"}
+        )
+        transfer_id = response.json()["id"]
+        message = ws.receive_json()
+        assert message["kind"] == "transfer"
+        assert message["data"] == {
+            "id": transfer_id,
+            "status": "pending",
+            "amount": "100.00",
+            "sender_id": 2,
+            "receiver_id": 3,
+        }
+
+        api_client.post(f"/transfers/{transfer_id}/reject", headers={"user_id": "3"})
+        assert ws.receive_json()["data"]["status"] == "rejected"
+
+        api_client.post("/withdraw", params={"amount": 5}, headers={"user_id": "3"})
+        message = ws.receive_json()
+        assert message["kind"] == "balance"
+        assert message["data"] == {"amount": "-5.00", "balance": "19995.00"}
+
+
+def test_websocket_needs_a_user(api_client, seeded_db):
+    with pytest.raises(WebSocketDisconnect) as disconnect:
+        with api_client.websocket_connect("/events/ws"):
+            pass
+    assert disconnect.value.code == 1008
+
+
+def test_sse_resumes_after_the_last_event_id(api_client, seeded_db):
+    seeded_db.commit()
+    for amount in (10, 20):
+        api_client.post("/deposit", params={"amount": amount}, headers={"user_id": "3"})
+    first, second = seeded_db.scalars(
+        select(UserEvent.id).where(UserEvent.user_id == 3).order_by(UserEvent.id)
+    )
+
+    async def read_resumed():
+        stream = sse_events(3, first)
+        try:
+            return [await stream.__anext__(), await stream.__anext__()]
+        finally:
+            await stream.aclose()
+
+    opened, resumed = api_client.portal.call(read_resumed)
+    assert opened == b": keep-alive\n\n"
+    lines = resumed.decode().splitlines()
+    assert lines[:2] == [f"id: {second}", "event: balance"]
+    assert json.loads(lines[2].removeprefix("data: ")) == {
+        "amount": "20.00",
+        "balance": "20030.00",
+    }
+
+
+def test_lagging_subscribers_are_closed(api_client, seeded_db, monkeypatch):
+    seeded_db.commit()
+    monkeypatch.setattr(event_dispatcher, "queue_size", 1)
+    overflows = event_dispatcher.overflows
+
+    async def subscribe():
+        return event_dispatcher.subscribe(4)
+
+    async def read_when_closed(subscription):
+        # Not before, a reader keeping up would not lag behind
+        while subscription.closed is None:
+            await asyncio.sleep(0.01)
+        return [event async for event in subscription.events()]
+
+    subscription = api_client.portal.call(subscribe)
+    with subscription:
+        for amount in (1, 2):
+            api_client.post(
+                "/deposit", params={"amount": amount}, headers={"user_id": "4"}
+            )
+        events = api_client.portal.call(
+            asyncio.wait_for, read_when_closed(subscription), 5
+        )
+    # The first one was queued, the client resumes after it from the outbox
+    assert [event.payload["amount"] for event in events] == ["1.00"]
+    assert subscription.closed == "overflow"
+    assert event_dispatcher.overflows == overflows + 1
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select, update
+
+from app.db import write_session_factory
+from app.models import (
+    LedgerEntry,
+    SchedulerLease,
+    Transfer,
+    TransferStatusEnum,
+    User,
+    UserEvent,
+)
+from app.scheduler import LeaderLease, scheduler
+from app.services.entries import balance_drift_query
+
+
+def test_stale_pending_transfers_expire(api_client, seeded_db):
+    seeded_db.commit()
+    transfer = {"receiver_id": 3, "amount": "100"}
+    response = api_client.post("/transfers", json=transfer, headers={"user_id": "2"})
+    held_id = response.json()["id"]
+    fresh_id = api_client.post(
+        "/transfers", json=transfer, headers={"user_id": "2"}
+    ).json()["id"]
+    seeded_db.rollback()  # end the read snapshot
+    seeded_db.execute(
+        update(Transfer)
+        .where(Transfer.id.in_([1, held_id]))
+        .values(created_at=datetime.now() - timedelta(days=8))
+    )
+    seeded_db.commit()
+
+    assert api_client.portal.call(scheduler.tick) == {"expire_transfers": 2}
+    seeded_db.rollback()
+    statuses = dict(seeded_db.execute(select(Transfer.id, Transfer.status)).all())
+    assert statuses[1] == statuses[held_id] == TransferStatusEnum.EXPIRED
+    assert statuses[fresh_id] == TransferStatusEnum.PENDING
+    # The expired hold went back to the sender, the fresh one is still held
+    assert seeded_db.get(User, 2).balance == 9900
+    assert seeded_db.scalar(select(func.sum(LedgerEntry.amount))) == 0
+    assert seeded_db.execute(balance_drift_query()).all() == []
+    event = seeded_db.scalars(
+        select(UserEvent.payload).where(UserEvent.user_id == 3).order_by(UserEvent.id)
+    ).all()[-1]
+    assert event["id"] == held_id and event["status"] == "expired"
+
+    path = f"/transfers/{held_id}/accept"
+    assert api_client.post(path, headers={"user_id": "3"}).status_code == 403
+    response = api_client.get(
+        "/transfers", params={"status": "expired"}, headers={"user_id": "3"}
+    )
+    assert [transfer["id"] for transfer in response.json()["transfers"]] == [held_id]
+    assert api_client.portal.call(scheduler.tick) == {"expire_transfers": 0}
+
+
+def test_only_the_lease_holder_runs_the_jobs(api_client, seeded_db):
+    other = LeaderLease(write_session_factory, scheduler.lease.name, ttl=60)
+
+    async def clear_leases():
+        async with write_session_factory() as session:
+            await session.execute(delete(SchedulerLease))
+            await session.commit()
+
+    api_client.portal.call(clear_leases)
+    try:
+        assert api_client.portal.call(other.acquire)
+        assert api_client.portal.call(scheduler.tick) is None
+        assert scheduler.stats()["leader"] == 0
+        # Taken over once the holder gives it up
+        api_client.portal.call(other.release)
+        assert api_client.portal.call(scheduler.tick) == {"expire_transfers": 0}
+        assert not api_client.portal.call(other.acquire)
+    finally:
+        api_client.portal.call(clear_leases)
@@ -0,0 +1,63 @@
+import asyncio
+from decimal import Decimal
+
+from app.models import BalanceSnapshot, User
+from app.services.business_logic import deposit_balance, withdraw_amount
+from app.services.ledger import ledger
+from app.services.mutations import adjust_balance
+
+
+def test_concurrent_writes_are_group_committed(api_client, seeded_db):
+    async def write_many():
+        return await asyncio.gather(
+            *(deposit_balance(6, Decimal(1)) for _ in range(30)),
+            withdraw_amount(6, Decimal(10**6)),
+        )
+
+    before = ledger.stats()
+    results = api_client.portal.call(write_many)
+    after = ledger.stats()
+
+    assert all(result.is_ok for result in results[:-1])
+    assert results[-1].unwrap_err().status_code == 400
+    assert after["operations"] - before["operations"] == 31
+    assert after["batches"] - before["batches"] < 31
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 6).balance == 50030
+
+
+def test_failed_operation_only_rolls_back_itself(api_client, seeded_db):
+    async def broken(session):
+        await adjust_balance(session, 7, Decimal(5))
+        raise RuntimeError("boom")
+
+    async def write_both():
+        return await asyncio.gather(
+            ledger.submit(broken),
+            deposit_balance(7, Decimal(1)),
+            return_exceptions=True,
+        )
+
+    failed, deposited = api_client.portal.call(write_both)
+
+    assert isinstance(failed, RuntimeError)
+    assert deposited.is_ok
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 7).balance == 60001
+
+
+def test_unknown_user_deposit_is_an_error(api_client, seeded_db):
+    result = api_client.portal.call(deposit_balance, 999, Decimal(1))
+    assert result.unwrap_err().status_code == 404
+
+
+def test_writer_checkpoints_balances(api_client, seeded_db, monkeypatch):
+    monkeypatch.setattr(ledger, "checkpoint_every", 1)
+    checkpoints = ledger.checkpoints
+
+    api_client.portal.call(deposit_balance, 8, Decimal(2))
+    api_client.portal.call(ledger.close)  # the checkpoint runs after the batch
+
+    assert ledger.checkpoints == checkpoints + 1
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(BalanceSnapshot, 8).balance == 70002
@@ -0,0 +1,70 @@
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import select
+
+from app.db import read_session_factory
+from app.metrics import (
+    Histogram,
+    MetricsMiddleware,
+    db_n_plus_one,
+    http_request_statements,
+    normalize_statement,
+)
+from app.models import User
+
+
+def test_statements_are_normalized():
+    statement = "SELECT * FROM t\n  WHERE id IN (?, ?, ?) AND name = 'o''k' AND n > 10"
+    assert normalize_statement(statement) == (
+        "SELECT * FROM t WHERE id IN (?, ...) AND name = ? AND n > ?"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency", "Help.", ["route"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, "/a")
+    assert list(histogram.render())[2:] == [
+        'latency_bucket{route="/a",le="0.1"} 1',
+        'latency_bucket{route="/a",le="1"} 2',
+        'latency_bucket{route="/a",le="+Inf"} 3',
+        'latency_sum{route="/a"} 5.55',
+        'latency_count{route="/a"} 3',
+    ]
+
+
+def test_requests_are_recorded_by_route(api_client, seeded_db):
+    api_client.get("/transfers/1", headers={"user_id": "1"})
+    api_client.get("/transfers/2", headers={"user_id": "1"})
+
+    body = api_client.get("/metrics").text
+    assert (
+        'http_responses_total{method="GET",route="/transfers/{transfer_id}",'
+        'status="200"}' in body
+    )
+    assert 'db_statement_duration_seconds_count{engine="read",operation="SELECT"}' in (
+        body
+    )
+    assert 'cache_size{cache="users"}' in body
+
+
+def test_repeated_statements_are_reported_as_n_plus_one(api_client):
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/users")
+    async def list_users_one_by_one():
+        async with read_session_factory() as session:
+            for user_id in range(1, 11 + 1):
+                await session.scalar(select(User.username).where(User.id == user_id))
+
+    async def get_users():
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.get("/users")
+
+    before = db_n_plus_one.value("/users")
+    # On the client's event loop, where the pooled connections live
+    api_client.portal.call(get_users)
+    assert db_n_plus_one.value("/users") == before + 1
+    assert http_request_statements.count("/users") == 1
@@ -0,0 +1,38 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+from app.shards import SHARD_BUCKETS
+
+ROOT = Path(__file__).parent.parent
+
+
+def test_upgrade_migrates_every_shard_of_database_url(tmp_path):
+    buckets = [bucket % 2 for bucket in range(SHARD_BUCKETS)]
+    (tmp_path / "db.shards.json").write_text(
+        json.dumps({"buckets": buckets, "first_id": 1})
+    )
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path / 'db.sqlite'}"}
+    subprocess.run(
+        [sys.executable, "-m", "alembic", "upgrade", "head"],
+        cwd=ROOT,
+        env=env,
+        check=True,
+        capture_output=True,
+    )
+    heads = subprocess.run(
+        [sys.executable, "-m", "alembic", "heads"],
+        cwd=ROOT,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()[0]
+
+    for name in ["db.sqlite", "db.shard1.sqlite"]:
+        with sqlite3.connect(tmp_path / name) as connection:
+            versions = connection.execute("SELECT * FROM alembic_version").fetchall()
+        assert versions == [(heads,)]
@@ -0,0 +1,32 @@
+from app.main import app
+from app.scheme import OpenAPISchema, artifact_path
+
+
+def test_schema_is_served_with_an_etag(api_client):
+    response = api_client.get("/openapi.json")
+    assert response.status_code == 200
+    paths = response.json()["paths"]
+    parameters = [
+        p["name"] for p in paths["/transfers/batch/accept"]["post"]["parameters"]
+    ]
+    assert parameters == ["user_id"]
+    leaderboard = paths["/leaderboard/top-transfers"]["get"]["parameters"]
+    assert "user_id" not in {parameter["name"] for parameter in leaderboard}
+    assert "/docs" not in paths and "/openapi.json" not in paths
+
+    etag = response.headers["etag"]
+    response = api_client.get("/openapi.json", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert "/openapi.json" in api_client.get("/docs").text
+
+
+def test_schema_is_loaded_from_its_artifact(api_client, tmp_path):
+    path = OpenAPISchema(app).write(tmp_path)
+    assert path == artifact_path(tmp_path)
+
+    loaded = OpenAPISchema(app, path)
+    assert loaded.encoded().body == path.read_bytes() and loaded.loaded
+    assert loaded.encoded().etag == api_client.get("/openapi.json").headers["etag"]
+    # Without one, e.g. for other sources, the same schema is built
+    built = OpenAPISchema(app, tmp_path / "missing.json")
+    assert built.encoded().body == path.read_bytes() and not built.loaded
@@ -0,0 +1,132 @@
+import time
+
+import pytest
+
+from sqlalchemy import text
+
+from app.db import write_engine, write_session_factory
+from app.dependencies.rate_limit import limiter, limiter_database
+from app.main import app
+from app.models import RateLimitBucket
+from app.ratelimit import Limiter, RateLimit, SqlBucketStore
+
+
+def test_parse_rate_limits():
+    assert RateLimit.parse("5/minute") == RateLimit(5, 60)
+    assert RateLimit.parse("100 per hours") == RateLimit(100, 3600)
+    with pytest.raises(ValueError):
+        RateLimit.parse("5/fortnight")
+
+
+def test_local_bucket_allows_bursts_then_refills():
+    limiter = Limiter()
+    limit = RateLimit(2, 1)
+    assert limiter.hit("scope", 1, limit) is None
+    assert limiter.hit("scope", 1, limit) is None
+    retry_after = limiter.hit("scope", 1, limit)
+    assert 0 < retry_after <= 0.5
+    # Buckets are per scope and key
+    assert limiter.hit("scope", 2, limit) is None
+    assert limiter.hit("other", 1, limit) is None
+
+
+def test_workers_share_buckets_through_the_store(api_client, seeded_db):
+    limit = RateLimit(10, 3600)
+    workers = [
+        Limiter(SqlBucketStore(write_session_factory), sync_interval=3600)
+        for _ in range(2)
+    ]
+
+    async def hit_and_sync():
+        for _ in range(4):
+            assert workers[0].hit("shared", "u1", limit) is None
+        for _ in range(4):
+            assert workers[1].hit("shared", "u1", limit) is None
+        for worker in workers:
+            await worker.close()
+        # The first worker learns the second worker's hits on its next sync
+        assert workers[0].hit("shared", "u1", limit) is None
+        await workers[0].sync()
+        # 10 - 9 taken
+        assert workers[0].hit("shared", "u1", limit) is None
+        assert workers[0].hit("shared", "u1", limit) is not None
+        await workers[0].close()
+
+    api_client.portal.call(hit_and_sync)
+
+    assert workers[0].syncs == 3
+    bucket = seeded_db.get(RateLimitBucket, "shared:u1")
+    assert bucket.capacity == 10
+    assert round(bucket.tokens) == 0
+
+
+def test_limiter_has_a_database_of_its_own(api_client):
+    assert limiter.store.session_factory is limiter_database.write_session_factory
+    assert limiter_database.write_engine.url.database != write_engine.url.database
+
+    worker = Limiter(SqlBucketStore(limiter_database.write_session_factory))
+
+    async def hit_and_sync():
+        assert worker.hit("own", 1, RateLimit(5, 60)) is None
+        await worker.close()
+
+    api_client.portal.call(hit_and_sync)
+    with limiter_database.engine.connect() as connection:
+        tokens = connection.scalar(
+            text("SELECT tokens FROM rate_limit_buckets WHERE key = 'own:1'")
+        )
+    assert round(tokens) == 4
+
+
+def test_store_prunes_full_buckets(api_client, seeded_db):
+    now = time.time()
+    seeded_db.add_all(
+        [
+            RateLimitBucket(
+                key="idle", tokens=9, capacity=10, rate=1, updated_at=now - 5
+            ),
+            RateLimitBucket(
+                key="busy", tokens=0, capacity=10, rate=1, updated_at=now - 5
+            ),
+        ]
+    )
+    seeded_db.commit()
+    store = SqlBucketStore(write_session_factory, prune_interval=3600)
+    levels = api_client.portal.call(
+        store.exchange, [("active", RateLimit(10, 10), 1, now)]
+    )
+    assert levels == {"active": 9}
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(RateLimitBucket, "idle") is None
+    assert seeded_db.get(RateLimitBucket, "busy") is not None
+    assert store.pruned == 1
+    # Not again before `prune_interval`
+    seeded_db.get(RateLimitBucket, "busy").tokens = 10
+    seeded_db.commit()
+    api_client.portal.call(store.exchange, [("active", RateLimit(10, 10), 1, now)])
+    assert store.pruned == 1
+
+
+def test_rate_limited_requests_get_429(api_client, seeded_db):
+    app.state.limiter.enabled = True
+    try:
+        responses = [
+            api_client.get("/transfers", headers={"user_id": "3"}) for _ in range(6)
+        ]
+    finally:
+        app.state.limiter.enabled = False
+
+    assert [response.status_code for response in responses] == [200] * 5 + [429]
+    assert int(responses[-1].headers["Retry-After"]) > 0
+    # Keyed by the authenticated user, not by the header's text
+    app.state.limiter.enabled = True
+    try:
+        spelled = api_client.get("/transfers", headers={"user_id": "03"})
+        other = api_client.get("/transfers", headers={"user_id": "4"})
+        anonymous = api_client.get("/transfers", headers={"user_id": "999"})
+    finally:
+        app.state.limiter.enabled = False
+    assert spelled.status_code == 429
+    assert other.status_code == 200
+    assert anonymous.status_code == 401
@@ -0,0 +1,35 @@
+from sqlalchemy import func, select
+
+from app.models import Transfer, TransferStatusEnum, User, UserTransferCount
+from app.seed import bulk_seed
+
+
+def _transfers(session):
+    return session.execute(
+        select(Transfer.sender_id, Transfer.receiver_id, Transfer.amount).order_by(
+            Transfer.id
+        )
+    ).all()
+
+
+def test_bulk_seed_is_deterministic_and_skewed(api_client, seeded_db):
+    seeded_db.commit()
+    options = dict(users=50, transfers=3_000, seed=1, skew=3, batch_size=1_000)
+    bulk_seed(**options, statuses={TransferStatusEnum.PENDING: 1})
+    first = _transfers(seeded_db)
+    seeded_db.rollback()  # end the read snapshot
+
+    assert len(first) == 3_000
+    assert all(sender != receiver for sender, receiver, _ in first)
+    assert {status for status in seeded_db.scalars(select(Transfer.status))} == {
+        TransferStatusEnum.PENDING
+    }
+    senders = [sender for sender, _, _ in first]
+    assert senders.count(1) > 10 * senders.count(50)
+    assert seeded_db.scalar(select(func.count(User.id))) == 50
+    # Counted for the sender and the receiver
+    assert seeded_db.scalar(select(func.sum(UserTransferCount.transfer_count))) == 6_000
+
+    bulk_seed(**options, statuses={TransferStatusEnum.PENDING: 1})
+    seeded_db.rollback()  # end the read snapshot
+    assert _transfers(seeded_db) == first
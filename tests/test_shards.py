@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+from sqlalchemy import func, select, update
+from sqlalchemy.engine import make_url
+
+from app.db import DATABASE_URL
+from app.models import LedgerEntry, Transfer, TransferStatusEnum, User
+from app.rebalance_shards import rebalance
+from app.services.business_logic import expire_stale_transfers
+from app.services.entries import balance_drift_query, opening_entries
+from app.services.shard_relay import shard_relay
+from app.shards import load_router, router, shard_map_path, shard_url
+
+
+@pytest.fixture
+def two_shards(api_client, seeded_db, monkeypatch):
+    # Buckets 3000 and 3001 go to the second shard, users 1 to 10 stay
+    seeded_db.add_all(
+        [
+            User(id=3000, username="far_0", balance=Decimal(500)),
+            User(id=3001, username="far_1", balance=Decimal(0)),
+        ]
+    )
+    seeded_db.execute(opening_entries())
+    seeded_db.commit()
+    rebalance(2)
+    loaded = load_router()
+    for name in ("shards", "buckets", "first_id"):
+        monkeypatch.setattr(router, name, getattr(loaded, name))
+    yield loaded.shards
+
+    second = loaded.shards[1]
+    api_client.portal.call(second.ledger.close)
+    api_client.portal.call(second.database.write_engine.dispose)
+    api_client.portal.call(second.database.read_engine.dispose)
+    second.database.engine.dispose()
+    shard_map_path().unlink()
+    path = Path(make_url(shard_url(DATABASE_URL, 1)).database)
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
+
+
+def _balanced(shard):
+    with shard.database.session_factory() as session:
+        assert session.scalar(select(func.sum(LedgerEntry.amount))) == 0
+        assert session.execute(balance_drift_query()).all() == []
+
+
+def _deliver(api_client, shards):
+    for shard in shards:
+        api_client.portal.call(shard_relay.deliver, shard)
+
+
+def test_rebalance_moves_users_with_their_balance(api_client, two_shards):
+    first, second = two_shards
+    assert router.shard_for(3000) is second and router.shard_for(1) is first
+
+    response = api_client.get("/balance", headers={"user_id": "3000"})
+    assert response.json() == {"balance": "500.00"}
+    with second.database.session_factory() as session:
+        assert session.get(User, 3000).balance == 500
+        assert session.get(User, 5).balance == 0  # only there to be joined
+    for shard in two_shards:
+        _balanced(shard)
+
+    response = api_client.get("/leaderboard/top-transfers", params={"limit": 2})
+    assert {row["id"] for row in response.json()} == {1, 2}
+
+
+def test_cross_shard_transfers_settle_through_the_outbox(api_client, two_shards):
+    first, second = two_shards
+    headers = {"user_id": "3000"}
+    bulk = {
+        "transfers": [
+            {"receiver_id": 4, "amount": "100"},
+            {"receiver_id": 5, "amount": "50"},
+            {"receiver_id": 3001, "amount": "10"},
+        ]
+    }
+    response = api_client.post("/transfers/bulk", json=bulk, headers=headers)
+    accepted, rejected, local = response.json()["transfer_ids"]
+    # Ids of the second shard, above the copied ones
+    assert accepted % 2 == rejected % 2 == 1 and accepted > 2
+    _deliver(api_client, two_shards)
+
+    listing = api_client.get("/transfers", headers={"user_id": "4"}).json()
+    assert accepted in {transfer["id"] for transfer in listing["transfers"]}
+    path = f"/transfers/{accepted}/accept"
+    assert api_client.post(path, headers={"user_id": "4"}).status_code == 200
+    path = f"/transfers/{rejected}/reject"
+    assert api_client.post(path, headers={"user_id": "5"}).status_code == 200
+    path = f"/transfers/{local}/accept"
+    assert api_client.post(path, headers={"user_id": "3001"}).status_code == 200
+    _deliver(api_client, two_shards)
+
+    with second.database.session_factory() as session:
+        assert session.get(User, 3000).balance == 390  # paid 100 and 10
+        assert session.get(User, 3001).balance == Decimal("9.80")
+        statuses = session.scalars(
+            select(Transfer.status).where(Transfer.id.in_([accepted, rejected]))
+        )
+        assert list(statuses) == [
+            TransferStatusEnum.COMPLETED,
+            TransferStatusEnum.REJECTED,
+        ]
+    with first.database.session_factory() as session:
+        assert session.get(User, 4).balance == 30098
+        assert session.get(User, 5).balance == 40000
+    for shard in two_shards:
+        _balanced(shard)
+    response = api_client.get("/balance", headers=headers)
+    assert response.json() == {"balance": "390.00"}
+
+
+def test_each_shard_expires_up_to_the_tick_budget(api_client, two_shards, monkeypatch):
+    monkeypatch.setattr("app.services.business_logic.EXPIRY_MAX_PER_TICK", 2)
+    monkeypatch.setattr("app.services.business_logic.EXPIRY_CHUNK_SIZE", 1)
+    monkeypatch.setattr("app.services.business_logic.EXPIRY_CHUNK_PAUSE", 0)
+    # Three stale transfers on the first shard, one on the second
+    for sender, receiver in [("2", 3)] * 3 + [("3000", 3001)]:
+        response = api_client.post(
+            "/transfers",
+            json={"receiver_id": receiver, "amount": "10"},
+            headers={"user_id": sender},
+        )
+        assert response.status_code == 201
+    for shard in two_shards:
+        with shard.database.session_factory() as session:
+            session.execute(
+                update(Transfer)
+                .where(Transfer.receiver_id.in_([3, 3001]))
+                .values(created_at=datetime.now() - timedelta(days=8))
+            )
+            session.commit()
+
+    # The first shard's backlog takes its whole budget, not the second's
+    assert api_client.portal.call(expire_stale_transfers) == 3
+    first, second = two_shards
+    with second.database.session_factory() as session:
+        statuses = session.scalars(
+            select(Transfer.status).where(Transfer.receiver_id == 3001)
+        ).all()
+    assert statuses == [TransferStatusEnum.EXPIRED]
+    assert api_client.portal.call(expire_stale_transfers) == 1
+    _balanced(first)
+    _balanced(second)
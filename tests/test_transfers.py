@@ -0,0 +1,271 @@
+import csv
+import io
+import json
+
+from app.models import Transfer, TransferStatusEnum, User
+from app.services.pydantic_models import TransferPageValidator
+from app.services.counters import transfer_stats_delta
+
+
+def test_list_transfers_as_sender(api_client, seeded_db):
+    response = api_client.get("/transfers", headers={"user_id": "1"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total_transfers"] == 2
+    assert {t["sender"]["id"] for t in body["transfers"]} == {1}
+
+
+def test_list_transfers_filtered_by_status(api_client, seeded_db):
+    response = api_client.get(
+        "/transfers", params={"status": "pending"}, headers={"user_id": "2"}
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total_transfers"] == 1
+    assert body["transfers"][0]["status"] == "pending"
+
+
+def test_get_transfer_loads_parties(api_client, seeded_db):
+    transfer = seeded_db.query(Transfer).first()
+    response = api_client.get(f"/transfers/{transfer.id}", headers={"user_id": "2"})
+    assert response.status_code == 200
+    assert response.json()["receiver"]["username"] == "user_1"
+
+
+def test_get_transfer_denied_for_third_party(api_client, seeded_db):
+    transfer = seeded_db.query(Transfer).first()
+    response = api_client.get(f"/transfers/{transfer.id}", headers={"user_id": "3"})
+    assert response.status_code == 403
+
+
+def test_missing_user_header(api_client, seeded_db):
+    assert api_client.get("/transfers").status_code == 401
+
+
+def test_cursor_pagination_walks_all_transfers(api_client, seeded_db):
+    for amount in range(1, 6):
+        seeded_db.add(Transfer(sender_id=3, receiver_id=4, amount=amount))
+    seeded_db.commit()
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        body = api_client.get("/transfers", params=params, headers={"user_id": "3"})
+        body = body.json()
+        seen.extend(t["id"] for t in body["transfers"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+        assert body["page"] in (1, None)
+
+    assert len(seen) == 5
+    assert seen == sorted(seen, reverse=True)
+
+
+def test_invalid_cursor(api_client, seeded_db):
+    response = api_client.get(
+        "/transfers", params={"cursor": "not-a-cursor"}, headers={"user_id": "1"}
+    )
+    assert response.status_code == 400
+
+
+def test_leaderboard_counts_completed_transfers(api_client, seeded_db):
+    response = api_client.get("/leaderboard/top-transfers", params={"by": "count"})
+    assert response.status_code == 200
+    counts = {row["id"]: row["transfer_count"] for row in response.json()}
+    assert counts == {1: 1, 2: 1}
+
+
+def test_leaderboard_follows_completed_transfers(api_client, seeded_db):
+    transfer = Transfer(sender_id=3, receiver_id=4, amount=10)
+    seeded_db.add(transfer)
+    seeded_db.flush()
+    seeded_db.execute(transfer_stats_delta([transfer]))
+    seeded_db.commit()
+
+    response = api_client.get(
+        "/leaderboard/top-transfers", params={"by": "amount", "limit": 4}
+    )
+    totals = {row["id"]: row["total_transferred"] for row in response.json()}
+    assert totals == {1: "1000.00", 2: "1000.00", 3: "10.00", 4: "10.00"}
+
+    response = api_client.get("/leaderboard/top-transfers", params={"limit": 1})
+    [top] = response.json()
+    assert set(top) == {"id", "username", "transfer_count"}
+
+
+def test_counters_follow_status_changes(api_client, seeded_db):
+    headers = {"user_id": "2"}
+    pending = api_client.get(
+        "/transfers", params={"status": "pending"}, headers=headers
+    )
+    transfer_id = pending.json()["transfers"][0]["id"]
+
+    response = api_client.post(f"/transfers/{transfer_id}/reject", headers=headers)
+    assert response.status_code == 200
+
+    for status, total in (("pending", 0), ("rejected", 1), ("completed", 1)):
+        body = api_client.get(
+            "/transfers", params={"status": status}, headers=headers
+        ).json()
+        assert body["total_transfers"] == total
+    assert api_client.get("/transfers", headers=headers).json()["total_transfers"] == 2
+
+
+def test_listing_without_total(api_client, seeded_db):
+    response = api_client.get(
+        "/transfers",
+        params={"include_total": False, "limit": 1},
+        headers={"user_id": "1"},
+    )
+    body = response.json()
+    assert body["total_transfers"] is None
+    assert body["has_more"] is True
+    assert len(body["transfers"]) == 1
+
+
+def test_batch_accept_reports_each_transfer(api_client, seeded_db):
+    transfers = [
+        Transfer(sender_id=3, receiver_id=4, amount=amount)
+        for amount in (100, 200, 1_000_000)
+    ]
+    seeded_db.add_all(transfers)
+    seeded_db.commit()
+    ids = [transfer.id for transfer in transfers]
+
+    response = api_client.post(
+        "/transfers/batch/accept",
+        json={"transfer_ids": [*ids, 1]},
+        headers={"user_id": "4"},
+    )
+    assert response.status_code == 200
+    assert [item["status_code"] for item in response.json()["results"]] == [
+        200,
+        200,
+        400,
+        403,
+    ]
+
+    seeded_db.rollback()  # end the read snapshot
+    assert seeded_db.get(User, 3).balance == 20000 - 300
+    assert seeded_db.get(User, 4).balance == 30000 + 300 * 0.98
+    assert seeded_db.get(Transfer, ids[2]).status == TransferStatusEnum.PENDING
+
+
+def test_batch_reject(api_client, seeded_db):
+    response = api_client.post(
+        "/transfers/batch/reject",
+        json={"transfer_ids": [1, 2]},
+        headers={"user_id": "2"},
+    )
+    assert [item["status_code"] for item in response.json()["results"]] == [200, 403]
+    body = api_client.get(
+        "/transfers", params={"status": "rejected"}, headers={"user_id": "2"}
+    ).json()
+    assert body["total_transfers"] == 1
+
+
+def test_get_transfer_revalidates_with_etag(api_client, seeded_db):
+    headers = {"user_id": "2"}
+    response = api_client.get("/transfers/1", headers=headers)
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    response = api_client.get(
+        "/transfers/1", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+
+    api_client.post("/transfers/1/reject", headers=headers)
+    response = api_client.get(
+        "/transfers/1", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["status"] == "rejected"
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    # Final transfers are served from the cache, still access checked
+    assert api_client.get("/transfers/1", headers={"user_id": "3"}).status_code == 403
+
+
+def test_renames_change_the_etags_of_the_counterparties(api_client, seeded_db):
+    headers = {"user_id": "2"}
+    api_client.post("/transfers/1/reject", headers=headers)
+    response = api_client.get("/transfers/1", headers=headers)
+    sender_id, etag = response.json()["sender"]["id"], response.headers["etag"]
+    listing_etag = api_client.get("/transfers", headers=headers).headers["etag"]
+
+    seeded_db.rollback()  # end the read snapshot
+    seeded_db.get(User, sender_id).username = "renamed"
+    seeded_db.commit()
+
+    response = api_client.get(
+        "/transfers/1", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["sender"]["username"] == "renamed"
+    response = api_client.get(
+        "/transfers", headers={**headers, "If-None-Match": listing_etag}
+    )
+    assert response.status_code == 200
+    assert "renamed" in {t["sender"]["username"] for t in response.json()["transfers"]}
+
+
+def test_listing_etag_follows_the_users_transfers(api_client, seeded_db):
+    headers = {"user_id": "2"}
+    response = api_client.get("/transfers", headers=headers)
+    etag = response.headers["etag"]
+
+    response = api_client.get("/transfers", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    other_page = api_client.get(
+        "/transfers", params={"limit": 1}, headers={**headers, "If-None-Match": etag}
+    )
+    assert other_page.status_code == 200
+
+    api_client.post("/transfers/1/reject", headers=headers)
+    response = api_client.get("/transfers", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    statuses = {t["status"] for t in response.json()["transfers"]}
+    assert statuses == {"rejected", "completed"}
+
+
+def test_listing_serializes_like_the_validator(api_client, seeded_db):
+    response = api_client.get("/transfers", headers={"user_id": "1"})
+    transfers = seeded_db.query(Transfer).order_by(Transfer.id.desc()).all()
+    expected = TransferPageValidator(
+        page=1, limit=10, transfers=transfers, total_transfers=2
+    )
+    assert response.content == expected.model_dump_json().encode()
+
+
+def test_export_streams_the_whole_history(api_client, seeded_db, monkeypatch):
+    monkeypatch.setattr("app.services.export.EXPORT_BATCH_SIZE", 2)
+    for amount in range(1, 6):
+        seeded_db.add(Transfer(sender_id=3, receiver_id=4, amount=amount))
+    seeded_db.add(Transfer(sender_id=4, receiver_id=3, amount=6))
+    seeded_db.commit()
+
+    response = api_client.get("/transfers/export", headers={"user_id": "3"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["amount"] for line in lines] == [
+        "1.00",
+        "2.00",
+        "3.00",
+        "4.00",
+        "5.00",
+        "6.00",
+    ]
+    assert lines[-1]["sender"] == {"id": 4, "username": "user_3"}
+
+    response = api_client.get(
+        "/transfers/export",
+        params={"format": "csv", "created_from": lines[4]["created_at"]},
+        headers={"user_id": "3"},
+    )
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["id"] for row in rows] == [str(lines[4]["id"]), str(lines[5]["id"])]
+    assert rows[0]["status"] == "pending"